@@ -1,22 +1,68 @@
 from itertools import product
+from typing import Union
 
-from ortools.linear_solver import pywraplp
+import numpy as np
 
+from .trace import annotate, traced
+
+ENGINES = ("min_cost_flow", "scip")
+
+
+def _section_keyword_counts(*, n_keywords: int, n_resume_sections: int, count_weights: list[int]) -> list[int]:
+    """Split the keywords among the resume sections in proportion to count_weights (1 for sections without a weight)."""
+    actual_weights = [
+        count_weights[resume_section_index] if resume_section_index < len(count_weights) else 1
+        for resume_section_index in range(n_resume_sections)
+    ]
+    total_weight = sum(actual_weights)
+    section_keyword_counts = []
+    n_keywords_assigned = 0
+    for resume_section_index in range(n_resume_sections):
+        n_keywords_assigned_cumulative = min(
+            n_keywords, round(n_keywords / total_weight * sum(actual_weights[0 : resume_section_index + 1]))
+        )
+        section_keyword_counts.append(n_keywords_assigned_cumulative - n_keywords_assigned)
+        n_keywords_assigned = n_keywords_assigned_cumulative
+    assert n_keywords_assigned == n_keywords, f"Algorithm error: {n_keywords_assigned} assigned / {n_keywords} total"
+    return section_keyword_counts
+
+
+def _assign_min_cost_flow(*, compatibility: np.ndarray, section_keyword_counts: list[int]) -> list[tuple[int, int]]:
+    # The solvers are imported on first use, since OR-Tools takes a while to import
+    from ortools.graph.python import min_cost_flow
+
+    n_resume_sections, n_keywords = compatibility.shape
+    if n_keywords == 0:
+        return []
+    # Transportation network: every keyword node supplies 1 unit of flow, every resume section node demands as many
+    # units as it should get keywords, and each keyword - resume section arc costs the negated compatibility.
+    keyword_nodes, resume_section_nodes = np.meshgrid(
+        np.arange(n_keywords), n_keywords + np.arange(n_resume_sections), indexing="ij"
+    )
+    solver = min_cost_flow.SimpleMinCostFlow()
+    arcs = solver.add_arcs_with_capacity_and_unit_cost(
+        keyword_nodes.ravel(),
+        resume_section_nodes.ravel(),
+        np.ones(n_keywords * n_resume_sections, dtype=np.int64),
+        -compatibility.T.ravel(),
+    )
+    solver.set_nodes_supplies(
+        np.arange(n_keywords + n_resume_sections),
+        np.concatenate([np.ones(n_keywords, dtype=np.int64), -np.asarray(section_keyword_counts, dtype=np.int64)]),
+    )
+    status = solver.solve()
+    annotate(solver_status=status.name)
+    if status != solver.OPTIMAL:
+        raise RuntimeError(f"No feasible keyword - resume section assignment found ({status}).")
+    keyword_indices, resume_section_indices = np.divmod(np.flatnonzero(solver.flows(arcs) > 0), n_resume_sections)
+    return list(zip(keyword_indices.tolist(), resume_section_indices.tolist()))
+
+
+def _assign_scip(*, compatibility: np.ndarray, section_keyword_counts: list[int]) -> list[tuple[int, int]]:
+    from ortools.linear_solver import pywraplp
 
-def assign(*, compatibility: list[list[int]], count_weights: list[int] = []) -> list[tuple[int, int]]:
-    """Assigns keywords to resume sections to maximize compatibility.
-    The compatibility matrix has tuple keys (keyword_index, resume_section_index) and integer values.
-    Conventionally the values are 0-3 but it doesn't really matter.
-    The solution process can be described as analogous to a game.
-    You have some keywords and assigning them to resume sections yields points depending on how compatible
-    the resume section is to a keyword.
-    There are also rules:
-    - Each keyword can only be assigned to at most 1 resume section.
-    - The total number of keywords assignable to a resume section is fixed to match count_weights.
-    """
     solver = pywraplp.Solver.CreateSolver("SCIP")
-    n_resume_sections = len(compatibility)
-    n_keywords = len(compatibility[0])
+    n_resume_sections, n_keywords = compatibility.shape
     assignment = {indices: solver.IntVar(0, 1, "") for indices in product(range(n_keywords), range(n_resume_sections))}
     # Each keyword is assigned to exactly 1 resume section.
     for keyword_index in range(n_keywords):
@@ -27,27 +73,54 @@ def assign(*, compatibility: list[list[int]], count_weights: list[int] = []) ->
             == 1
         )
     # Each resume section has an exact number of keywords assigned in accordance with count_weights
-    actual_weights = [
-        count_weights[resume_section_index] if resume_section_index < len(count_weights) else 1
-        for resume_section_index in range(n_resume_sections)
-    ]
-    total_weight = sum(actual_weights)
-    n_keywords_assigned = 0
     for resume_section_index in range(n_resume_sections):
-        n_keywords_assigned_cumulative = min(
-            n_keywords, round(n_keywords / total_weight * sum(actual_weights[0 : resume_section_index + 1]))
-        )
         solver.Add(
             solver.Sum([assignment[keyword_index, resume_section_index] for keyword_index in range(n_keywords)])
-            == n_keywords_assigned_cumulative - n_keywords_assigned
+            == section_keyword_counts[resume_section_index]
         )
-        n_keywords_assigned = n_keywords_assigned_cumulative
-    assert n_keywords_assigned == n_keywords, f"Algorithm error: {n_keywords_assigned} assigned / {n_keywords} total"
     # Maximize sum of assignment * compatibility
-    solver.Maximize(solver.Sum([assignment[indices] * compatibility[indices[1]][indices[0]] for indices in assignment]))
+    solver.Maximize(
+        solver.Sum([assignment[indices] * int(compatibility[indices[1], indices[0]]) for indices in assignment])
+    )
     status = solver.Solve()
+    annotate(
+        solver_status={pywraplp.Solver.OPTIMAL: "OPTIMAL", pywraplp.Solver.FEASIBLE: "FEASIBLE"}.get(status, status)
+    )
     if status == pywraplp.Solver.OPTIMAL or status == pywraplp.Solver.FEASIBLE:
         # Allow tolerance for floating point arithmetic when getting the solution value
         return [indices for indices in assignment if assignment[indices].solution_value() > 0.5]
     else:
         raise RuntimeError("No feasible keyword - resume section assignment found.")
+
+
+@traced("assign", category="solver")
+def assign(
+    *,
+    compatibility: Union[list[list[int]], np.ndarray],
+    count_weights: list[int] = [],
+    engine: str = "min_cost_flow",
+) -> list[tuple[int, int]]:
+    """Assigns keywords to resume sections to maximize compatibility.
+    The compatibility matrix is indexed by [resume_section_index][keyword_index] and has integer values.
+    Conventionally the values are 0-3 but it doesn't really matter.
+    The solution process can be described as analogous to a game.
+    You have some keywords and assigning them to resume sections yields points depending on how compatible
+    the resume section is to a keyword.
+    There are also rules:
+    - Each keyword can only be assigned to at most 1 resume section.
+    - The total number of keywords assignable to a resume section is fixed to match count_weights.
+    This is a balanced transportation problem, which the default min_cost_flow engine solves in polynomial time.
+    The scip engine solves the same problem as a general mixed integer program.
+    Returns the (keyword_index, resume_section_index) pairs of the assignment.
+    """
+    compatibility = np.asarray(compatibility, dtype=np.int64)
+    annotate(engine=engine, n_resume_sections=compatibility.shape[0], n_keywords=compatibility.shape[1])
+    section_keyword_counts = _section_keyword_counts(
+        n_keywords=compatibility.shape[1], n_resume_sections=compatibility.shape[0], count_weights=count_weights
+    )
+    if engine == "min_cost_flow":
+        return _assign_min_cost_flow(compatibility=compatibility, section_keyword_counts=section_keyword_counts)
+    elif engine == "scip":
+        return _assign_scip(compatibility=compatibility, section_keyword_counts=section_keyword_counts)
+    else:
+        raise ValueError(f"Unknown assignment engine {engine!r}, expected one of {ENGINES}.")
@@ -0,0 +1,84 @@
+"""Routing of the stages to the LLM backends and models of a backends config, which the README describes."""
+
+import os
+from typing import Any, Iterable, Optional
+
+from .chains import (
+    STAGE_MODEL_NAMES,
+    ChatModelFactory,
+    openai_chat_model,
+    set_chat_model_factory,
+    set_stage_model_names,
+)
+
+PROVIDERS = ("openai", "fake")
+DEFAULT_BACKEND = "openai"
+
+
+def backend_chat_model_factory(backend: dict[str, Any], *, max_connections: Optional[int] = None) -> ChatModelFactory:
+    """Chat model factory of a backend of a backends config. With max_connections, the chat models of "openai"
+    backends share one OpenAI client per backend with that many connections.
+    """
+    provider = backend.get("provider", "openai")
+    if provider == "openai":
+        api_key = backend.get("api_key") or os.environ.get(backend.get("api_key_env", "OPENAI_API_KEY"))
+        if max_connections is not None:
+            from .server import pooled_openai_chat_model_factory
+
+            return pooled_openai_chat_model_factory(
+                base_url=backend.get("base_url"), api_key=api_key, max_connections=max_connections
+            )
+        client_kwargs = {
+            name: value
+            for name, value in {"openai_api_base": backend.get("base_url"), "openai_api_key": api_key}.items()
+            if value is not None
+        }
+        return lambda stage, **model_kwargs: openai_chat_model(stage, **client_kwargs, **model_kwargs)
+    if provider == "fake":
+        from .testing import fake_chat_model_factory
+
+        return fake_chat_model_factory(**{name: value for name, value in backend.items() if name != "provider"})
+    raise ValueError(f"Unknown provider {provider!r}, the providers are {list(PROVIDERS)}.")
+
+
+def parse_route(route: str) -> tuple[str, dict[str, str]]:
+    """Parse a STAGE=BACKEND:MODEL route into the stage and its route in a backends config. The model may contain
+    colons, and may be left out along with the colon to keep the stage's model.
+    """
+    stage, equals, target = route.partition("=")
+    backend, _, model = target.partition(":")
+    if not equals or not stage or not backend:
+        raise ValueError(f"Invalid route {route!r}, expected STAGE=BACKEND:MODEL.")
+    return stage, {"backend": backend, **({"model": model} if model else {})}
+
+
+def configure_backends(
+    config: Optional[dict[str, Any]] = None,
+    *,
+    routes: Iterable[str] = (),
+    default_backend: Optional[dict[str, Any]] = None,
+    max_connections: Optional[int] = None,
+) -> None:
+    """Set the chat model factory and the stage models that route each stage to its backend and model in the backends
+    config, with the STAGE=BACKEND:MODEL routes overriding those of the config. default_backend is the "openai"
+    backend unless the config defines it. See backend_chat_model_factory() for max_connections.
+    """
+    config = config or {}
+    backends = {DEFAULT_BACKEND: default_backend or {"provider": "openai"}, **config.get("backends", {})}
+    stage_routes = {**config.get("stages", {}), **dict(map(parse_route, routes))}
+    unknown_stages = set(stage_routes) - set(STAGE_MODEL_NAMES)
+    if len(unknown_stages) > 0:
+        raise ValueError(f"Unknown stages {sorted(unknown_stages)}, the stages are {list(STAGE_MODEL_NAMES)}.")
+    unknown_backends = {route.get("backend", DEFAULT_BACKEND) for route in stage_routes.values()} - set(backends)
+    if len(unknown_backends) > 0:
+        raise ValueError(f"Unknown backends {sorted(unknown_backends)}, the backends are {list(backends)}.")
+    factories = {
+        name: backend_chat_model_factory(backend, max_connections=max_connections) for name, backend in backends.items()
+    }
+
+    def factory(stage: str, **model_kwargs: Any) -> Any:
+        return factories[stage_routes.get(stage, {}).get("backend", DEFAULT_BACKEND)](stage, **model_kwargs)
+
+    # The chains ask for the routed models, so that cache keys and rate limits are those of the models that answer
+    set_stage_model_names({stage: route["model"] for stage, route in stage_routes.items() if "model" in route})
+    set_chat_model_factory(factory)
@@ -0,0 +1,389 @@
+"""Offline performance benchmarks. Run with `python -m resume_optimizer.benchmark <benchmark>`."""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Any
+
+import numpy as np
+
+from .assign import ENGINES, assign
+from .chains import set_chat_model_factory
+from .optimize import aoptimize_resume, aoptimize_resume_batch
+from .testing import DEFAULT_KEYWORDS, ChatModelStats, FakeOpenAIServer, fake_chat_model_factory
+
+# Short names of the optimize_resume stages for the benchmark table
+STAGE_COLUMNS = {
+    "keywords": "extract_ms",
+    "position_summaries": "summarize_ms",
+    "verbatim_compatibility": "verbatim_ms",
+    "difficulties": "difficulty_ms",
+    "compatibility": "compat_ms",
+    "position_keywords": "assign_ms",
+    "optimized_highlights": "insert_ms",
+}
+
+
+def benchmark_assign(
+    *,
+    keyword_counts: list[int],
+    resume_section_counts: list[int],
+    engines: tuple[str, ...] = ENGINES,
+    repeat: int = 5,
+    seed: int = 0,
+) -> list[dict]:
+    """Time assign() on random compatibility matrices for every combination of keyword and resume section counts.
+    Returns one row per combination and engine with the median solve time in milliseconds.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for n_keywords in keyword_counts:
+        for n_resume_sections in resume_section_counts:
+            compatibility = rng.integers(0, 4, size=(n_resume_sections, n_keywords))
+            for engine in engines:
+                solve_times = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    assign(compatibility=compatibility, count_weights=[3, 3, 2], engine=engine)
+                    solve_times.append(time.perf_counter() - start)
+                rows.append(
+                    {
+                        "engine": engine,
+                        "n_keywords": n_keywords,
+                        "n_resume_sections": n_resume_sections,
+                        "median_ms": 1000 * float(np.median(solve_times)),
+                    }
+                )
+    return rows
+
+
+def _benchmark_keywords(n_keywords: int) -> list[str]:
+    return (DEFAULT_KEYWORDS + [f"skill {i}" for i in range(len(DEFAULT_KEYWORDS), n_keywords)])[:n_keywords]
+
+
+def _benchmark_resume(*, n_work_entries: int, keywords: list[str]) -> dict[str, Any]:
+    # Every work entry mentions a few of the keywords verbatim
+    return {
+        "work": [
+            {
+                "position": f"Data Engineer {i + 1}",
+                "highlights": [
+                    f"Built reporting with {keywords[(3 * i + j) % len(keywords)]} for team {j + 1}" for j in range(4)
+                ],
+            }
+            for i in range(n_work_entries)
+        ]
+    }
+
+
+async def _run_jobs(*, resume: dict, jobs: list[dict], max_workers: int) -> dict[str, list[float]]:
+    """Optimize the resume for the jobs, alone if there's one, and return the wall times of each stage in seconds."""
+    stage_starts = {}
+    stage_seconds = defaultdict(list)
+
+    def record_event(event: dict[str, Any]) -> None:
+        if event["event"] == "stage_start":
+            stage_starts[event.get("job"), event["stage"]] = event["elapsed"]
+        elif event["event"] == "stage_complete":
+            stage_seconds[event["stage"]].append(event["elapsed"] - stage_starts[event.get("job"), event["stage"]])
+
+    if len(jobs) == 1:
+        await aoptimize_resume(
+            resume=resume,
+            job_description=jobs[0]["job_description"],
+            job_title=jobs[0]["job_title"],
+            tokens_per_highlight=60,
+            on_event=record_event,
+        )
+    else:
+        async for _ in aoptimize_resume_batch(
+            resume=resume, jobs=jobs, tokens_per_highlight=60, max_workers=max_workers, on_event=record_event
+        ):
+            pass
+    return stage_seconds
+
+
+def benchmark_optimize(
+    *,
+    keyword_counts: list[int],
+    work_entry_counts: list[int],
+    job_counts: list[int],
+    max_workers: int = 4,
+    seconds_per_call: float = 0.0,
+    seconds_per_token: float = 0.0,
+) -> list[dict]:
+    """Run optimize_resume with FakeChatModels for every combination of keyword, work entry and job counts.
+    Returns one row per combination with the total wall time, the mean wall time of each stage, and the call and
+    token counts of the fake chat models. With the default zero model latency, the wall times are the orchestration
+    overhead of the optimizer itself.
+    """
+    rows = []
+    try:
+        for n_keywords in keyword_counts:
+            for n_work_entries in work_entry_counts:
+                for n_jobs in job_counts:
+                    keywords = _benchmark_keywords(n_keywords)
+                    stats = ChatModelStats()
+                    set_chat_model_factory(
+                        fake_chat_model_factory(
+                            keywords=keywords,
+                            stats=stats,
+                            seconds_per_call=seconds_per_call,
+                            seconds_per_token=seconds_per_token,
+                        )
+                    )
+                    resume = _benchmark_resume(n_work_entries=n_work_entries, keywords=keywords)
+                    jobs = [
+                        {"id": str(i), "job_title": "Data Engineer", "job_description": f"Job description {i}"}
+                        for i in range(n_jobs)
+                    ]
+                    start = time.perf_counter()
+                    stage_seconds = asyncio.run(_run_jobs(resume=resume, jobs=jobs, max_workers=max_workers))
+                    wall_seconds = time.perf_counter() - start
+                    rows.append(
+                        {
+                            "n_keywords": n_keywords,
+                            "n_work_entries": n_work_entries,
+                            "n_jobs": n_jobs,
+                            "wall_ms": 1000 * wall_seconds,
+                            **{
+                                column: 1000 * float(np.mean(stage_seconds[stage])) if stage in stage_seconds else "-"
+                                for stage, column in STAGE_COLUMNS.items()
+                            },
+                            "calls": stats.calls,
+                            "prompt_tokens": stats.prompt_tokens,
+                            "completion_tokens": stats.completion_tokens,
+                        }
+                    )
+    finally:
+        set_chat_model_factory(None)
+    return rows
+
+
+# Modules that take long to import and that the CLI should only import once the arguments are parsed
+HEAVY_MODULES = ("langchain", "langchain_community", "langchain_core", "langchain_openai", "openai", "ortools")
+
+# Python code run in a fresh interpreter for each startup measurement
+STARTUP_COMMANDS = {
+    "resume-optimizer --help": "from resume_optimizer.cli import cli; sys.argv = ['resume-optimizer', '--help']; cli()",
+    "resume-optimizer-batch --help": (
+        "from resume_optimizer.cli import batch_cli; sys.argv = ['resume-optimizer-batch', '--help']; batch_cli()"
+    ),
+    "import resume_optimizer.optimize": "import resume_optimizer.optimize",
+}
+
+
+def benchmark_startup(*, repeat: int = 5) -> list[dict]:
+    """Time each of the STARTUP_COMMANDS in a fresh Python interpreter, including the interpreter startup.
+    Returns one row per command with the median wall time in milliseconds and the heavy modules it imported.
+    """
+    rows = []
+    for name, code in STARTUP_COMMANDS.items():
+        # Print the heavy modules that were imported even when the command exits, like --help does
+        script = (
+            "import atexit, sys\n"
+            f"atexit.register(lambda: print(','.join(sorted(m for m in {HEAVY_MODULES!r} if m in sys.modules)), "
+            "file=sys.stderr))\n"
+            f"{code}\n"
+        )
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+            durations.append(1000 * (time.perf_counter() - start))
+        rows.append(
+            {
+                "command": name,
+                "wall_ms": float(np.median(durations)),
+                "heavy_imports": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "-",
+            }
+        )
+    return rows
+
+
+async def _cancel_tasks() -> None:
+    """Cancel all other tasks of the running event loop and wait for them to finish."""
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def benchmark_server(
+    *, n_requests: int = 5, seconds_per_call: float = 0.0, seconds_per_token: float = 0.0
+) -> list[dict]:
+    """Compare the per-request latency of running the CLI once per job to that of sending the jobs to a warm server.
+    Both talk over HTTP to a FakeOpenAIServer, so the difference is the process, import and connection setup cost.
+    Returns one row per mode with the median and total latency in milliseconds.
+    """
+    import httpx
+
+    from .cache import StageCache, set_stage_cache
+    from .server import OptimizerServer, pooled_openai_chat_model_factory
+
+    # The servers run in a background event loop, so that the CLI subprocesses and the HTTP client can block
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    fake_openai = asyncio.run_coroutine_threadsafe(
+        FakeOpenAIServer(seconds_per_call=seconds_per_call, seconds_per_token=seconds_per_token).start(), loop
+    ).result()
+    base_url = f"http://127.0.0.1:{fake_openai.sockets[0].getsockname()[1]}/v1"
+    resume = _benchmark_resume(n_work_entries=3, keywords=DEFAULT_KEYWORDS)
+    # The CLI runs in the temporary directory so that its LLM cache starts empty, which needs the package to be
+    # importable from there even when it isn't installed
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        resume_file = os.path.join(directory, "resume.json")
+        with open(resume_file, "w") as f:
+            json.dump(resume, f)
+
+        cli_durations = []
+        for i in range(n_requests):
+            job_description_file = os.path.join(directory, f"job-{i}.txt")
+            with open(job_description_file, "w") as f:
+                f.write(f"Benchmark job description {i}")
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, "-c", "from resume_optimizer.cli import cli; cli()"]
+                + [
+                    "-r",
+                    resume_file,
+                    "-j",
+                    job_description_file,
+                    "-t",
+                    "Data Engineer",
+                    "-o",
+                    f"{directory}/cli-{i}.json",
+                ]
+                + ["--stage-cache-file", os.path.join(directory, "cli.db")],
+                cwd=directory,
+                env={
+                    **os.environ,
+                    "PYTHONPATH": package_root,
+                    "OPENAI_API_BASE": base_url,
+                    "OPENAI_API_KEY": "benchmark",
+                },
+                check=True,
+                capture_output=True,
+            )
+            cli_durations.append(1000 * (time.perf_counter() - start))
+        rows.append({"mode": "cli", "median_ms": float(np.median(cli_durations)), "total_ms": sum(cli_durations)})
+
+        set_chat_model_factory(pooled_openai_chat_model_factory(base_url=base_url))
+        set_stage_cache(StageCache(os.path.join(directory, "server.db")))
+        optimizer_server = OptimizerServer()
+        socket_path = os.path.join(directory, "server.sock")
+        asyncio.run_coroutine_threadsafe(optimizer_server.serve(unix_socket=socket_path), loop)
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        try:
+            server_durations = []
+            with httpx.Client(transport=httpx.HTTPTransport(uds=socket_path), timeout=None) as client:
+                for i in range(n_requests):
+                    start = time.perf_counter()
+                    response = client.post(
+                        "http://server/optimize",
+                        json={
+                            "resume": resume,
+                            "job_title": "Data Engineer",
+                            "job_description": f"Benchmark job description {i}",
+                        },
+                    )
+                    response.raise_for_status()
+                    server_durations.append(1000 * (time.perf_counter() - start))
+            rows.append(
+                {"mode": "server", "median_ms": float(np.median(server_durations)), "total_ms": sum(server_durations)}
+            )
+        finally:
+            set_chat_model_factory(None)
+            set_stage_cache(None)
+            asyncio.run_coroutine_threadsafe(_cancel_tasks(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+    return rows
+
+
+def _print_table(rows: list[dict]) -> None:
+    columns = list(rows[0].keys())
+    cells = [
+        [f"{row[column]:.2f}" if isinstance(row[column], float) else str(row[column]) for column in columns]
+        for row in rows
+    ]
+    widths = [max(len(column), *(len(row_cells[i]) for row_cells in cells)) for i, column in enumerate(columns)]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row_cells in cells:
+        print("  ".join(cell.rjust(width) for cell, width in zip(row_cells, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    assign_parser = subparsers.add_parser("assign", help="Keyword - resume section assignment solve time")
+    assign_parser.add_argument("--keyword-counts", type=int, nargs="+", default=[10, 30, 100, 300, 1000])
+    assign_parser.add_argument("--resume-section-counts", type=int, nargs="+", default=[3, 5, 10, 20])
+    assign_parser.add_argument("--engines", nargs="+", choices=ENGINES, default=list(ENGINES))
+    assign_parser.add_argument("--repeat", type=int, default=5)
+    optimize_parser = subparsers.add_parser(
+        "optimize", help="Per-stage wall time and call and token counts of optimize_resume with fake chat models"
+    )
+    optimize_parser.add_argument("--keyword-counts", type=int, nargs="+", default=[10, 30, 100])
+    optimize_parser.add_argument("--work-entry-counts", type=int, nargs="+", default=[3, 10])
+    optimize_parser.add_argument("--job-counts", type=int, nargs="+", default=[1, 10])
+    optimize_parser.add_argument("--workers", type=int, default=4)
+    optimize_parser.add_argument("--seconds-per-call", type=float, default=0.0, help="Simulated latency per call")
+    optimize_parser.add_argument("--seconds-per-token", type=float, default=0.0, help="Simulated latency per token")
+    startup_parser = subparsers.add_parser(
+        "startup", help="Wall time and heavy imports of starting the CLI in a fresh interpreter"
+    )
+    startup_parser.add_argument("--repeat", type=int, default=5)
+    server_parser = subparsers.add_parser(
+        "server", help="Per-request latency of running the CLI per job versus sending the jobs to a warm server"
+    )
+    server_parser.add_argument("--requests", type=int, default=5)
+    server_parser.add_argument("--seconds-per-call", type=float, default=0.0, help="Simulated latency per call")
+    server_parser.add_argument("--seconds-per-token", type=float, default=0.0, help="Simulated latency per token")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.ERROR)
+
+    if args.benchmark == "assign":
+        _print_table(
+            benchmark_assign(
+                keyword_counts=args.keyword_counts,
+                resume_section_counts=args.resume_section_counts,
+                engines=tuple(args.engines),
+                repeat=args.repeat,
+            )
+        )
+    elif args.benchmark == "optimize":
+        _print_table(
+            benchmark_optimize(
+                keyword_counts=args.keyword_counts,
+                work_entry_counts=args.work_entry_counts,
+                job_counts=args.job_counts,
+                max_workers=args.workers,
+                seconds_per_call=args.seconds_per_call,
+                seconds_per_token=args.seconds_per_token,
+            )
+        )
+    elif args.benchmark == "startup":
+        _print_table(benchmark_startup(repeat=args.repeat))
+    elif args.benchmark == "server":
+        _print_table(
+            benchmark_server(
+                n_requests=args.requests,
+                seconds_per_call=args.seconds_per_call,
+                seconds_per_token=args.seconds_per_token,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
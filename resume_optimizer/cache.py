@@ -0,0 +1,133 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from typing import Optional
+
+from .match import tokenize
+
+
+def normalize_keyword(keyword: str) -> str:
+    """Normalize a keyword so that differently cased or pluralized spellings share the same cache entries."""
+    return " ".join(tokenize(keyword)) or keyword.strip().casefold()
+
+
+def section_hash(position: str, highlights: str) -> str:
+    """Content hash of a (position, highlights) resume section."""
+    return hashlib.sha256(f"{position}\n{highlights}".encode()).hexdigest()
+
+
+def job_hash(job_title: str, job_description: str) -> str:
+    """Content hash of a job, which identifies the incremental optimization manifest of the job."""
+    return hashlib.sha256(f"{job_title}\n{job_description}".encode()).hexdigest()
+
+
+class StageCache:
+    """SQLite cache of the individual values the LLM stages produce, as opposed to whole responses to whole prompts.
+    - Compatibility per (normalized keyword, resume section content hash, model)
+    - Difficulty per (normalized keyword, job title, model)
+    - Summary per (resume section content hash, model)
+    - Incremental optimization manifest per job content hash
+    This way a new keyword only costs an LLM call for the new keyword rather than for all keywords.
+    """
+
+    def __init__(self, database_path: str = ".resume_optimizer.db") -> None:
+        self.database_path = database_path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(database_path, timeout=60, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS compatibility (
+                    keyword TEXT, section_hash TEXT, model TEXT, value INTEGER,
+                    PRIMARY KEY (keyword, section_hash, model)
+                );
+                CREATE TABLE IF NOT EXISTS difficulty (
+                    keyword TEXT, job_title TEXT, model TEXT, value INTEGER,
+                    PRIMARY KEY (keyword, job_title, model)
+                );
+                CREATE TABLE IF NOT EXISTS summary (
+                    section_hash TEXT, model TEXT, value TEXT,
+                    PRIMARY KEY (section_hash, model)
+                );
+                CREATE TABLE IF NOT EXISTS manifest (
+                    job_hash TEXT PRIMARY KEY, value TEXT
+                );
+                """
+            )
+
+    def _select(self, query: str, parameters: list[tuple]) -> dict:
+        with self._lock:
+            return {
+                parameter[0]: row[0]
+                for parameter in parameters
+                for row in self._connection.execute(query, parameter).fetchall()
+            }
+
+    def _insert(self, query: str, rows: list[tuple]) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany(query, rows)
+
+    def get_compatibilities(self, *, keywords: list[str], section_hash: str, model: str) -> dict[str, int]:
+        """Return the cached compatibilities of the keywords that have them, by normalized keyword."""
+        return self._select(
+            "SELECT value FROM compatibility WHERE keyword = ? AND section_hash = ? AND model = ?",
+            [(normalize_keyword(keyword), section_hash, model) for keyword in keywords],
+        )
+
+    def set_compatibilities(self, *, compatibilities: dict[str, int], section_hash: str, model: str) -> None:
+        self._insert(
+            "INSERT OR REPLACE INTO compatibility VALUES (?, ?, ?, ?)",
+            [(normalize_keyword(keyword), section_hash, model, value) for keyword, value in compatibilities.items()],
+        )
+
+    def get_difficulties(self, *, keywords: list[str], job_title: str, model: str) -> dict[str, int]:
+        """Return the cached difficulties of the keywords that have them, by normalized keyword."""
+        return self._select(
+            "SELECT value FROM difficulty WHERE keyword = ? AND job_title = ? AND model = ?",
+            [(normalize_keyword(keyword), job_title.strip().casefold(), model) for keyword in keywords],
+        )
+
+    def set_difficulties(self, *, difficulties: dict[str, int], job_title: str, model: str) -> None:
+        self._insert(
+            "INSERT OR REPLACE INTO difficulty VALUES (?, ?, ?, ?)",
+            [
+                (normalize_keyword(keyword), job_title.strip().casefold(), model, value)
+                for keyword, value in difficulties.items()
+            ],
+        )
+
+    def get_summaries(self, *, section_hashes: list[str], model: str) -> dict[str, str]:
+        """Return the cached summaries of the resume sections that have them, by resume section content hash."""
+        return self._select(
+            "SELECT value FROM summary WHERE section_hash = ? AND model = ?",
+            [(section_hash, model) for section_hash in section_hashes],
+        )
+
+    def set_summaries(self, *, summaries: dict[str, str], model: str) -> None:
+        self._insert(
+            "INSERT OR REPLACE INTO summary VALUES (?, ?, ?)",
+            [(section_hash, model, value) for section_hash, value in summaries.items()],
+        )
+
+    def get_manifest(self, *, job_hash: str) -> Optional[dict]:
+        """Return the manifest of the previous optimization for the job, if any."""
+        manifest = self._select("SELECT value FROM manifest WHERE job_hash = ?", [(job_hash,)]).get(job_hash)
+        return json.loads(manifest) if manifest is not None else None
+
+    def set_manifest(self, *, job_hash: str, manifest: dict) -> None:
+        self._insert("INSERT OR REPLACE INTO manifest VALUES (?, ?)", [(job_hash, json.dumps(manifest))])
+
+
+_stage_cache: Optional[StageCache] = None
+
+
+def set_stage_cache(stage_cache: Optional[StageCache]) -> None:
+    """Set the stage cache used by the chains, or disable stage caching with None."""
+    global _stage_cache
+    _stage_cache = stage_cache
+
+
+def get_stage_cache() -> Optional[StageCache]:
+    return _stage_cache
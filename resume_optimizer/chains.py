@@ -1,23 +1,170 @@
+import asyncio
+import functools
+import json
 import logging
+import re
 from textwrap import dedent
+from typing import Any, Awaitable, Callable, Optional
+from uuid import UUID
 
-from langchain_core.messages import SystemMessage
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.outputs import LLMResult
 from langchain_core.output_parsers import MarkdownListOutputParser, NumberedListOutputParser, StrOutputParser
 from langchain_core.prompts.chat import (
+    AIMessagePromptTemplate,
     HumanMessagePromptTemplate,
     SystemMessagePromptTemplate,
 )
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
+from langchain_core.runnables import Runnable, RunnableSequence
+
+from .cache import get_stage_cache, normalize_keyword, section_hash
+from .keywords import get_keyword_store
+from .preprocess import get_job_description_preprocessor
+from .scheduler import estimate_tokens, get_scheduler
+from .trace import Span, Tracer, annotate, context_attributes, get_tracer, traced
 
 OPENAI_REPRODUCIBILITY_SEED = 338598
 
-EXTRACT_KEYWORDS_CHAIN = (
-    ChatPromptTemplate.from_messages(
-        [
-            SystemMessage(
-                content=dedent(
-                    """\
+# Default model of the chain of each stage
+STAGE_MODEL_NAMES = {
+    "extract_keywords": "gpt-4",
+    "summarize_resume_sections": "gpt-4",
+    "get_difficulties": "gpt-4",
+    "get_compatibility": "gpt-3.5-turbo",
+    "insert_keywords": "gpt-4",
+}
+# Most tokens of a resume section summary
+SUMMARY_MAX_TOKENS = 300
+
+# Creates the chat model of a chain from the stage name and the ChatOpenAI keyword arguments of the stage
+ChatModelFactory = Callable[..., BaseChatModel]
+
+
+def openai_chat_model(stage: str, **model_kwargs: Any) -> BaseChatModel:
+    """The default chat model factory."""
+    # Imported on first use, since the OpenAI client takes a while to import
+    from langchain_openai import ChatOpenAI
+
+    # Retries are up to the scheduler, which knows about the rate limits of all requests
+    return ChatOpenAI(**{"max_retries": 0, **model_kwargs})
+
+
+_chat_model_factory: ChatModelFactory = openai_chat_model
+_chat_models: dict[str, BaseChatModel] = {}
+
+
+_stage_model_names: dict[str, str] = {}
+
+
+def set_stage_model_names(stage_model_names: Optional[dict[str, str]]) -> None:
+    """Set the models of the chains of some stages instead of those in STAGE_MODEL_NAMES. None restores the defaults."""
+    unknown_stages = set(stage_model_names or {}) - set(STAGE_MODEL_NAMES)
+    if len(unknown_stages) > 0:
+        raise ValueError(f"Unknown stages {sorted(unknown_stages)}, the stages are {list(STAGE_MODEL_NAMES)}.")
+    global _stage_model_names
+    _stage_model_names = dict(stage_model_names or {})
+
+
+def stage_model_name(stage: str) -> str:
+    return _stage_model_names.get(stage, STAGE_MODEL_NAMES[stage])
+
+
+def set_chat_model_factory(chat_model_factory: Optional[ChatModelFactory]) -> None:
+    """Set the function that creates the chat models of the chains, e.g. to use a stand-in for OpenAI.
+    None restores the default OpenAI chat models.
+    """
+    global _chat_model_factory
+    _chat_model_factory = chat_model_factory or openai_chat_model
+    _chat_models.clear()
+
+
+def chat_model(stage: str, **model_kwargs: Any) -> BaseChatModel:
+    """Return the chat model for the stage and model keyword arguments, creating it on first use."""
+    key = json.dumps([stage, model_kwargs], sort_keys=True)
+    if key not in _chat_models:
+        _chat_models[key] = _chat_model_factory(stage, **model_kwargs)
+    return _chat_models[key]
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Records a span for each chat model call, with its token usage, retries, and whether the LLM cache was hit."""
+
+    # Run in the event loop rather than in an executor, so that the span start times are accurate
+    run_inline = True
+
+    def __init__(self, tracer: Tracer) -> None:
+        self.tracer = tracer
+        self._runs: dict[UUID, tuple[float, dict[str, Any]]] = {}
+
+    def on_chat_model_start(
+        self, serialized: dict[str, Any], messages: list, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs
+    ) -> None:
+        invocation_params = kwargs.get("invocation_params") or {}
+        self._runs[run_id] = (
+            self.tracer.now(),
+            {
+                **context_attributes(),
+                **(metadata or {}),
+                "model": invocation_params.get("model_name") or invocation_params.get("model"),
+                "retries": 0,
+            },
+        )
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs) -> None:
+        if run_id in self._runs:
+            self._runs[run_id][1]["streamed_tokens"] = self._runs[run_id][1].get("streamed_tokens", 0) + 1
+
+    def on_retry(self, retry_state: Any, *, run_id: UUID, **kwargs) -> None:
+        if run_id in self._runs:
+            self._runs[run_id][1]["retries"] += 1
+
+    def _end(self, run_id: UUID, **attributes: Any) -> None:
+        if run_id not in self._runs:
+            return
+        start, run_attributes = self._runs.pop(run_id)
+        self.tracer.record(
+            Span(
+                name=run_attributes.get("stage", "chat_model"),
+                category="llm",
+                start=start,
+                duration=self.tracer.now() - start,
+                attributes={**run_attributes, **attributes},
+            )
+        )
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs) -> None:
+        # Responses served from the LLM cache have no provider output. Streamed responses don't either, but they aren't
+        # cached and report their tokens one by one instead.
+        token_usage = (response.llm_output or {}).get("token_usage", {})
+        streamed = run_id in self._runs and "streamed_tokens" in self._runs[run_id][1]
+        self._end(
+            run_id,
+            llm_cache_hit=response.llm_output is None and not streamed,
+            prompt_tokens=token_usage.get("prompt_tokens"),
+            completion_tokens=token_usage.get("completion_tokens"),
+        )
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs) -> None:
+        self._end(run_id, error=repr(error))
+
+
+def run_config(stage: str) -> dict[str, Any]:
+    """Runnable config that traces the chat model calls of the stage with the current tracer, if any."""
+    tracer = get_tracer()
+    return {
+        "metadata": {"stage": stage},
+        "callbacks": [TracingCallbackHandler(tracer)] if tracer is not None else [],
+    }
+
+
+EXTRACT_KEYWORDS_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        SystemMessage(
+            content=dedent(
+                """\
                     Background:
                     You are an expert ATS (applicant tracking system) keyword extractor.
 
@@ -59,39 +206,128 @@ EXTRACT_KEYWORDS_CHAIN = (
                     2. Keyword 2
                     3. Keyword 3
                     """
-                )
-            ),
-            HumanMessagePromptTemplate.from_template(
-                template=dedent(
-                    """\
+            )
+        ),
+        HumanMessagePromptTemplate.from_template(
+            template=dedent(
+                """\
                     Job Title: {job_title}
                     Job Description:
                     {job_description}
                     """
-                )
-            ),
-        ]
-    )
-    | ChatOpenAI(model_name="gpt-4")
-    | NumberedListOutputParser()
+            )
+        ),
+    ]
 )
 
 
+async def _scheduled(
+    chain: RunnableSequence,
+    inputs: dict[str, Any],
+    *,
+    stage: str,
+    request: Optional[Callable[[], Awaitable[Any]]] = None,
+) -> Any:
+    """Invoke the chain with the inputs through the scheduler, or run a custom request of the chain instead.
+    The request is estimated to use the tokens of the prompt and up to max_tokens completion tokens.
+    """
+    model = next(step for step in chain.steps if isinstance(step, BaseChatModel))
+    return await get_scheduler().run(
+        request or (lambda: chain.ainvoke(inputs, config=run_config(stage))),
+        stage=stage,
+        model=model.model_name,
+        estimated_tokens=estimate_tokens(chain.first.format(**inputs)) + (getattr(model, "max_tokens", None) or 0),
+    )
+
+
+# Number of keywords that streamed keyword extraction passes on at a time
+KEYWORD_BATCH_SIZE = 10
+
+
+def _extract_keywords_chain() -> Runnable:
+    return (
+        EXTRACT_KEYWORDS_PROMPT
+        | chat_model("extract_keywords", model_name=stage_model_name("extract_keywords"))
+        | NumberedListOutputParser()
+    )
+
+
 def extract_keywords(
     *,
     job_description: str,
     job_title: str,
 ) -> list[str]:
     """Extract ATS keywords from the job description and distribute them among resume positions."""
-    return EXTRACT_KEYWORDS_CHAIN.invoke(
-        {
-            "job_description": job_description,
-            "job_title": job_title,
-        }
-    )
+    return asyncio.run(aextract_keywords(job_description=job_description, job_title=job_title))
 
 
-KEYWORD_DIFFICULTY_CHAIN = ChatPromptTemplate.from_messages(
+@traced("extract_keywords", category="chain")
+async def aextract_keywords(
+    *,
+    job_description: str,
+    job_title: str,
+    on_keywords: Optional[Callable[[list[str]], None]] = None,
+) -> list[str]:
+    """Async version of extract_keywords.
+    With a job description preprocessor, the keywords are extracted from the preprocessed job description.
+    With a keyword store, aliases of earlier keywords like the "K8s" after "Kubernetes" are dropped.
+    If on_keywords is given, the response is streamed and on_keywords is called with each batch of
+    KEYWORD_BATCH_SIZE new keywords as soon as they're generated, and with the remaining ones at the end. The
+    keywords are passed with the spellings they'll have in the returned list, and a retried response only passes on
+    the keywords that weren't passed on yet.
+    """
+    preprocessor = get_job_description_preprocessor()
+    if preprocessor is not None:
+        preprocessed = preprocessor.preprocess(job_description, model=stage_model_name("extract_keywords"))
+        logging.info(
+            f"Preprocessing the job description saved {preprocessed.tokens_saved} of {preprocessed.tokens_before} "
+            f"tokens, dropping {preprocessed.duplicate_lines} duplicate lines, {preprocessed.boilerplate_lines} "
+            f"boilerplate lines and {preprocessed.boilerplate_sentences} boilerplate sentences"
+        )
+        annotate(preprocessing_tokens_saved=preprocessed.tokens_saved)
+        job_description = preprocessed.text
+    chain = _extract_keywords_chain()
+    inputs = {
+        "job_description": job_description,
+        "job_title": job_title,
+    }
+    keyword_store = get_keyword_store()
+    if on_keywords is None:
+        keywords = await _scheduled(chain, inputs, stage="extract_keywords")
+    else:
+        passed_on_keywords = set()
+        batch = []
+
+        def pass_on(keyword: str) -> None:
+            key = (
+                keyword_store.canonical_keys([keyword])[0] if keyword_store is not None else normalize_keyword(keyword)
+            )
+            if key not in passed_on_keywords:
+                passed_on_keywords.add(key)
+                batch.append(keyword)
+
+        async def stream() -> list[str]:
+            keywords = []
+            async for chunk in chain.astream(inputs, config=run_config("extract_keywords")):
+                keywords += chunk
+                for keyword in chunk:
+                    pass_on(keyword)
+                if len(batch) >= KEYWORD_BATCH_SIZE:
+                    on_keywords(batch[:])
+                    batch.clear()
+            return keywords
+
+        keywords = await _scheduled(chain, inputs, stage="extract_keywords", request=stream)
+        if len(batch) > 0:
+            on_keywords(batch[:])
+    if keyword_store is not None:
+        unique_keywords = keyword_store.deduplicate(keywords)
+        annotate(merged_keywords=len(keywords) - len(unique_keywords))
+        return unique_keywords
+    return keywords
+
+
+KEYWORD_DIFFICULTY_PROMPT = ChatPromptTemplate.from_messages(
     [
         SystemMessage(
             content=dedent(
@@ -137,40 +373,184 @@ KEYWORD_DIFFICULTY_CHAIN = ChatPromptTemplate.from_messages(
             template="Output the difficulty values for all {n_keywords} keywords in a numbered list, no other text."
         ),
     ]
-) | ChatOpenAI(
-    temperature=0,
-    model_kwargs={"seed": OPENAI_REPRODUCIBILITY_SEED},
-    model_name="gpt-4",
 )
 
 
+def _keyword_difficulty_chain() -> Runnable:
+    return KEYWORD_DIFFICULTY_PROMPT | chat_model(
+        "get_difficulties",
+        temperature=0,
+        model_kwargs={"seed": OPENAI_REPRODUCIBILITY_SEED},
+        model_name=stage_model_name("get_difficulties"),
+    )
+
+
+def _chat_model_name(chain: RunnableSequence) -> str:
+    """Name of the chat model in the chain, which is part of the stage cache keys."""
+    return next(step.model_name for step in chain.steps if isinstance(step, BaseChatModel))
+
+
+def _numbered_list(items: list[str]) -> str:
+    return "\n".join(f"{i}. {item}" for i, item in enumerate(items, start=1))
+
+
+# Row of a numbered list of scores, like "12. 1", tolerating other separators like "12) 1" or "12: 1"
+NUMBERED_SCORE_PATTERN = re.compile(r"\s*(\d+)\s*[.):-]\s*(\d+)\s*")
+# Times the values missing from malformed responses are requested again before giving up
+MAX_PARSE_RETRIES = 2
+
+
+def _parse_numbered_scores(rows: list[str], *, keywords: dict[str, str], values: range) -> dict[str, int]:
+    """Parse the scores of the numbered keywords out of the rows of a numbered list, by normalized keyword.
+    Malformed rows, unknown numbers, repeated numbers, and values out of range are skipped, so that only the keywords
+    without a valid score have to be requested again.
+    """
+    numbered_keywords = dict(enumerate(keywords, start=1))
+    scores = {}
+    for row in rows:
+        match = NUMBERED_SCORE_PATTERN.fullmatch(row)
+        if match is None or int(match.group(1)) not in numbered_keywords or int(match.group(2)) not in values:
+            if row.strip():
+                logging.debug(f"Skipping malformed score row {row!r}")
+            continue
+        scores.setdefault(numbered_keywords[int(match.group(1))], int(match.group(2)))
+    return scores
+
+
+def _retry_chain(chain: RunnableSequence, attempt: int) -> RunnableSequence:
+    """The chain for the attempt-th retry after a malformed response, with a reminder of the output format appended to
+    the prompt. The reminder also keeps the retry from getting the malformed response from the LLM cache again.
+    """
+    if attempt == 0:
+        return chain
+    reminder = SystemMessage(
+        content=f"Retry {attempt}: The previous response had malformed or missing rows. Output exactly one row like "
+        '"1. 2" with the number of the keyword and its value for each keyword, no other text.'
+    )
+    return RunnableSequence(chain.first + reminder, *chain.steps[1:])
+
+
+async def _rerequest_missing_scores(
+    scores: dict[str, int],
+    keywords: dict[str, str],
+    request: Callable[[dict[str, str], int], Awaitable[dict[str, int]]],
+    *,
+    stage: str,
+) -> dict[str, int]:
+    """Request the scores of the keywords missing from the scores again, up to MAX_PARSE_RETRIES times.
+    The request is called with the missing keywords and the number of the retry.
+    """
+    for attempt in range(1, MAX_PARSE_RETRIES + 1):
+        missing_keywords = {keyword: spelling for keyword, spelling in keywords.items() if keyword not in scores}
+        if len(missing_keywords) == 0:
+            break
+        logging.warning(
+            f"Requesting the {stage} values of {len(missing_keywords)} keywords again after a malformed response"
+        )
+        scores.update(await request(missing_keywords, attempt))
+    return scores
+
+
+def _check_scores(scores: dict[str, int], keywords: dict[str, str], *, stage: str) -> None:
+    missing_spellings = [spelling for keyword, spelling in keywords.items() if keyword not in scores]
+    if len(missing_spellings) > 0:
+        raise ValueError(
+            f"The LLM didn't return valid {stage} values for {missing_spellings} after {MAX_PARSE_RETRIES} retries."
+        )
+
+
+def _missing_keywords(keywords: list[str], cached_values: dict[str, Any]) -> dict[str, str]:
+    """Map the normalized keywords that aren't cached yet to the first spelling of each."""
+    missing_keywords = {}
+    for keyword in keywords:
+        if normalize_keyword(keyword) not in cached_values:
+            missing_keywords.setdefault(normalize_keyword(keyword), keyword)
+    return missing_keywords
+
+
 def get_difficulties(
     *,
     job_description_keywords: list[str],
     job_title: str,
 ) -> list[int]:
-    """Compute a compatibility matrix between job description keywords and (position, highlights) resume section tuples."""
-    raw_difficulties = KEYWORD_DIFFICULTY_CHAIN.invoke(
-        {
-            "job_title": job_title,
-            "numbered_job_description_keywords": "\n".join(
-                f"{i}. {k}" for i, k in enumerate(job_description_keywords, start=1)
-            ),
-            "n_keywords": len(job_description_keywords),
-        }
+    """Estimate how difficult each job description keyword would be to learn for a professional with the job title."""
+    return asyncio.run(aget_difficulties(job_description_keywords=job_description_keywords, job_title=job_title))
+
+
+@traced("get_difficulties", category="chain")
+async def aget_difficulties(
+    *,
+    job_description_keywords: list[str],
+    job_title: str,
+) -> list[int]:
+    """Async version of get_difficulties.
+    Only the keywords without a difficulty in the keyword store (for the job title family) or the stage cache (for the
+    job title) are sent to the LLM.
+    """
+    stage_cache = get_stage_cache()
+    keyword_store = get_keyword_store()
+    chain = _keyword_difficulty_chain()
+    model = _chat_model_name(chain)
+    difficulties = (
+        keyword_store.get_difficulties(keywords=job_description_keywords, job_title=job_title, model=model)
+        if keyword_store is not None
+        else {}
     )
-    logging.debug(f"{raw_difficulties=}")
-    dict_difficulties = {
-        int(pair[0]): int(pair[1]) for pair in [row.split(". ") for row in raw_difficulties.content.split("\n")]
-    }
-    logging.debug(f"{dict_difficulties=}")
-    expected_score_keys = list(range(1, len(job_description_keywords) + 1))
-    score_keys = list(dict_difficulties.keys())
-    assert score_keys == expected_score_keys, f"Numbering mismatch: {expected_score_keys=}, {score_keys=}"
-    return list(dict_difficulties.values())
+    keyword_store_hits = len(difficulties)
+    if stage_cache is not None:
+        difficulties.update(
+            stage_cache.get_difficulties(
+                keywords=list(_missing_keywords(job_description_keywords, difficulties).values()),
+                job_title=job_title,
+                model=model,
+            )
+        )
+    missing_keywords = _missing_keywords(job_description_keywords, difficulties)
+    logging.debug(
+        f"Difficulty keyword store hits: {keyword_store_hits}, cache hits: {len(difficulties) - keyword_store_hits}, "
+        f"misses: {len(missing_keywords)}"
+    )
+    annotate(
+        keyword_store_hits=keyword_store_hits,
+        stage_cache_hits=len(difficulties) - keyword_store_hits,
+        stage_cache_misses=len(missing_keywords),
+    )
+    if len(missing_keywords) > 0:
+
+        async def request_difficulties(keywords: dict[str, str], attempt: int = 0) -> dict[str, int]:
+            raw_difficulties = await _scheduled(
+                _retry_chain(chain, attempt),
+                {
+                    "job_title": job_title,
+                    "numbered_job_description_keywords": _numbered_list(list(keywords.values())),
+                    "n_keywords": len(keywords),
+                },
+                stage="get_difficulties",
+            )
+            logging.debug(f"{raw_difficulties=}")
+            return _parse_numbered_scores(raw_difficulties.content.split("\n"), keywords=keywords, values=range(1, 4))
+
+        new_difficulties = await _rerequest_missing_scores(
+            await request_difficulties(missing_keywords),
+            missing_keywords,
+            request_difficulties,
+            stage="get_difficulties",
+        )
+        # Cache the valid difficulties even if some are still missing, so that a rerun only requests those
+        if stage_cache is not None:
+            stage_cache.set_difficulties(difficulties=new_difficulties, job_title=job_title, model=model)
+        if keyword_store is not None:
+            keyword_store.set_difficulties(
+                difficulties={missing_keywords[keyword]: value for keyword, value in new_difficulties.items()},
+                job_title=job_title,
+                model=model,
+            )
+        difficulties.update(new_difficulties)
+        _check_scores(new_difficulties, missing_keywords, stage="get_difficulties")
+    return [difficulties[normalize_keyword(keyword)] for keyword in job_description_keywords]
 
 
-KEYWORD_COMPATIBILITY_CHAIN = ChatPromptTemplate.from_messages(
+KEYWORD_COMPATIBILITY_PROMPT = ChatPromptTemplate.from_messages(
     [
         SystemMessagePromptTemplate.from_template(
             # Note literal '{' and '}' need to be doubled up in an f-string.
@@ -212,50 +592,297 @@ KEYWORD_COMPATIBILITY_CHAIN = ChatPromptTemplate.from_messages(
             template="Output the compatibility values for all {n_keywords} keywords in a numbered list, no other text."
         ),
     ]
-) | ChatOpenAI(
-    temperature=0,
-    model_kwargs={"seed": OPENAI_REPRODUCIBILITY_SEED},
-    model_name="gpt-3.5-turbo",
-    # model_name="gpt-4",
 )
 
 
+PACKED_KEYWORD_COMPATIBILITY_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        SystemMessagePromptTemplate.from_template(
+            template=dedent(
+                """\
+                    Objective: Estimate how compatible each of several numbered resume sections is to a list of
+                    keywords.
+
+                    Compatibility values are numbers ranging from 0 to 2:
+                    - 0: There is no indication that the keyword could apply to the resume section.
+                    - 1: There is some indication that the keyword could apply to the resume section.
+                    - 2: The keyword definitely applies to the resume section.
+
+                    For each resume section in order, output its header line followed by the compatibilities of the
+                    keywords with that section in a numbered list in sequential order and matching the corresponding
+                    keyword numbers.
+
+                    Example:
+                    Section 1:
+                    1. 0
+                    2. 2
+                    3. 1
+                    ...
+                    Section 2:
+                    1. 1
+                    2. 0
+                    3. 2
+                    ...
+
+                    Output the compatibility values for all {n_keywords} keywords for each of the {n_sections} resume
+                    sections, no other text.
+
+                    """
+            ),
+        ),
+        HumanMessagePromptTemplate.from_template(
+            template=dedent(
+                """\
+                    Resume sections to estimate compatibility for:
+                    {resume_sections}
+                    Job description keywords to estimate compatibility for:
+                    {numbered_job_description_keywords}
+                    """
+            ),
+        ),
+        SystemMessagePromptTemplate.from_template(
+            template="Output the compatibility values for all {n_keywords} keywords for each of the {n_sections} "
+            "resume sections, no other text."
+        ),
+    ]
+)
+
+# Most compatibility values to ask for in a single request. Longer numbered outputs get slower and more likely to skip
+# or repeat numbers, so longer keyword lists are split into chunks that are requested in parallel.
+MAX_SCORES_PER_REQUEST = 60
+# Most estimated tokens of resume sections to pack into a single request
+MAX_PACKED_SECTION_TOKENS = 1500
+
+
+def _resume_section(position: str, highlights: str) -> str:
+    return f"Job title: {position}\nHighlights:\n{highlights}"
+
+
+def _compatibility_inputs(
+    section_indices: list[int], keywords: dict[str, str], position_highlights: list[tuple[str, str]]
+) -> dict[str, Any]:
+    """Inputs of the compatibility prompt for one section, or of the packed one for several sections."""
+    if len(section_indices) == 1:
+        return {
+            "numbered_job_description_keywords": _numbered_list(list(keywords.values())),
+            "resume_section": _resume_section(*position_highlights[section_indices[0]]),
+            "n_keywords": len(keywords),
+        }
+    return {
+        "numbered_job_description_keywords": _numbered_list(list(keywords.values())),
+        "resume_sections": "\n".join(
+            f"Section {j}:\n{_resume_section(*position_highlights[i])}" for j, i in enumerate(section_indices, start=1)
+        ),
+        "n_keywords": len(keywords),
+        "n_sections": len(section_indices),
+    }
+
+
+def _compatibility_request_tokens(section_tokens: list[int], keywords: dict[str, str]) -> int:
+    """Estimated prompt and completion tokens of a compatibility request, besides the instructions."""
+    keyword_tokens = sum(estimate_tokens(f"1. {keyword}") for keyword in keywords.values())
+    # Each value is a line like "12. 1"
+    return sum(section_tokens) + keyword_tokens + len(section_tokens) * len(keywords) * estimate_tokens("12. 1\n")
+
+
+def _pack_compatibility_requests(
+    missing_keywords: list[dict[str, str]], position_highlights: list[tuple[str, str]]
+) -> list[tuple[list[int], dict[str, str]]]:
+    """Plan the compatibility requests as (resume section indices, keywords) pairs covering all missing
+    (keyword, resume section) cells, with the keywords mapping normalized keywords to their spelling.
+    Keyword lists longer than MAX_SCORES_PER_REQUEST are split into even chunks. Sections are packed into one request
+    for the union of their missing keywords while the values asked for stay within MAX_SCORES_PER_REQUEST, the sections
+    within MAX_PACKED_SECTION_TOKENS, and the estimated tokens of the packed request are fewer than those of separate
+    requests, which each repeat the instructions.
+    """
+    instruction_tokens = estimate_tokens(
+        KEYWORD_COMPATIBILITY_PROMPT.format(resume_section="", numbered_job_description_keywords="", n_keywords=0)
+    )
+    requests: list[tuple[list[int], dict[str, str]]] = []
+    packed_indices: list[int] = []
+    packed_keywords: dict[str, str] = {}
+    packed_tokens: list[int] = []
+    for i, section_keywords in enumerate(missing_keywords):
+        if len(section_keywords) == 0:
+            continue
+        section_tokens = estimate_tokens(_resume_section(*position_highlights[i]))
+        if len(section_keywords) > MAX_SCORES_PER_REQUEST:
+            n_chunks = -(-len(section_keywords) // MAX_SCORES_PER_REQUEST)
+            keywords = list(section_keywords.items())
+            requests += [([i], dict(keywords[chunk::n_chunks])) for chunk in range(n_chunks)]
+            continue
+        union_keywords = {**packed_keywords, **section_keywords}
+        if packed_indices and (
+            (len(packed_indices) + 1) * len(union_keywords) > MAX_SCORES_PER_REQUEST
+            or sum(packed_tokens) + section_tokens > MAX_PACKED_SECTION_TOKENS
+            or _compatibility_request_tokens(packed_tokens + [section_tokens], union_keywords)
+            >= _compatibility_request_tokens(packed_tokens, packed_keywords)
+            + instruction_tokens
+            + _compatibility_request_tokens([section_tokens], section_keywords)
+        ):
+            requests.append((packed_indices, packed_keywords))
+            packed_indices, packed_keywords, packed_tokens, union_keywords = [], {}, [], dict(section_keywords)
+        packed_indices.append(i)
+        packed_keywords = union_keywords
+        packed_tokens.append(section_tokens)
+    if packed_indices:
+        requests.append((packed_indices, packed_keywords))
+    return requests
+
+
+def _parse_packed_scores(
+    raw_scores: BaseMessage, *, n_sections: int, keywords: dict[str, str], values: range
+) -> list[dict[str, int]]:
+    """Parse the numbered lists of scores under the "Section N:" header of each section, like _parse_numbered_scores.
+    Sections without a header get no scores.
+    """
+    section_rows: dict[int, list[str]] = {}
+    rows: list[str] = []
+    for row in raw_scores.content.split("\n"):
+        if header := re.fullmatch(r"\s*\**Section (\d+):?\**\s*", row):
+            rows = section_rows.setdefault(int(header.group(1)), [])
+        else:
+            rows.append(row)
+    return [
+        _parse_numbered_scores(section_rows.get(j, []), keywords=keywords, values=values)
+        for j in range(1, n_sections + 1)
+    ]
+
+
+def _keyword_compatibility_chain(prompt: ChatPromptTemplate = KEYWORD_COMPATIBILITY_PROMPT) -> Runnable:
+    return prompt | chat_model(
+        "get_compatibility",
+        temperature=0,
+        model_kwargs={"seed": OPENAI_REPRODUCIBILITY_SEED},
+        model_name=stage_model_name("get_compatibility"),
+    )
+
+
 def get_compatibility(
     *,
     job_description_keywords: list[str],
     position_highlights: list[tuple[str, str]],
-) -> dict[tuple[int, int], int]:
+    prefilled: Optional[list[dict[str, int]]] = None,
+) -> list[list[int]]:
     """Compute a compatibility matrix between job description keywords and (position, highlights) resume section tuples."""
-    numbered_keywords = "\n".join(f"{i}. {k}" for i, k in enumerate(job_description_keywords, start=1))
-    raw_compatibilities = KEYWORD_COMPATIBILITY_CHAIN.batch(
-        [
-            {
-                "numbered_job_description_keywords": numbered_keywords,
-                "resume_section": f"Job title: {position}\nHighlights:\n{highlights}",
-                "n_keywords": len(job_description_keywords),
-            }
-            for position, highlights in position_highlights
-        ]
+    return asyncio.run(
+        aget_compatibility(
+            job_description_keywords=job_description_keywords,
+            position_highlights=position_highlights,
+            prefilled=prefilled,
+        )
     )
-    logging.debug(f"{raw_compatibilities=}")
-    dict_compatibilities = [
-        {int(pair[0]): int(pair[1]) for pair in [row.split(". ") for row in section.content.split("\n")]}
-        for section in raw_compatibilities
+
+
+@traced("get_compatibility", category="chain")
+async def aget_compatibility(
+    *,
+    job_description_keywords: list[str],
+    position_highlights: list[tuple[str, str]],
+    prefilled: Optional[list[dict[str, int]]] = None,
+) -> list[list[int]]:
+    """Async version of get_compatibility.
+    prefilled can map keywords to the compatibilities of each resume section that are already known, e.g. from the
+    local prefilter. Only the (keyword, resume section) cells without a prefilled or cached compatibility are sent to
+    the LLM, packed into requests by _pack_compatibility_requests. Prefilled compatibilities aren't cached.
+    """
+    stage_cache = get_stage_cache()
+    chain = _keyword_compatibility_chain()
+    packed_chain = _keyword_compatibility_chain(PACKED_KEYWORD_COMPATIBILITY_PROMPT)
+    model = _chat_model_name(chain)
+    section_hashes = [section_hash(position, highlights) for position, highlights in position_highlights]
+    compatibilities = [
+        stage_cache.get_compatibilities(keywords=job_description_keywords, section_hash=hash, model=model)
+        if stage_cache is not None
+        else {}
+        for hash in section_hashes
     ]
-    logging.debug(f"{dict_compatibilities=}")
-    expected_score_keys = list(range(1, len(job_description_keywords) + 1))
-    for compatibility in dict_compatibilities:
-        score_keys = list(compatibility.keys())
-        assert score_keys == expected_score_keys, f"Numbering mismatch: {expected_score_keys=}, {score_keys=}"
-    return [list(compatibility.values()) for compatibility in dict_compatibilities]
-
-
-SUMMARIZE_RESUME_SECTION_CHAIN = (
-    ChatPromptTemplate.from_messages(
-        [
-            SystemMessage(
-                content=dedent(
-                    """
+    cache_hits = sum(map(len, compatibilities))
+    n_prefilled = 0
+    for section_compatibilities, section_prefilled in zip(compatibilities, prefilled or []):
+        for keyword, compatibility in section_prefilled.items():
+            if normalize_keyword(keyword) not in section_compatibilities:
+                section_compatibilities[normalize_keyword(keyword)] = compatibility
+                n_prefilled += 1
+    missing_keywords = [
+        _missing_keywords(job_description_keywords, section_compatibilities)
+        for section_compatibilities in compatibilities
+    ]
+    logging.debug(
+        f"Compatibility cache hits: {cache_hits}, prefilled: {n_prefilled}, misses: {sum(map(len, missing_keywords))}"
+    )
+    requests = _pack_compatibility_requests(missing_keywords, position_highlights)
+    annotate(
+        stage_cache_hits=cache_hits,
+        stage_cache_misses=sum(map(len, missing_keywords)),
+        prefilled=n_prefilled,
+        requests=len(requests),
+        packed_requests=sum(len(section_indices) > 1 for section_indices, _keywords in requests),
+    )
+
+    async def request_section_compatibilities(i: int, keywords: dict[str, str], attempt: int = 0) -> dict[str, int]:
+        raw_scores = await _scheduled(
+            _retry_chain(chain, attempt),
+            _compatibility_inputs([i], keywords, position_highlights),
+            stage="get_compatibility",
+        )
+        logging.debug(f"{raw_scores=}")
+        return _parse_numbered_scores(raw_scores.content.split("\n"), keywords=keywords, values=range(3))
+
+    async def request_compatibilities(section_indices: list[int], keywords: dict[str, str]) -> list[dict[str, int]]:
+        if len(section_indices) == 1:
+            scores = [await request_section_compatibilities(section_indices[0], keywords)]
+        else:
+            raw_scores = await _scheduled(
+                packed_chain,
+                _compatibility_inputs(section_indices, keywords, position_highlights),
+                stage="get_compatibility",
+            )
+            logging.debug(f"{raw_scores=}")
+            scores = _parse_packed_scores(
+                raw_scores, n_sections=len(section_indices), keywords=keywords, values=range(3)
+            )
+        # Packed sections are asked for the union of their missing keywords, but only the missing ones are kept. The
+        # ones missing from a malformed response are requested again for just their section.
+        return await asyncio.gather(
+            *(
+                _rerequest_missing_scores(
+                    {keyword: score for keyword, score in section_scores.items() if keyword in missing_keywords[i]},
+                    {keyword: spelling for keyword, spelling in keywords.items() if keyword in missing_keywords[i]},
+                    functools.partial(request_section_compatibilities, i),
+                    stage="get_compatibility",
+                )
+                for i, section_scores in zip(section_indices, scores)
+            )
+        )
+
+    all_scores = await asyncio.gather(
+        *(request_compatibilities(section_indices, keywords) for section_indices, keywords in requests)
+    )
+    new_compatibilities: dict[int, dict[str, int]] = {}
+    for section_indices, scores in zip((section_indices for section_indices, _keywords in requests), all_scores):
+        for i, section_scores in zip(section_indices, scores):
+            new_compatibilities.setdefault(i, {}).update(section_scores)
+    # Cache the valid compatibilities even if some are still missing, so that a rerun only requests those
+    for i, section_new_compatibilities in new_compatibilities.items():
+        if stage_cache is not None:
+            stage_cache.set_compatibilities(
+                compatibilities=section_new_compatibilities, section_hash=section_hashes[i], model=model
+            )
+        compatibilities[i].update(section_new_compatibilities)
+    for i, section_missing_keywords in enumerate(missing_keywords):
+        _check_scores(compatibilities[i], section_missing_keywords, stage="get_compatibility")
+    return [
+        [section_compatibilities[normalize_keyword(keyword)] for keyword in job_description_keywords]
+        for section_compatibilities in compatibilities
+    ]
+
+
+SUMMARIZE_RESUME_SECTION_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        SystemMessage(
+            content=dedent(
+                """
                     Background:
                     You are an expert resume section summarizer.
                     You value understanding a candidate's skills beyond the exact technologies used.
@@ -289,50 +916,77 @@ SUMMARIZE_RESUME_SECTION_CHAIN = (
                     WRONG: "Experienced in deploying AWS resources with Terraform."
                     RIGHT: "Experienced in deploying cloud resources through infrastructure-as-code tools."
                     """
-                )
-            ),
-            HumanMessagePromptTemplate.from_template(
-                template="""
+            )
+        ),
+        HumanMessagePromptTemplate.from_template(
+            template="""
                     Job title: {position}
                     Highlights:
                     {highlights}
                     """
-            ),
-        ]
-    )
-    | ChatOpenAI(model_name="gpt-4", max_tokens=300)
-    | StrOutputParser()
+        ),
+    ]
 )
 
 
+def _summarize_resume_section_chain() -> Runnable:
+    return (
+        SUMMARIZE_RESUME_SECTION_PROMPT
+        | chat_model(
+            "summarize_resume_sections",
+            model_name=stage_model_name("summarize_resume_sections"),
+            max_tokens=SUMMARY_MAX_TOKENS,
+        )
+        | StrOutputParser()
+    )
+
+
 def summarize_resume_sections(*, position_highlights: list[tuple[str, str]]) -> list[str]:
     # Summarize each section of the default resume to eliminate any ATS keywords that are already there.
-    return SUMMARIZE_RESUME_SECTION_CHAIN.batch(
-        [
-            {
-                "position": position,
-                "highlights": highlights,
-            }
-            for position, highlights in position_highlights
-        ]
+    return asyncio.run(asummarize_resume_sections(position_highlights=position_highlights))
+
+
+@traced("summarize_resume_sections", category="chain")
+async def asummarize_resume_sections(*, position_highlights: list[tuple[str, str]]) -> list[str]:
+    """Async version of summarize_resume_sections. Only the resume sections without a cached summary are summarized."""
+    stage_cache = get_stage_cache()
+    chain = _summarize_resume_section_chain()
+    model = _chat_model_name(chain)
+    section_hashes = [section_hash(position, highlights) for position, highlights in position_highlights]
+    summaries = stage_cache.get_summaries(section_hashes=section_hashes, model=model) if stage_cache is not None else {}
+    missing_section_indices = [i for i, hash in enumerate(section_hashes) if hash not in summaries]
+    annotate(stage_cache_hits=len(summaries), stage_cache_misses=len(missing_section_indices))
+    new_summaries = dict(
+        zip(
+            [section_hashes[i] for i in missing_section_indices],
+            await asyncio.gather(
+                *(
+                    _scheduled(
+                        chain,
+                        {
+                            "position": position_highlights[i][0],
+                            "highlights": position_highlights[i][1],
+                        },
+                        stage="summarize_resume_sections",
+                    )
+                    for i in missing_section_indices
+                )
+            ),
+        )
     )
+    if stage_cache is not None:
+        stage_cache.set_summaries(summaries=new_summaries, model=model)
+    summaries.update(new_summaries)
+    return [summaries[hash] for hash in section_hashes]
 
 
-def insert_keywords(
-    position_summary: str,
-    position_keywords: list[str],
-    highlight_count: int,
-    tokens_per_highlight: int,
-    /,
-) -> list[str]:
-    return (
-        ChatPromptTemplate.from_messages(
-            [
-                SystemMessagePromptTemplate.from_template(
-                    # Note literal '{' and '}' need to be escaped by doubling in an f-string.
-                    # See https://docs.python.org/3/library/string.html#format-string-syntax
-                    template=dedent(
-                        """\
+INSERT_KEYWORDS_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        SystemMessagePromptTemplate.from_template(
+            # Note literal '{' and '}' need to be escaped by doubling in an f-string.
+            # See https://docs.python.org/3/library/string.html#format-string-syntax
+            template=dedent(
+                """\
                     You are an expert resume writer.
                     Your objective is to turn a resume position summary into a list of {highlight_count} position
                     highlights that contain the required ATS (applicant tracking system) keywords.
@@ -380,24 +1034,113 @@ def insert_keywords(
                     Remember to keep the number of generated highlights to {highlight_count} highlights while inserting
                     as many provided ATS keywords into them as possible!
                     """
-                    ),
-                ),
-                HumanMessagePromptTemplate.from_template(
-                    template=dedent(
-                        """\
+            ),
+        ),
+        HumanMessagePromptTemplate.from_template(
+            template=dedent(
+                """\
                     Generate position highlights for the following ATS keywords:
                     {position_keywords}
                     """
-                    )
-                ),
-            ]
-        )
-        | ChatOpenAI(model_name="gpt-4", max_tokens=tokens_per_highlight * highlight_count)
-        | MarkdownListOutputParser()
-    ).invoke(
-        {
-            "position_summary": position_summary,
-            "position_keywords": position_keywords,
-            "highlight_count": highlight_count,
-        }
+            )
+        ),
+    ]
+)
+
+# Follow-up to INSERT_KEYWORDS_PROMPT that calls out what's wrong with the highlights it generated
+REVISE_HIGHLIGHTS_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        *INSERT_KEYWORDS_PROMPT.messages,
+        AIMessagePromptTemplate.from_template(template="{highlights}"),
+        HumanMessagePromptTemplate.from_template(
+            template=dedent(
+                """\
+                    {problems}
+                    Rewrite the highlights as a Markdown list of {highlight_count} highlights that contain all of the
+                    ATS keywords.
+                    """
+            )
+        ),
+    ]
+)
+
+
+def _insert_keywords_chain(
+    *, highlight_count: int, tokens_per_highlight: int, prompt: ChatPromptTemplate = INSERT_KEYWORDS_PROMPT
+) -> Runnable:
+    """Chain up to the chat model. The output parser is left out so that the generated tokens can be streamed."""
+    return prompt | chat_model(
+        "insert_keywords",
+        model_name=stage_model_name("insert_keywords"),
+        max_tokens=tokens_per_highlight * highlight_count,
+    )
+
+
+def insert_keywords(
+    position_summary: str,
+    position_keywords: list[str],
+    highlight_count: int,
+    tokens_per_highlight: int,
+    /,
+) -> list[str]:
+    return asyncio.run(ainsert_keywords(position_summary, position_keywords, highlight_count, tokens_per_highlight))
+
+
+@traced("insert_keywords", category="chain")
+async def ainsert_keywords(
+    position_summary: str,
+    position_keywords: list[str],
+    highlight_count: int,
+    tokens_per_highlight: int,
+    /,
+    *,
+    on_token: Optional[Callable[[str], None]] = None,
+) -> list[str]:
+    """Async version of insert_keywords.
+    If on_token is given, the response is streamed and on_token is called with each generated token. A retried
+    response is streamed again from the start.
+    """
+    chain = _insert_keywords_chain(highlight_count=highlight_count, tokens_per_highlight=tokens_per_highlight)
+    inputs = {
+        "position_summary": position_summary,
+        "position_keywords": position_keywords,
+        "highlight_count": highlight_count,
+    }
+    if on_token is None:
+        return MarkdownListOutputParser().parse((await _scheduled(chain, inputs, stage="insert_keywords")).content)
+
+    async def stream() -> str:
+        content = ""
+        async for chunk in chain.astream(inputs, config=run_config("insert_keywords")):
+            on_token(chunk.content)
+            content += chunk.content
+        return content
+
+    return MarkdownListOutputParser().parse(await _scheduled(chain, inputs, stage="insert_keywords", request=stream))
+
+
+@traced("revise_highlights", category="chain")
+async def arevise_highlights(
+    position_summary: str,
+    position_keywords: list[str],
+    highlight_count: int,
+    tokens_per_highlight: int,
+    /,
+    *,
+    highlights: list[str],
+    problems: str,
+) -> list[str]:
+    """Regenerate the highlights generated by ainsert_keywords() with the same arguments, calling out their problems,
+    e.g. the keywords they're missing.
+    """
+    chain = _insert_keywords_chain(
+        highlight_count=highlight_count, tokens_per_highlight=tokens_per_highlight, prompt=REVISE_HIGHLIGHTS_PROMPT
     )
+    inputs = {
+        "position_summary": position_summary,
+        "position_keywords": position_keywords,
+        "highlight_count": highlight_count,
+        "highlights": "\n".join(f"- {highlight}" for highlight in highlights),
+        "problems": problems,
+    }
+    return MarkdownListOutputParser().parse((await _scheduled(chain, inputs, stage="insert_keywords")).content)
@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+from typing import Any, Iterable, Optional
+
+import numpy as np
+
+
+def _to_json(value: Any) -> Any:
+    if isinstance(value, np.ndarray):
+        return {"ndarray": value.tolist(), "dtype": str(value.dtype)}
+    raise TypeError(f"Can't checkpoint {type(value).__name__} values.")
+
+
+def _from_json(value: Any) -> Any:
+    if isinstance(value, dict) and set(value) == {"ndarray", "dtype"}:
+        return np.array(value["ndarray"], dtype=value["dtype"])
+    return value
+
+
+def digest(value: Any) -> str:
+    """Content hash of a JSON-serializable value, which may contain NumPy arrays."""
+    return hashlib.sha256(json.dumps(value, default=_to_json, sort_keys=True).encode()).hexdigest()
+
+
+class RunCheckpoint:
+    """Directory of the outputs of the stages of one optimization run, one JSON file per stage (or per resume section
+    of a stage), so that a rerun after a failure continues where the failed run stopped.
+    Each output is saved with a key, e.g. a digest of the stage's inputs and parameters, and is only loaded back with
+    the same key. Stages listed in regenerate aren't loaded back, and with resume False nothing is.
+    """
+
+    def __init__(self, path: str, *, resume: bool = True, regenerate: Iterable[str] = ()) -> None:
+        self.path = path
+        self.resume = resume
+        self.regenerate = set(regenerate)
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, f"{name}.json")
+
+    def load(self, name: str, *, key: str) -> tuple[bool, Any]:
+        """Return (True, output) if the output of the stage (or "stage.section") was saved with the key, and
+        (False, None) otherwise.
+        """
+        if not self.resume or name.split(".")[0] in self.regenerate or not os.path.exists(self._file(name)):
+            return False, None
+        with open(self._file(name)) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint["key"] != key:
+            return False, None
+        return True, _from_json(checkpoint["output"])
+
+    def save(self, name: str, output: Any, *, key: str) -> None:
+        # Write to a temporary file first, so that a crash mid-write doesn't leave a corrupt checkpoint behind
+        temporary_file = self._file(name) + ".tmp"
+        with open(temporary_file, "w") as checkpoint_file:
+            json.dump({"key": key, "output": output}, checkpoint_file, default=_to_json)
+        os.replace(temporary_file, self._file(name))
+
+
+def run_path(run_dir: str, *, position_highlights: list[tuple[str, str]], job_title: str, job_description: str) -> str:
+    """Directory under the run directory of the checkpoints of optimizing the (position, highlights) resume sections for
+    the job.
+    """
+    return os.path.join(run_dir, digest([position_highlights, job_title, job_description])[:16])
+
+
+def stage_key(params: Optional[dict[str, Any]], inputs: dict[str, Any]) -> str:
+    """Checkpoint key of a stage with the parameters and dependency outputs."""
+    return digest([params or {}, {name: digest(value) for name, value in inputs.items()}])
@@ -1,47 +1,178 @@
 import argparse
+import asyncio
 import fileinput
 import json
 import logging
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterator, Optional
 
-from langchain.cache import SQLiteCache
-from langchain.globals import set_llm_cache
+from .cache import StageCache, set_stage_cache
+from .keywords import KeywordStore, set_keyword_store
+from .preprocess import JobDescriptionPreprocessor, set_job_description_preprocessor
+from .scheduler import Scheduler, set_scheduler
+from .trace import Tracer, get_tracer, set_tracer
 
-from .optimize import optimize_resume
+if TYPE_CHECKING:
+    from .planner import RunPlan
 
+# langchain, the OpenAI client and OR-Tools are only imported once the arguments are parsed, so that --help and argument
+# errors are fast.
 
-def cli():
-    # See https://docs.python.org/3/howto/argparse.html
-    parser = argparse.ArgumentParser()
+
+def _prefilter_threshold(value: str) -> float:
+    from .prefilter import check_threshold
+
+    try:
+        threshold = float(value)
+        check_threshold(threshold)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error)) from error
+    return threshold
+
+
+def _assign_engine(value: str) -> str:
+    from .assign import ENGINES
+
+    if value not in ENGINES:
+        raise argparse.ArgumentTypeError(f"invalid choice: {value!r} (choose from {', '.join(ENGINES)})")
+    return value
+
+
+def _add_optimization_arguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument(
-        "-r",
-        "--resume-file",
-        help="filepath (or '-' for standard input) containing the default JSON resume",
-        required=True,
+        "-k",
+        "--tokens-per-highlight",
+        help="Tokens to generate per highlight. Defaults to 60.",
+        type=int,
+        default=60,
     )
     parser.add_argument(
-        "-j",
-        "--job-description-file",
-        help="filepath (or '-' for standard input) containing the job description",
-        required=True,
+        "--highlight-counts",
+        help="Numbers of highlights to generate for the first resume sections, the others get 1 highlight each. "
+        "Keywords are assigned to the resume sections in proportion to them. With --resume-run, changing them "
+        "assigns the keywords again and regenerates the highlights without scoring the keywords again. Defaults to "
+        "3 3 2.",
+        type=int,
+        nargs="+",
+        metavar="COUNT",
     )
     parser.add_argument(
-        "-t",
-        "--job-title",
-        help="Title of the job in the job description",
-        required=True,
+        "--assign-engine",
+        help="Solver for assigning keywords to resume sections, min_cost_flow or scip. Defaults to min_cost_flow.",
+        type=_assign_engine,
+        default="min_cost_flow",
     )
     parser.add_argument(
-        "-o",
-        "--output-file",
-        help="File to output the optimized JSON resume to.",
-        required=True,
+        "--prefilter-threshold",
+        help="Set the compatibilities of keywords and resume sections whose local character n-gram similarity is at "
+        "most this threshold to 0, and those at least 1 minus this threshold to 2, instead of asking the LLM. Higher "
+        "thresholds make fewer LLM calls at the cost of accuracy. With -v, the number of compatibilities each "
+        "threshold would skip is printed. At least 0 and less than 0.5. Disabled by default.",
+        type=_prefilter_threshold,
     )
     parser.add_argument(
-        "-k",
-        "--tokens-per-highlight",
-        help="Tokens to generate per highlight. Defaults to 60.",
+        "--verify",
+        help="Check that the generated highlights of each resume section contain the keywords assigned to it and are "
+        "as many as requested, and regenerate the highlights of the sections that aren't up to this many times, "
+        "calling out the missing keywords. With -v, the keyword coverage of each section is printed. Defaults to 1 "
+        "regeneration if given without a number.",
+        metavar="ATTEMPTS",
+        dest="verify_attempts",
         type=int,
-        default=60,
+        nargs="?",
+        const=1,
+    )
+    parser.add_argument(
+        "--stage-cache-file",
+        help="SQLite file caching individual compatibility, difficulty and summary values. "
+        "Defaults to .resume_optimizer.db.",
+        default=".resume_optimizer.db",
+    )
+    parser.add_argument(
+        "--llm-cache-file",
+        help="SQLite file caching whole LLM responses, which concurrent runs can share. Defaults to .langchain.db.",
+        default=".langchain.db",
+    )
+    parser.add_argument(
+        "--llm-cache-max-mb",
+        help="Size cap of the LLM responses in the LLM cache file in megabytes, beyond which the least recently used "
+        "ones are evicted. Defaults to 512.",
+        type=float,
+        default=512,
+    )
+    parser.add_argument(
+        "--llm-cache-ttl-days",
+        help="Days after which LLM responses are evicted from the LLM cache file. By default they're only evicted for "
+        "space.",
+        type=float,
+    )
+    parser.add_argument(
+        "--keyword-store",
+        action="store_true",
+        help="Merge aliases of the same extracted keyword, like Kubernetes and k8s, and remember keyword difficulties "
+        "across postings in the stage cache file. Disabled by default.",
+    )
+    parser.add_argument(
+        "--keyword-aliases",
+        help='JSON file mapping keyword aliases to their canonical spellings, e.g. {"k8s": "Kubernetes"}, to add to '
+        "the keyword store. Implies --keyword-store.",
+    )
+    parser.add_argument(
+        "--near-duplicate-threshold",
+        help="Reuse the keywords and difficulties of a previously optimized posting with a job title of the same "
+        "family whose job description has at least this estimated similarity (from 0 to 1, e.g. 0.8) with the new "
+        "one, instead of extracting and estimating them again. The postings are indexed in the stage cache file. "
+        "Disabled by default.",
+        type=float,
+    )
+    parser.add_argument(
+        "--preprocess",
+        action="store_true",
+        help="Normalize the whitespace of job descriptions and drop duplicate lines and boilerplate like EEO "
+        "statements, benefits sections and navigation text before extracting their keywords. With -v, the tokens saved "
+        "are printed.",
+    )
+    parser.add_argument(
+        "--boilerplate-patterns",
+        help='JSON file with more regular expressions of boilerplate for --preprocess to drop, e.g. {"lines": ["apply '
+        'on company site"], "statements": ["drug-free workplace"], "sections": ["about the company"]}. Implies '
+        "--preprocess.",
+    )
+    parser.add_argument(
+        "--rate-limits",
+        help='JSON file with the rate limits of each model, e.g. {"gpt-4": {"rpm": 500, "tpm": 30000}}. '
+        "Requests are paced to stay within them.",
+    )
+    parser.add_argument(
+        "--backends-config",
+        help="JSON file with the LLM backends (the OpenAI API or OpenAI-compatible APIs such as local servers) and the "
+        "backend and model of each stage. See the README for the format. By default all stages use the OpenAI API.",
+    )
+    parser.add_argument(
+        "--route",
+        help="Route a stage to a backend of the backends config and a model, e.g. "
+        "get_compatibility=local:llama3, overriding the backends config. Can be given multiple times.",
+        metavar="STAGE=BACKEND:MODEL",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--max-concurrent-requests",
+        help="Maximum number of LLM requests in flight at the same time. Defaults to 16.",
+        type=int,
+        default=16,
+    )
+    parser.add_argument(
+        "--trace-file",
+        help="File to write a trace of the stages, chain calls, LLM calls and assignment solves to.",
+    )
+    parser.add_argument(
+        "--trace-format",
+        help="Format of the trace file. chrome traces can be viewed in chrome://tracing or https://ui.perfetto.dev, "
+        "json traces list the spans and their p50/p95 durations. Defaults to chrome.",
+        choices=("chrome", "json"),
+        default="chrome",
     )
     parser.add_argument(
         "-v",
@@ -50,7 +181,75 @@ def cli():
         default=0,
         help="Verbosity level. -v prints informational messages, -vv prints debug messages.",
     )
-    args = parser.parse_args()
+
+
+def _add_common_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "-r",
+        "--resume-file",
+        help="filepath (or '-' for standard input) containing the default JSON resume",
+        required=True,
+    )
+    _add_optimization_arguments(parser)
+    parser.add_argument(
+        "--max-tokens-budget",
+        help="Most prompt and completion tokens to spend on each optimization, as planned before sending any request. "
+        "The tokens per highlight are lowered to fit the plan into the budget, and jobs that don't fit even so are "
+        "rejected, or skipped in batch mode.",
+        type=int,
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the planned LLM requests, tokens and latency of each optimization without sending any request.",
+    )
+    parser.add_argument(
+        "--stream-keywords",
+        action="store_true",
+        help="Stream the keyword extraction and estimate the difficulties and compatibilities of each batch of "
+        "keywords as soon as it's extracted. Streamed keyword extractions aren't cached by the LLM cache.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Reuse the previous optimization for the same job from the stage cache, only redoing the work for "
+        "resume sections that changed since.",
+    )
+    parser.add_argument(
+        "--run-dir",
+        help="Directory to save the output of each stage of each optimization to as soon as it's ready, in a "
+        "subdirectory for the resume and job.",
+    )
+    parser.add_argument(
+        "--resume-run",
+        action="store_true",
+        help="Continue from the outputs saved to --run-dir by a previous run for the same resume and job, only running "
+        "the stages that didn't finish, the stages listed in --regenerate, and the stages whose inputs or options "
+        "changed.",
+    )
+    parser.add_argument(
+        "--regenerate",
+        nargs="+",
+        default=[],
+        metavar="STAGE",
+        help="Stages to run again with --resume-run even though their outputs were saved: keywords, "
+        "position_summaries, verbatim_compatibility, difficulties, compatibility, position_keywords (the keyword "
+        "assignment), optimized_highlights, verified_highlights (the highlights after --verify). The stages that "
+        "depend on them are only run again if their outputs change.",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Print progress events, including each resume section's highlights as soon as they're generated, to "
+        "standard output as newline-delimited JSON.",
+    )
+
+
+def _configure(args: argparse.Namespace) -> None:
+    from langchain.globals import set_llm_cache
+
+    from .llm_cache import BoundedLLMCache
+
     if args.verbose == 1:
         logging.basicConfig(format="%(message)s", level=logging.INFO)
     elif args.verbose >= 2:
@@ -58,18 +257,423 @@ def cli():
     else:
         logging.basicConfig(format="%(message)s", level=logging.WARNING)
     # Use cache to avoid executing some tasks that only use the default resume over and over again
-    set_llm_cache(SQLiteCache(database_path=".langchain.db"))
+    set_llm_cache(
+        BoundedLLMCache(
+            args.llm_cache_file,
+            max_bytes=int(args.llm_cache_max_mb * 1024 * 1024),
+            ttl=args.llm_cache_ttl_days * 24 * 60 * 60 if args.llm_cache_ttl_days is not None else None,
+        )
+    )
+    # Cache the values of individual keywords and resume sections too, so that new keywords or resume sections don't
+    # invalidate the values of the others
+    set_stage_cache(StageCache(database_path=args.stage_cache_file))
+    if args.keyword_store or args.keyword_aliases:
+        # Canonicalize keywords and remember their difficulties across postings
+        keyword_store = KeywordStore(database_path=args.stage_cache_file)
+        if args.keyword_aliases:
+            with open(args.keyword_aliases) as keyword_aliases_file:
+                keyword_store.add_aliases(json.load(keyword_aliases_file))
+        set_keyword_store(keyword_store)
+    if args.near_duplicate_threshold is not None:
+        from .postings import PostingIndex, set_posting_index
+
+        set_posting_index(PostingIndex(database_path=args.stage_cache_file, threshold=args.near_duplicate_threshold))
+    if args.preprocess or args.boilerplate_patterns:
+        boilerplate_patterns = None
+        if args.boilerplate_patterns:
+            with open(args.boilerplate_patterns) as boilerplate_patterns_file:
+                boilerplate_patterns = json.load(boilerplate_patterns_file)
+        set_job_description_preprocessor(JobDescriptionPreprocessor(boilerplate_patterns))
+    rate_limits = None
+    if args.rate_limits:
+        with open(args.rate_limits) as rate_limits_file:
+            rate_limits = json.load(rate_limits_file)
+    set_scheduler(Scheduler(rate_limits=rate_limits, max_concurrency=args.max_concurrent_requests))
+    if args.backends_config or args.route:
+        from .backends import configure_backends
+
+        configure_backends(_backends_config(args), routes=args.route)
+    if args.trace_file:
+        set_tracer(Tracer())
+
+
+def _backends_config(args: argparse.Namespace) -> Optional[dict]:
+    if not args.backends_config:
+        return None
+    with open(args.backends_config) as backends_config_file:
+        return json.load(backends_config_file)
+
+
+def _log_llm_cache_stats() -> None:
+    from langchain.globals import get_llm_cache
 
-    # Optimize the resume, reading the resume and job description contents from the provided files (or stdin)
+    llm_cache = get_llm_cache()
+    if hasattr(llm_cache, "stats"):
+        stats = llm_cache.stats()
+        logging.info(
+            f"LLM cache hits: {stats['hits']}, misses: {stats['misses']} ({stats['hit_rate']:.0%} hit rate), "
+            f"evictions: {stats['evictions']}, size: {stats['bytes'] / 1024 / 1024:.1f} MB"
+        )
+
+
+def _write_trace(args: argparse.Namespace) -> None:
+    tracer = get_tracer()
+    if tracer is None:
+        return
+    tracer.write(args.trace_file, format=args.trace_format)
+    logging.info("Span durations in milliseconds:")
+    for name, stats in tracer.summary().items():
+        logging.info(
+            f"{name:<40} count={stats['count']:<4} p50={stats['p50_ms']:<10.1f} p95={stats['p95_ms']:<10.1f} "
+            f"total={stats['total_ms']:.1f}"
+        )
+
+
+def _print_event(event: dict) -> None:
+    print(json.dumps(event), flush=True)
+
+
+def _print_table(rows: list[dict]) -> None:
+    cells = [[f"{value:.1f}" if isinstance(value, float) else str(value) for value in row.values()] for row in rows]
+    widths = [max(len(column), *(len(row_cells[i]) for row_cells in cells)) for i, column in enumerate(rows[0])]
+    print("  ".join(column.rjust(width) for column, width in zip(rows[0], widths)))
+    for row_cells in cells:
+        print("  ".join(cell.rjust(width) for cell, width in zip(row_cells, widths)))
+
+
+def _plan(args: argparse.Namespace, *, resume: dict, job_description: str, job_title: str, **plan_kwargs) -> "RunPlan":
+    """Plan the optimization of the resume for the job with the options, fitted to the token budget if any."""
+    from .optimize import get_default_highlights, get_section_highlight_counts
+    from .planner import fit_to_budget, plan_optimization
+
+    position_highlights = get_default_highlights(resume)
+    plan_kwargs.update(
+        position_highlights=position_highlights,
+        job_description=job_description,
+        job_title=job_title,
+        tokens_per_highlight=args.tokens_per_highlight,
+        highlight_counts=get_section_highlight_counts(len(position_highlights), highlight_counts=args.highlight_counts),
+        verify_attempts=args.verify_attempts,
+    )
+    if args.max_tokens_budget is not None:
+        return fit_to_budget(max_tokens_budget=args.max_tokens_budget, **plan_kwargs)
+    return plan_optimization(**plan_kwargs)
+
+
+def cli():
+    # See https://docs.python.org/3/howto/argparse.html
+    parser = argparse.ArgumentParser()
+    _add_common_arguments(parser)
+    parser.add_argument(
+        "-j",
+        "--job-description-file",
+        help="filepath (or '-' for standard input) containing the job description",
+        required=True,
+    )
+    parser.add_argument(
+        "-t",
+        "--job-title",
+        help="Title of the job in the job description",
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output-file",
+        help="File to output the optimized JSON resume to.",
+        required=True,
+    )
+    args = parser.parse_args()
+    _configure(args)
+    from .optimize import optimize_resume
+
+    # Read the resume and job description contents from the provided files (or stdin)
+    resume = json.loads("".join(fileinput.input(files=[args.resume_file])))
+    job_description = "".join(fileinput.input(files=[args.job_description_file]))
+    if args.dry_run:
+        from .planner import BudgetExceededError
+
+        try:
+            plan = _plan(args, resume=resume, job_description=job_description, job_title=args.job_title)
+        except BudgetExceededError as error:
+            parser.exit(1, f"{error}\n")
+        _print_table(plan.rows())
+        print(
+            f"Total: {plan.tokens} tokens, {plan.latency:.1f} seconds, {plan.tokens_per_highlight} tokens per highlight"
+        )
+        return
     resume = optimize_resume(
-        resume=json.loads("".join(fileinput.input(files=[args.resume_file]))),
-        job_description="".join(fileinput.input(files=[args.job_description_file])),
+        resume=resume,
+        job_description=job_description,
         job_title=args.job_title,
         tokens_per_highlight=args.tokens_per_highlight,
+        assign_engine=args.assign_engine,
+        prefilter_threshold=args.prefilter_threshold,
+        verify_attempts=args.verify_attempts,
+        highlight_counts=args.highlight_counts,
+        stream_keywords=args.stream_keywords,
+        max_tokens_budget=args.max_tokens_budget,
+        incremental=args.incremental,
+        run_dir=args.run_dir,
+        resume_run=args.resume_run,
+        regenerate=args.regenerate,
+        on_event=_print_event if args.stream else None,
     )
     # Save the updated resume to resume.json.
     with open(args.output_file, "w") as resume_file:
         resume_file.write(json.dumps(resume, indent=4))
+    _log_llm_cache_stats()
+    _write_trace(args)
+
+
+def _read_jobs(path: str) -> Iterator[dict[str, str]]:
+    """Read job records from an NDJSON file or a directory.
+    Each NDJSON line is an object with 'job_title' and 'job_description' keys and an optional 'id' key.
+    A directory can contain *.json files with one such object each, or *.txt files where the first line is the job
+    title and the rest of the file is the job description.
+    """
+    if os.path.isdir(path):
+        for job_path in sorted(Path(path).iterdir()):
+            if job_path.suffix == ".json":
+                yield {"id": job_path.stem, **json.loads(job_path.read_text())}
+            elif job_path.suffix == ".txt":
+                job_title, _, job_description = job_path.read_text().partition("\n")
+                yield {"id": job_path.stem, "job_title": job_title.strip(), "job_description": job_description}
+    else:
+        for line_number, line in enumerate(fileinput.input(files=[path]), start=1):
+            if line.strip():
+                yield {"id": f"job-{line_number:04}", **json.loads(line)}
+
+
+def batch_cli():
+    parser = argparse.ArgumentParser(description="Optimize one resume against many job descriptions.")
+    _add_common_arguments(parser)
+    parser.add_argument(
+        "-J",
+        "--jobs",
+        help="NDJSON filepath (or '-' for standard input) or directory containing the job titles and descriptions",
+        required=True,
+    )
+    parser.add_argument(
+        "-O",
+        "--output-dir",
+        help="Directory to output the optimized JSON resumes to, one <job id>.json file per job.",
+        required=True,
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Maximum number of jobs to optimize at the same time. Defaults to 4.",
+        type=int,
+        default=4,
+    )
+    args = parser.parse_args()
+    _configure(args)
+    from .optimize import aoptimize_resume_batch
+
+    resume = json.loads("".join(fileinput.input(files=[args.resume_file])))
+    if args.dry_run:
+        from .planner import BudgetExceededError
+
+        rows = []
+        for i, job in enumerate(_read_jobs(args.jobs)):
+            # The resume sections are only summarized once for all jobs
+            try:
+                plan = _plan(
+                    args,
+                    resume=resume,
+                    job_description=job["job_description"],
+                    job_title=job["job_title"],
+                    summarize=i == 0,
+                )
+            except BudgetExceededError:
+                rows.append(
+                    {"job": job["id"], "requests": 0, "tokens": 0, "latency_s": 0.0, "tokens_per_highlight": "skipped"}
+                )
+                continue
+            rows.append(
+                {
+                    "job": job["id"],
+                    "requests": sum(stage.requests for stage in plan.stages.values()),
+                    "tokens": plan.tokens,
+                    "latency_s": plan.latency,
+                    "tokens_per_highlight": plan.tokens_per_highlight,
+                }
+            )
+        _print_table(rows)
+        print(f"Total: {sum(row['tokens'] for row in rows)} tokens")
+        return
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    async def write_resumes():
+        async for job, optimized_resume in aoptimize_resume_batch(
+            resume=resume,
+            jobs=_read_jobs(args.jobs),
+            tokens_per_highlight=args.tokens_per_highlight,
+            max_workers=args.workers,
+            assign_engine=args.assign_engine,
+            prefilter_threshold=args.prefilter_threshold,
+            verify_attempts=args.verify_attempts,
+            highlight_counts=args.highlight_counts,
+            stream_keywords=args.stream_keywords,
+            max_tokens_budget=args.max_tokens_budget,
+            incremental=args.incremental,
+            run_dir=args.run_dir,
+            resume_run=args.resume_run,
+            regenerate=args.regenerate,
+            on_event=_print_event if args.stream else None,
+        ):
+            output_file = os.path.join(args.output_dir, f"{job['id']}.json")
+            with open(output_file, "w") as resume_file:
+                resume_file.write(json.dumps(optimized_resume, indent=4))
+            logging.info(f"Saved the resume optimized for {job['job_title']!r} to {output_file}")
+
+    asyncio.run(write_resumes())
+    _log_llm_cache_stats()
+    _write_trace(args)
+
+
+def portfolio_cli():
+    parser = argparse.ArgumentParser(
+        description="Optimize several variants of a resume against one job description to pick the best one."
+    )
+    parser.add_argument(
+        "-r",
+        "--resume-file",
+        help="filepath containing a default JSON resume variant. Repeat for each variant.",
+        action="append",
+        required=True,
+    )
+    _add_optimization_arguments(parser)
+    parser.add_argument(
+        "-j",
+        "--job-description-file",
+        help="filepath (or '-' for standard input) containing the job description",
+        required=True,
+    )
+    parser.add_argument(
+        "-t",
+        "--job-title",
+        help="Title of the job in the job description",
+        required=True,
+    )
+    parser.add_argument(
+        "-O",
+        "--output-dir",
+        help="Directory to output the optimized JSON resumes to, under the file names of the variants, along with "
+        "portfolio.json listing the variants from the highest to the lowest keyword coverage.",
+        required=True,
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Print progress events to standard output as newline-delimited JSON, with the index of the variant under "
+        '"resume".',
+    )
+    args = parser.parse_args()
+    _configure(args)
+    from .optimize import aoptimize_resume_portfolio
+
+    output_files = [os.path.join(args.output_dir, Path(resume_file).name) for resume_file in args.resume_file]
+    if len(set(output_files)) < len(output_files):
+        parser.error("The resume variants need different file names.")
+    os.makedirs(args.output_dir, exist_ok=True)
+    results = asyncio.run(
+        aoptimize_resume_portfolio(
+            resumes=[json.loads(Path(resume_file).read_text()) for resume_file in args.resume_file],
+            job_description="".join(fileinput.input(files=[args.job_description_file])),
+            job_title=args.job_title,
+            tokens_per_highlight=args.tokens_per_highlight,
+            assign_engine=args.assign_engine,
+            prefilter_threshold=args.prefilter_threshold,
+            verify_attempts=args.verify_attempts,
+            highlight_counts=args.highlight_counts,
+            on_event=_print_event if args.stream else None,
+        )
+    )
+    for output_file, result in zip(output_files, results):
+        with open(output_file, "w") as resume_file:
+            resume_file.write(json.dumps(result["resume"], indent=4))
+    ranking = sorted(
+        (
+            {
+                "resume_file": resume_file,
+                "output_file": output_file,
+                "coverage": result["coverage"],
+                "missing_keywords": result["missing_keywords"],
+            }
+            for resume_file, output_file, result in zip(args.resume_file, output_files, results)
+        ),
+        key=lambda variant: variant["coverage"],
+        reverse=True,
+    )
+    with open(os.path.join(args.output_dir, "portfolio.json"), "w") as portfolio_file:
+        portfolio_file.write(json.dumps(ranking, indent=4))
+    if not args.stream:
+        for variant in ranking:
+            print(f"{variant['coverage']:.0%} keyword coverage: {variant['output_file']}")
+    _log_llm_cache_stats()
+    _write_trace(args)
+
+
+def server_cli():
+    parser = argparse.ArgumentParser(
+        description="Serve resume optimizations over HTTP, keeping the chat models, connections and caches warm."
+    )
+    _add_optimization_arguments(parser)
+    parser.add_argument("--host", help="Host to listen on. Defaults to 127.0.0.1.", default="127.0.0.1")
+    parser.add_argument("-p", "--port", help="TCP port to listen on. Defaults to 8080.", type=int, default=8080)
+    parser.add_argument("--unix-socket", help="Unix socket path to listen on instead of the TCP host and port.")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Maximum number of jobs to optimize at the same time. Defaults to 4.",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--queue-size",
+        help="Maximum number of jobs waiting for a worker before requests are rejected with 503. Defaults to 16.",
+        type=int,
+        default=16,
+    )
+    parser.add_argument(
+        "--openai-base-url",
+        help="Base URL of the OpenAI API, e.g. of a local OpenAI-compatible stand-in, for the stages that the backends "
+        "config doesn't route elsewhere. Defaults to the OpenAI API.",
+    )
+    parser.add_argument(
+        "--max-connections",
+        help="Maximum number of HTTP connections to each OpenAI-compatible backend. Defaults to 100.",
+        type=int,
+        default=100,
+    )
+    args = parser.parse_args()
+    _configure(args)
+    from .backends import configure_backends
+    from .server import OptimizerServer
+
+    # Replaces the routing of _configure() with one whose chat models share a pool of connections per backend
+    configure_backends(
+        _backends_config(args),
+        routes=args.route,
+        default_backend={"provider": "openai", "base_url": args.openai_base_url},
+        max_connections=args.max_connections,
+    )
+    server = OptimizerServer(
+        workers=args.workers,
+        queue_size=args.queue_size,
+        tokens_per_highlight=args.tokens_per_highlight,
+        assign_engine=args.assign_engine,
+        prefilter_threshold=args.prefilter_threshold,
+        verify_attempts=args.verify_attempts,
+        highlight_counts=args.highlight_counts,
+    )
+    try:
+        asyncio.run(server.serve(host=args.host, port=args.port, unix_socket=args.unix_socket))
+    except KeyboardInterrupt:
+        pass
+    _log_llm_cache_stats()
+    _write_trace(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+import re
+import sqlite3
+import threading
+from typing import Optional
+
+from .cache import normalize_keyword
+from .match import tokenize
+
+# Canonical spellings of aliases that postings commonly use, which the store starts out with. Canonical spellings
+# that are common words, like the "Go" of "Golang", are left out since they'd match ordinary text.
+DEFAULT_ALIASES = {
+    "k8s": "Kubernetes",
+    "Postgres": "PostgreSQL",
+    "JS": "JavaScript",
+    "Amazon Web Services": "AWS",
+    "Google Cloud Platform": "GCP",
+    "CI CD": "CI/CD",
+}
+
+# Title words that don't change what a job is about, so that e.g. "Senior Data Engineer II" and "Data Engineer" share
+# stored difficulties
+SENIORITY_TOKENS = {
+    "associate",
+    "entry",
+    "head",
+    "i",
+    "ii",
+    "iii",
+    "iv",
+    "intern",
+    "jr",
+    "junior",
+    "lead",
+    "level",
+    "mid",
+    "principal",
+    "senior",
+    "sr",
+    "staff",
+}
+
+# A keyword with an alias in parentheses, like "Kubernetes (k8s)"
+PARENTHESIZED_ALIAS_PATTERN = re.compile(r"^(.*?)\s*\(([^()]+)\)\s*$")
+
+
+def _is_abbreviation(abbreviation: str, keyword: str) -> bool:
+    """Whether the abbreviation is an acronym of the words of the keyword, like "AWS" or "IaC", or a numeronym of the
+    keyword, like "k8s".
+    """
+    abbreviation = re.sub(r"\W+", "", abbreviation).casefold()
+    words = re.findall(r"\w+", keyword.casefold())
+    if len(abbreviation) < 2 or len(words) == 0:
+        return False
+    numeronym = re.fullmatch(r"([a-z])(\d+)([a-z])", abbreviation)
+    if numeronym and len(words) == 1:
+        first, length, last = numeronym.groups()
+        return words[0][0] == first and words[0][-1] == last and len(words[0]) - 2 == int(length)
+    return len(words) > 1 and abbreviation == "".join(word[0] for word in words)
+
+
+def job_title_family(job_title: str) -> str:
+    """Normalized job title without seniority and level words."""
+    tokens = tokenize(job_title)
+    return " ".join(token for token in tokens if token not in SENIORITY_TOKENS) or " ".join(tokens)
+
+
+class KeywordStore:
+    """SQLite store of what's known about keywords across postings, with an in-memory index of all of it.
+    - Canonical spelling per normalized alias, so that "Kubernetes", "kubernetes (k8s)" and "K8s" are one keyword
+    - Difficulty per (normalized canonical keyword, job title family, model)
+    """
+
+    def __init__(self, database_path: str = ".resume_optimizer.db") -> None:
+        self.database_path = database_path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(database_path, timeout=60, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS keyword_alias (
+                    alias TEXT PRIMARY KEY, canonical TEXT
+                );
+                CREATE TABLE IF NOT EXISTS keyword_difficulty (
+                    keyword TEXT, job_title_family TEXT, model TEXT, value INTEGER,
+                    PRIMARY KEY (keyword, job_title_family, model)
+                );
+                """
+            )
+            self._aliases = {normalize_keyword(alias): canonical for alias, canonical in DEFAULT_ALIASES.items()}
+            self._aliases.update(self._connection.execute("SELECT alias, canonical FROM keyword_alias").fetchall())
+            self._difficulties = {
+                (keyword, family, model): value
+                for keyword, family, model, value in self._connection.execute("SELECT * FROM keyword_difficulty")
+            }
+
+    def add_aliases(self, aliases: dict[str, str]) -> None:
+        """Make the canonical spellings the canonical spellings of their aliases, and of themselves."""
+        rows = [(normalize_keyword(alias), canonical) for alias, canonical in aliases.items()]
+        rows += [(normalize_keyword(canonical), canonical) for canonical in aliases.values()]
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO keyword_alias VALUES (?, ?)", rows)
+            self._aliases.update(rows)
+
+    def resolve(self, keyword: str) -> Optional[str]:
+        """Return the canonical spelling of a known keyword or alias, or None for unknown keywords."""
+        match = PARENTHESIZED_ALIAS_PATTERN.match(keyword)
+        spellings = [match.group(1), match.group(2)] if match else [keyword]
+        return next(
+            (self._aliases[alias] for alias in map(normalize_keyword, spellings) if alias in self._aliases), None
+        )
+
+    def canonical_keys(self, keywords: list[str]) -> list[str]:
+        """Normalized canonical spelling of each keyword.
+        Unknown keywords become canonical, with the alias in parentheses of spellings like "Kubernetes (k8s)". Only
+        aliases that abbreviate the keyword are stored for later postings, others like the "AWS" of "Cloud (AWS)" only
+        apply to these keywords.
+        """
+        new_aliases = {}
+        local_aliases = {}
+        keys = []
+        for keyword in keywords:
+            alias = normalize_keyword(keyword)
+            canonical = self.resolve(keyword) or new_aliases.get(alias) or local_aliases.get(alias)
+            if canonical is None:
+                match = PARENTHESIZED_ALIAS_PATTERN.match(keyword)
+                canonical = match.group(1) if match and match.group(1) else keyword.strip()
+                new_aliases[alias] = canonical
+                if match:
+                    abbreviates = _is_abbreviation(match.group(2), canonical) or _is_abbreviation(
+                        canonical, match.group(2)
+                    )
+                    (new_aliases if abbreviates else local_aliases)[normalize_keyword(match.group(2))] = canonical
+            keys.append(normalize_keyword(canonical))
+        if new_aliases:
+            self.add_aliases(new_aliases)
+        return keys
+
+    def deduplicate(self, keywords: list[str]) -> list[str]:
+        """Drop the keywords that are aliases of earlier ones. The keywords keep their spellings, which are the ones
+        that ATS look for, and their canonical spellings only tell aliases apart.
+        """
+        unique_keywords: dict[str, str] = {}
+        for keyword, key in zip(keywords, self.canonical_keys(keywords)):
+            unique_keywords.setdefault(key, keyword)
+        return list(unique_keywords.values())
+
+    def _key(self, keyword: str) -> str:
+        return normalize_keyword(self.resolve(keyword) or keyword)
+
+    def get_difficulties(self, *, keywords: list[str], job_title: str, model: str) -> dict[str, int]:
+        """Return the stored difficulties of the keywords that have them for the job title family, by normalized
+        keyword.
+        """
+        family = job_title_family(job_title)
+        return {
+            normalize_keyword(keyword): self._difficulties[(self._key(keyword), family, model)]
+            for keyword in keywords
+            if (self._key(keyword), family, model) in self._difficulties
+        }
+
+    def set_difficulties(self, *, difficulties: dict[str, int], job_title: str, model: str) -> None:
+        family = job_title_family(job_title)
+        rows = [(self._key(keyword), family, model, value) for keyword, value in difficulties.items()]
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO keyword_difficulty VALUES (?, ?, ?, ?)", rows)
+            self._difficulties.update({(keyword, family, model): value for keyword, family, model, value in rows})
+
+
+_keyword_store: Optional[KeywordStore] = None
+
+
+def set_keyword_store(keyword_store: Optional[KeywordStore]) -> None:
+    """Set the keyword store used by the chains, or disable it with None."""
+    global _keyword_store
+    _keyword_store = keyword_store
+
+
+def get_keyword_store() -> Optional[KeywordStore]:
+    return _keyword_store
@@ -0,0 +1,176 @@
+import atexit
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.load import dumps, loads
+
+
+def _cache_key(prompt: str, llm_string: str) -> str:
+    return hashlib.sha256(f"{llm_string}\n{prompt}".encode()).hexdigest()
+
+
+class BoundedLLMCache(BaseCache):
+    """SQLite cache of whole LLM responses to whole prompts that many threads and processes can share, and that stays
+    within a size cap.
+    - The database is in WAL mode, so that readers don't block the writer and vice versa, and writers wait for each
+      other instead of failing.
+    - New responses and access times are written in batches of batch_size, or after flush_interval seconds, rather
+      than in a transaction per response. Responses waiting to be written are served from memory.
+    - Once the responses take up more than max_bytes, the least recently used ones are evicted down to 90% of it.
+      Responses older than ttl seconds are neither served nor kept.
+    """
+
+    def __init__(
+        self,
+        database_path: str = ".langchain.db",
+        *,
+        max_bytes: Optional[int] = 512 * 1024 * 1024,
+        ttl: Optional[float] = None,
+        batch_size: int = 32,
+        flush_interval: float = 5.0,
+    ) -> None:
+        self.database_path = database_path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # Responses and access times waiting to be written, by cache key
+        self._pending: dict[str, tuple[str, float]] = {}
+        self._pending_accesses: dict[str, float] = {}
+        self._flushed = time.monotonic()
+        self._connection = sqlite3.connect(database_path, timeout=60, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            # In one immediate transaction, so that processes opening a new database don't both seed its size
+            self._connection.executescript(
+                """
+                BEGIN IMMEDIATE;
+                CREATE TABLE IF NOT EXISTS llm_response (
+                    key TEXT PRIMARY KEY, response TEXT, size INTEGER, created REAL, accessed REAL
+                );
+                CREATE INDEX IF NOT EXISTS llm_response_accessed ON llm_response (accessed);
+                CREATE INDEX IF NOT EXISTS llm_response_created ON llm_response (created);
+                -- Total size of the responses, kept up to date by all processes writing to the database
+                CREATE TABLE IF NOT EXISTS llm_response_size (size INTEGER);
+                INSERT INTO llm_response_size SELECT COALESCE(SUM(size), 0) FROM llm_response
+                    WHERE NOT EXISTS (SELECT * FROM llm_response_size);
+                CREATE TRIGGER IF NOT EXISTS llm_response_insert AFTER INSERT ON llm_response BEGIN
+                    UPDATE llm_response_size SET size = size + NEW.size;
+                END;
+                CREATE TRIGGER IF NOT EXISTS llm_response_update AFTER UPDATE OF size ON llm_response BEGIN
+                    UPDATE llm_response_size SET size = size + NEW.size - OLD.size;
+                END;
+                CREATE TRIGGER IF NOT EXISTS llm_response_delete AFTER DELETE ON llm_response BEGIN
+                    UPDATE llm_response_size SET size = size - OLD.size;
+                END;
+                COMMIT;
+                """
+            )
+        atexit.register(self.flush)
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        key = _cache_key(prompt, llm_string)
+        now = time.time()
+        with self._lock:
+            if key in self._pending:
+                response, created = self._pending[key]
+            else:
+                row = self._connection.execute(
+                    "SELECT response, created FROM llm_response WHERE key = ?", (key,)
+                ).fetchone()
+                response, created = row if row is not None else (None, None)
+            if response is None or (self.ttl is not None and created < now - self.ttl):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._pending_accesses[key] = now
+            self._maybe_flush()
+        return [loads(generation) for generation in response.split("\n")]
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        # Serialized generations are JSON without raw newlines, so one per line
+        response = "\n".join(dumps(generation) for generation in return_val)
+        with self._lock:
+            self._pending[_cache_key(prompt, llm_string)] = (response, time.time())
+            self._maybe_flush()
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock, self._connection:
+            self._pending.clear()
+            self._pending_accesses.clear()
+            self._connection.execute("DELETE FROM llm_response")
+
+    def _maybe_flush(self) -> None:
+        if (
+            len(self._pending) + len(self._pending_accesses) >= self.batch_size
+            or time.monotonic() - self._flushed >= self.flush_interval
+        ):
+            self._flush()
+
+    def flush(self) -> None:
+        """Write the pending responses and access times to the database, evicting responses if over the size cap."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        self._flushed = time.monotonic()
+        if not self._pending and not self._pending_accesses:
+            return
+        with self._connection:
+            self._connection.executemany(
+                "INSERT INTO llm_response VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET response = "
+                "excluded.response, size = excluded.size, created = excluded.created, accessed = excluded.accessed",
+                [
+                    (key, response, len(key) + len(response), created, self._pending_accesses.pop(key, created))
+                    for key, (response, created) in self._pending.items()
+                ],
+            )
+            self._connection.executemany(
+                "UPDATE llm_response SET accessed = MAX(accessed, ?) WHERE key = ?",
+                [(accessed, key) for key, accessed in self._pending_accesses.items()],
+            )
+            self._pending.clear()
+            self._pending_accesses.clear()
+            if self.ttl is not None:
+                self.evictions += self._connection.execute(
+                    "DELETE FROM llm_response WHERE created < ?", (time.time() - self.ttl,)
+                ).rowcount
+            if self.max_bytes is not None and self._stored_size() > self.max_bytes:
+                self._evict()
+
+    def _stored_size(self) -> int:
+        return self._connection.execute("SELECT size FROM llm_response_size").fetchone()[0]
+
+    def _evict(self) -> None:
+        excess = self._stored_size() - int(0.9 * self.max_bytes)
+        evicted = []
+        for key, size in self._connection.execute("SELECT key, size FROM llm_response ORDER BY accessed"):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+        self._connection.executemany("DELETE FROM llm_response WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+        logging.debug(f"Evicted {len(evicted)} least recently used responses from the LLM cache")
+
+    def stats(self) -> dict[str, Any]:
+        """Hits, misses, hit rate and evictions since the cache was created, and the size of the written responses."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "bytes": self._stored_size(),
+            }
@@ -0,0 +1,67 @@
+import re
+import unicodedata
+from collections import deque
+
+# Tokens are runs of word characters, also allowing the symbols of names like C++, C#, Node.js, and ASP.NET
+TOKEN_PATTERN = re.compile(r"[\w+#]+(?:\.[\w+#]+)*")
+
+
+def normalize_token(token: str) -> str:
+    """Normalize the case, Unicode representation, and simple plural form of a token."""
+    token = unicodedata.normalize("NFKC", token).casefold()
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        token = token[:-1]
+    return token
+
+
+def tokenize(text: str) -> list[str]:
+    return [normalize_token(token) for token in TOKEN_PATTERN.findall(text)]
+
+
+class KeywordIndex:
+    """Aho-Corasick automaton over the normalized tokens of a list of keywords.
+    Keywords only match whole tokens, so "R" doesn't match inside "Terraform", and all keywords are found in a single
+    pass over the text.
+    """
+
+    def __init__(self, keywords: list[str]) -> None:
+        self.keywords = keywords
+        # Trie of token sequences. Node 0 is the root.
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._outputs: list[set[int]] = [set()]
+        for keyword_index, keyword in enumerate(keywords):
+            node = 0
+            for token in tokenize(keyword):
+                if token not in self._goto[node]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._outputs.append(set())
+                    self._goto[node][token] = len(self._goto) - 1
+                node = self._goto[node][token]
+            # Keywords without any tokens (e.g. just punctuation) are never matched
+            if node != 0:
+                self._outputs[node].add(keyword_index)
+        # Breadth-first traversal to compute the failure links, merging the outputs of the suffixes they point to
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for token, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail != 0 and token not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(token, 0)
+                self._outputs[child] |= self._outputs[self._fail[child]]
+                queue.append(child)
+
+    def find(self, text: str) -> set[int]:
+        """Return the indices of the keywords that appear in the text. Keywords don't match across lines."""
+        found_keyword_indices = set()
+        for line in text.splitlines():
+            node = 0
+            for token in tokenize(line):
+                while node != 0 and token not in self._goto[node]:
+                    node = self._fail[node]
+                node = self._goto[node].get(token, 0)
+                found_keyword_indices |= self._outputs[node]
+        return found_keyword_indices
@@ -1,11 +1,78 @@
+import asyncio
+import copy
 import json
 import logging
-from multiprocessing import Pool
-from typing import Any
+import time
+from typing import Any, AsyncIterator, Callable, Iterable, Optional
 
+import numpy as np
 
 from .assign import assign
-from .chains import extract_keywords, get_compatibility, get_difficulties, summarize_resume_sections, insert_keywords
+from .cache import get_stage_cache, job_hash, normalize_keyword, section_hash
+from .chains import (
+    aextract_keywords,
+    aget_compatibility,
+    aget_difficulties,
+    ainsert_keywords,
+    arevise_highlights,
+    asummarize_resume_sections,
+    stage_model_name,
+)
+from .checkpoint import RunCheckpoint, digest, run_path
+from .match import KeywordIndex
+from .pipeline import Pipeline
+from .planner import BudgetExceededError, fit_to_budget
+from .postings import get_posting_index
+from .prefilter import UNCERTAIN, confident_compatibility, keyword_similarity, prefilter_report
+from .trace import span, trace_context
+from .verify import SectionCoverage, coverage_report, verify_section
+
+# Compatibility matrix value of the (resume section, keyword) cells that haven't been scored yet
+UNSCORED = -1
+# Number of highlights of the first resume sections, the rest get one highlight each
+HIGHLIGHT_COUNTS = [3, 3, 2]
+
+
+def get_default_highlights(resume: dict[str, Any]) -> list[tuple[str, str]]:
+    """Turn the work entries of the resume into (position, Markdown highlights list) resume section tuples."""
+    return [
+        (
+            experience["position"],
+            "\n".join(f"- {highlight}" for highlight in experience["highlights"]),
+        )
+        for experience in resume["work"]
+    ]
+
+
+def get_section_highlight_counts(n_sections: int, *, highlight_counts: Optional[list[int]] = None) -> list[int]:
+    """Number of highlights to generate for each resume section: highlight_counts (HIGHLIGHT_COUNTS by default) for the
+    first resume sections, and 1 for the rest.
+    """
+    highlight_counts = HIGHLIGHT_COUNTS if highlight_counts is None else highlight_counts
+    if any(highlight_count < 1 for highlight_count in highlight_counts):
+        raise ValueError(f"Every resume section needs at least 1 highlight, not {highlight_counts}.")
+    return [highlight_counts[i] if i < len(highlight_counts) else 1 for i in range(n_sections)]
+
+
+def _present_keyword_indices(compatibility: np.ndarray) -> list[int]:
+    """Indices of the keywords that appear verbatim in at least one resume section."""
+    return np.flatnonzero((compatibility == 3).any(axis=0)).tolist()
+
+
+async def _early_scores(batches: list[tuple[list[str], asyncio.Task]]) -> dict[str, Any]:
+    """Scores by normalized keyword of the keyword batches that were scored while the keywords were being extracted."""
+    scores = {}
+    for keyword_batch, task in batches:
+        scores.update(zip(map(normalize_keyword, keyword_batch), await task))
+    return scores
+
+
+def _posting_models() -> dict[str, str]:
+    """Models of the keywords and difficulties stored in the posting index."""
+    return {
+        "keywords_model": stage_model_name("extract_keywords"),
+        "difficulties_model": stage_model_name("get_difficulties"),
+    }
 
 
 def optimize_resume(
@@ -14,154 +81,720 @@ def optimize_resume(
     job_description: str,
     job_title: str,
     tokens_per_highlight: int,
+    position_summaries: Optional[list[str]] = None,
+    keywords: Optional[list[str]] = None,
+    difficulties: Optional[list[int]] = None,
+    assign_engine: str = "min_cost_flow",
+    prefilter_threshold: Optional[float] = None,
+    stream_keywords: bool = False,
+    max_tokens_budget: Optional[int] = None,
+    verify_attempts: Optional[int] = None,
+    highlight_counts: Optional[list[int]] = None,
+    incremental: bool = False,
+    run_dir: Optional[str] = None,
+    resume_run: bool = False,
+    regenerate: Iterable[str] = (),
+    on_event: Optional[Callable[[dict[str, Any]], None]] = None,
 ) -> dict[str, Any]:
-    default_highlights = [
-        (
-            experience["position"],
-            "\n".join(f"- {highlight}" for highlight in experience["highlights"]),
+    """Rewrite the work highlights of the resume to contain the ATS keywords of the job description.
+    The position summaries only depend on the resume, and the keywords and their difficulties only depend on the job, so
+    they can be passed in when they were already computed.
+    With a prefilter threshold, the compatibilities that the local prefilter is confident about at that threshold aren't
+    estimated by the LLM, see confident_compatibility().
+    With stream_keywords, the keyword extraction is streamed, and the difficulties and compatibilities of each batch of
+    keywords are estimated as soon as the batch is extracted rather than once all keywords are. Streamed responses
+    aren't cached by the LLM cache.
+    With a token budget, the LLM requests are planned before any is sent, see plan_optimization(), and the tokens per
+    highlight are lowered to fit the planned tokens into the budget. Raises BudgetExceededError if they don't fit.
+    With verify_attempts, the highlights of each resume section are checked for the keywords assigned to the section and
+    for the number of highlights, and the highlights of the sections that fail are regenerated up to verify_attempts
+    times with their problems called out. 0 only checks them.
+    highlight_counts are the numbers of highlights of the first resume sections, see get_section_highlight_counts().
+    The keywords are assigned to the resume sections in proportion to them, so with resume_run, a rerun with other
+    highlight counts assigns the keywords again and regenerates the highlights, reusing the scores.
+    With incremental, the keywords, difficulties, and unchanged resume sections of the previous optimization for the
+    same job are reused from the stage cache.
+    With a posting index, the keywords and difficulties of a near-duplicate of the job that was optimized for before
+    are reused if there is one, and those of the job are added to the index otherwise, see PostingIndex.
+    With a run directory, the output of each stage (and the highlights of each resume section) is saved to a
+    subdirectory for the resume and job as soon as it's ready. With resume_run, a rerun continues from these outputs,
+    only running the stages that didn't finish, the stages listed in regenerate, and the stages whose inputs or
+    parameters changed.
+    on_event is called with progress events as soon as they happen:
+    - {"event": "stage_start", "stage": ...} when a stage starts
+    - {"event": "stage_complete", "stage": ...} when a stage finishes
+    - {"event": "keyword_batch", "keywords": [...]} for each batch of keywords extracted with stream_keywords
+    - {"event": "near_duplicate", "similarity": ...} when the keywords and difficulties of a near-duplicate posting
+      are reused
+    - {"event": "keywords", "keywords": [...]} when the keywords are extracted
+    - {"event": "assignment", "position_keywords": [[...], ...]} when the keywords are assigned to resume sections
+    - {"event": "section_token", "section": ..., "token": ...} for each token generated for a resume section
+    - {"event": "section_highlights", "section": ..., "highlights": [...]} when a resume section is finished, and
+      again when its highlights are regenerated by the verification
+    - {"event": "coverage_report", "report": {...}} when the highlights are verified, see coverage_report()
+    - {"event": "done"} when the whole resume is finished
+    Each event also has the number of seconds since the start of the optimization under "elapsed".
+    """
+    return asyncio.run(
+        aoptimize_resume(
+            resume=resume,
+            job_description=job_description,
+            job_title=job_title,
+            tokens_per_highlight=tokens_per_highlight,
+            position_summaries=position_summaries,
+            keywords=keywords,
+            difficulties=difficulties,
+            assign_engine=assign_engine,
+            prefilter_threshold=prefilter_threshold,
+            stream_keywords=stream_keywords,
+            max_tokens_budget=max_tokens_budget,
+            verify_attempts=verify_attempts,
+            highlight_counts=highlight_counts,
+            incremental=incremental,
+            run_dir=run_dir,
+            resume_run=resume_run,
+            regenerate=regenerate,
+            on_event=on_event,
         )
-        for experience in resume["work"]
-    ]
+    )
 
-    # Stage 1: Summarize resume sections and extract job description keywords in parallel
-    with Pool(2) as pool:
-        keywords_result = pool.apply_async(
-            func=extract_keywords,
-            kwds={
-                "job_description": job_description,
-                "job_title": job_title,
-            },
+
+async def aoptimize_resume(
+    *,
+    resume: dict[str, Any],
+    job_description: str,
+    job_title: str,
+    tokens_per_highlight: int,
+    position_summaries: Optional[list[str]] = None,
+    keywords: Optional[list[str]] = None,
+    difficulties: Optional[list[int]] = None,
+    assign_engine: str = "min_cost_flow",
+    prefilter_threshold: Optional[float] = None,
+    stream_keywords: bool = False,
+    max_tokens_budget: Optional[int] = None,
+    verify_attempts: Optional[int] = None,
+    highlight_counts: Optional[list[int]] = None,
+    incremental: bool = False,
+    run_dir: Optional[str] = None,
+    resume_run: bool = False,
+    regenerate: Iterable[str] = (),
+    on_event: Optional[Callable[[dict[str, Any]], None]] = None,
+) -> dict[str, Any]:
+    """Async version of optimize_resume.
+    The stages are run as a dependency graph, so stages that don't depend on each other run at the same time.
+    """
+    start_time = time.perf_counter()
+
+    def emit(event: str, **fields: Any) -> None:
+        if on_event is not None:
+            on_event({"event": event, "elapsed": round(time.perf_counter() - start_time, 3), **fields})
+
+    default_highlights = get_default_highlights(resume)
+    n_experiences = len(default_highlights)
+    section_highlight_counts = get_section_highlight_counts(n_experiences, highlight_counts=highlight_counts)
+    # Reuse the keywords and difficulties of a near-duplicate of the posting that was processed before, if any
+    posting_index = get_posting_index()
+    use_posting_index = posting_index is not None and keywords is None and difficulties is None and not incremental
+    near_duplicate = None
+    if use_posting_index:
+        near_duplicate = posting_index.find(job_title=job_title, job_description=job_description, **_posting_models())
+        if near_duplicate is not None:
+            logging.info(
+                "Reusing the keywords and difficulties of a near-duplicate posting with a similarity of "
+                f"{near_duplicate.similarity:.2f}"
+            )
+            emit("near_duplicate", similarity=near_duplicate.similarity)
+            keywords, difficulties = near_duplicate.keywords, near_duplicate.difficulties
+    if max_tokens_budget is not None:
+        plan = fit_to_budget(
+            max_tokens_budget=max_tokens_budget,
+            tokens_per_highlight=tokens_per_highlight,
+            position_highlights=default_highlights,
+            job_description=job_description,
+            job_title=job_title,
+            highlight_counts=section_highlight_counts,
+            keywords=keywords,
+            difficulties=difficulties,
+            position_summaries=position_summaries,
+            verify_attempts=verify_attempts,
         )
-        position_summaries_result = pool.apply_async(
-            func=summarize_resume_sections,
-            kwds={
-                "position_highlights": default_highlights,
-            },
+        tokens_per_highlight = plan.tokens_per_highlight
+        logging.info(f"Planned tokens: {plan.tokens}, planned latency: {plan.latency:.1f} seconds")
+    pipeline = Pipeline()
+
+    # Load the manifest of the previous optimization for this job to only redo the work for changed resume sections
+    stage_cache = get_stage_cache()
+    if incremental and stage_cache is None:
+        raise ValueError("Incremental optimization needs a stage cache, see set_stage_cache().")
+    manifest_job_hash = job_hash(job_title, job_description)
+    manifest = stage_cache.get_manifest(job_hash=manifest_job_hash) if incremental else None
+    section_hashes = [section_hash(position, highlights) for position, highlights in default_highlights]
+    checkpoint = None
+    if run_dir is not None:
+        checkpoint = RunCheckpoint(
+            run_path(
+                run_dir, position_highlights=default_highlights, job_title=job_title, job_description=job_description
+            ),
+            resume=resume_run,
+            regenerate=regenerate,
         )
-        keywords = keywords_result.get()
-        position_summaries = position_summaries_result.get()
-    logging.info("keywords=")
-    logging.info("\n".join(f"{i+1}. {k}" for i, k in enumerate(keywords)))
-    logging.info("---")
-    logging.debug("position_summaries=")
-    logging.debug(json.dumps(position_summaries, indent=4))
-    logging.debug("---")
+    previous_highlights = {}
+    if manifest is not None:
+        previous_highlights = {
+            (section["hash"], tuple(section["position_keywords"]), section["highlight_count"]): section["highlights"]
+            for section in manifest["sections"]
+            if manifest["tokens_per_highlight"] == tokens_per_highlight
+        }
+        previous_section_hashes = {section["hash"] for section in manifest["sections"]}
+        logging.info(
+            "Resume sections changed since the previous optimization = "
+            f"{[i+1 for i, hash in enumerate(section_hashes) if hash not in previous_section_hashes]}"
+        )
+
+    # Tasks scoring the batches of keywords extracted with stream_keywords, with the keywords of each batch they score
+    early_difficulties: list[tuple[list[str], asyncio.Task[list[int]]]] = []
+    early_compatibilities: list[tuple[list[str], asyncio.Task[list[np.ndarray]]]] = []
+
+    def score_keyword_batch(keyword_batch: list[str]) -> None:
+        emit("keyword_batch", keywords=keyword_batch)
+        if difficulties is None and manifest is None:
+            early_difficulties.append(
+                (
+                    keyword_batch,
+                    asyncio.create_task(aget_difficulties(job_description_keywords=keyword_batch, job_title=job_title)),
+                )
+            )
+        batch_compatibility = verbatim_compatibility(keyword_batch)
+        questionable_keywords = [
+            keyword_batch[i] for i in np.flatnonzero((batch_compatibility == UNSCORED).all(axis=0)).tolist()
+        ]
+        if len(questionable_keywords) > 0:
+
+            async def score_compatibility_columns() -> list[np.ndarray]:
+                return list(np.array(await score_compatibility(questionable_keywords)).T)
+
+            early_compatibilities.append((questionable_keywords, asyncio.create_task(score_compatibility_columns())))
+
+    # Stage 1: Summarize resume sections and extract job description keywords in parallel
+    async def keywords_stage() -> list[str]:
+        keywords = await aextract_keywords(
+            job_description=job_description,
+            job_title=job_title,
+            on_keywords=score_keyword_batch if stream_keywords else None,
+        )
+        logging.info("keywords=")
+        logging.info("\n".join(f"{i+1}. {k}" for i, k in enumerate(keywords)))
+        logging.info("---")
+        return keywords
+
+    async def position_summaries_stage() -> list[str]:
+        position_summaries = await asummarize_resume_sections(position_highlights=default_highlights)
+        logging.debug("position_summaries=")
+        logging.debug(json.dumps(position_summaries, indent=4))
+        logging.debug("---")
+        return position_summaries
+
+    pipeline.add_stage("keywords", keywords_stage)
+    pipeline.add_stage("position_summaries", position_summaries_stage)
 
     # Stage 2: Assign special compatibility level of 3 to keywords that appear verbatim in the default resume
-    compatibility = [[None for _k in range(len(keywords))] for _r in range(len(default_highlights))]
-    present_keyword_indices = set()
-    for resume_section_index, (position, highlights) in enumerate(default_highlights):
-        logging.debug(f"{highlights=}")
-        for keyword_index, keyword in enumerate(keywords):
-            if keyword.lower() in position.lower() or keyword.lower() in highlights.lower():
-                compatibility[resume_section_index][keyword_index] = 3
-                present_keyword_indices.add(keyword_index)
-    # Set all other compatibilities for present keywords to zero
-    for resume_section_index in range(len(default_highlights)):
-        for present_keyword_index in present_keyword_indices:
-            if compatibility[resume_section_index][present_keyword_index] is None:
-                compatibility[resume_section_index][present_keyword_index] = 0
-    logging.info(f"Keywords present in default resume = {[i+1 for i in present_keyword_indices]}")
-    logging.debug(f"{compatibility=}")
+    def verbatim_compatibility(keywords: list[str]) -> np.ndarray:
+        index = KeywordIndex(keywords)
+        compatibility = np.full((n_experiences, len(keywords)), UNSCORED, dtype=np.int8)
+        for resume_section_index, (position, highlights) in enumerate(default_highlights):
+            present_in_section = sorted(index.find(position) | index.find(highlights))
+            compatibility[resume_section_index, present_in_section] = 3
+        # Set all other compatibilities for present keywords to zero
+        compatibility[(compatibility == UNSCORED) & (compatibility == 3).any(axis=0)] = 0
+        return compatibility
+
+    async def verbatim_compatibility_stage(keywords: list[str]) -> np.ndarray:
+        for _position, highlights in default_highlights:
+            logging.debug(f"{highlights=}")
+        compatibility = verbatim_compatibility(keywords)
+        logging.info(f"Keywords present in default resume = {[i+1 for i in _present_keyword_indices(compatibility)]}")
+        logging.debug(f"{compatibility=}")
+        return compatibility
+
+    pipeline.add_stage("verbatim_compatibility", verbatim_compatibility_stage, after=("keywords",))
 
     # Stage 3: Estimate keyword difficulty based on the job title
-    difficulties = get_difficulties(job_description_keywords=keywords, job_title=job_title)
-    logging.info("difficulties=")
-    logging.info("\n".join(f"{i+1}. {d}" for i, d in enumerate(difficulties)))
-    logging.info("---")
-    # Remove difficult keywords that are not verbatim in the default resume
-    removed_keyword_indices = {
-        keyword_index
-        for keyword_index, difficulty in enumerate(difficulties)
-        if difficulty >= 3 and keyword_index not in present_keyword_indices
-    }
-    if len(removed_keyword_indices) > 0:
-        logging.warning(
-            "WARNING: Some keywords won't be inserted because the LLM gauged them as very difficult skills and "
-            "they weren't mentioned explicitly in the default resume:"
+    async def difficulties_stage(keywords: list[str]) -> list[int]:
+        scored_difficulties = await _early_scores(early_difficulties)
+        remaining_keywords = [keyword for keyword in keywords if normalize_keyword(keyword) not in scored_difficulties]
+        if len(remaining_keywords) > 0:
+            scored_difficulties.update(
+                zip(
+                    map(normalize_keyword, remaining_keywords),
+                    await aget_difficulties(job_description_keywords=remaining_keywords, job_title=job_title),
+                )
+            )
+        difficulties = [scored_difficulties[normalize_keyword(keyword)] for keyword in keywords]
+        logging.info("difficulties=")
+        logging.info("\n".join(f"{i+1}. {d}" for i, d in enumerate(difficulties)))
+        logging.info("---")
+        return difficulties
+
+    pipeline.add_stage("difficulties", difficulties_stage, after=("keywords",))
+
+    # Stage 4: Estimate the compatibility of the keywords that are not present verbatim with the resume sections.
+    # This doesn't wait for the difficulties, so the too difficult keywords are scored too and filtered out later.
+    # The cells that the local prefilter is confident about are set without asking the LLM.
+    def section_similarity(keywords: list[str]) -> np.ndarray:
+        return keyword_similarity(
+            keywords, [f"{position}\n{highlights}" for position, highlights in default_highlights]
+        )
+
+    async def score_compatibility(keywords: list[str]) -> list[list[int]]:
+        prefilled = None
+        if prefilter_threshold is not None:
+            confident = confident_compatibility(section_similarity(keywords), threshold=prefilter_threshold)
+            prefilled = [
+                {
+                    keyword: int(section_confident[k])
+                    for k, keyword in enumerate(keywords)
+                    if section_confident[k] != UNCERTAIN
+                }
+                for section_confident in confident
+            ]
+        return await aget_compatibility(
+            job_description_keywords=keywords, position_highlights=default_highlights, prefilled=prefilled
+        )
+
+    async def compatibility_stage(keywords: list[str], verbatim_compatibility: np.ndarray) -> np.ndarray:
+        compatibility = verbatim_compatibility.copy()
+        questionable_keyword_indices = np.flatnonzero((compatibility == UNSCORED).all(axis=0)).tolist()
+        if len(questionable_keyword_indices) > 0:
+            similarity = section_similarity([keywords[i] for i in questionable_keyword_indices])
+            logging.info(f"Compatibility cells the prefilter would skip by threshold = {prefilter_report(similarity)}")
+            scored_compatibilities = await _early_scores(early_compatibilities)
+            remaining_keyword_indices = []
+            for i in questionable_keyword_indices:
+                if normalize_keyword(keywords[i]) in scored_compatibilities:
+                    compatibility[:, i] = scored_compatibilities[normalize_keyword(keywords[i])]
+                else:
+                    remaining_keyword_indices.append(i)
+            if len(remaining_keyword_indices) > 0:
+                compatibility[:, remaining_keyword_indices] = await score_compatibility(
+                    [keywords[i] for i in remaining_keyword_indices]
+                )
+        # Print compatibility matrix in compact yet usable format
+        logging.info("compatibility=")
+        logging.info(
+            "    " + "".join(f"{d/10:.0f}" if d % 10 == 0 and d > 0 else " " for d in range(1, len(keywords) + 1))
+        )
+        logging.info("    " + "".join(f"{d%10:.0f}" for d in range(1, len(keywords) + 1)))
+        logging.info("    " + "".join("-" for _ in range(len(keywords))))
+        logging.info(
+            "\n".join(
+                [
+                    f"{i+1:<2}| " + "".join([str(v) if v != UNSCORED else "N" for v in row])
+                    for i, row in enumerate(compatibility)
+                ]
+            )
         )
-        logging.warning("\n".join(f"- {keywords[keyword_index]}" for keyword_index in removed_keyword_indices))
         logging.info("---")
+        return compatibility
 
-    # Stage 4: Assign keywords that are neither present verbatim nor too difficult to resume sections while maximizing
-    # overall compatibility.
-    questionable_keyword_indices = sorted(set(range(len(keywords))) - present_keyword_indices - removed_keyword_indices)
-    questionable_compatibility = get_compatibility(
-        job_description_keywords=[keywords[i] for i in questionable_keyword_indices],
-        position_highlights=default_highlights,
+    pipeline.add_stage(
+        "compatibility",
+        compatibility_stage,
+        after=("keywords", "verbatim_compatibility"),
+        params={"prefilter_threshold": prefilter_threshold},
     )
-    for resume_section_index in range(len(default_highlights)):
-        for sequential_keyword_index, questionable_keyword_index in enumerate(questionable_keyword_indices):
-            compatibility[resume_section_index][questionable_keyword_index] = questionable_compatibility[
-                resume_section_index
-            ][sequential_keyword_index]
-    # Print compatibility matrix in compact yet usable format
-    logging.info("compatibility=")
-    logging.info("    " + "".join(f"{d/10:.0f}" if d % 10 == 0 and d > 0 else " " for d in range(1, len(keywords) + 1)))
-    logging.info("    " + "".join(f"{d%10:.0f}" for d in range(1, len(keywords) + 1)))
-    logging.info("    " + "".join("-" for _ in range(len(keywords))))
-    logging.info(
-        "\n".join(
+
+    # Stage 5: Assign undeleted keywords to resume sections while maximizing overall compatibility
+    async def position_keywords_stage(
+        keywords: list[str],
+        verbatim_compatibility: np.ndarray,
+        difficulties: list[int],
+        compatibility: np.ndarray,
+    ) -> list[list[str]]:
+        present_keyword_indices = set(_present_keyword_indices(verbatim_compatibility))
+        # Remove difficult keywords that are not verbatim in the default resume
+        removed_keyword_indices = {
+            keyword_index
+            for keyword_index, difficulty in enumerate(difficulties)
+            if difficulty >= 3 and keyword_index not in present_keyword_indices
+        }
+        if len(removed_keyword_indices) > 0:
+            logging.warning(
+                "WARNING: Some keywords won't be inserted because the LLM gauged them as very difficult skills and "
+                "they weren't mentioned explicitly in the default resume:"
+            )
+            logging.warning("\n".join(f"- {keywords[keyword_index]}" for keyword_index in removed_keyword_indices))
+            logging.info("---")
+        # Sorting the keywords in order from most to least difficult encourages the LLM to use the most important ones
+        # first
+        difficulty_sorted_keyword_indices = [
+            sorted_keyword_index
+            for _difficulty, sorted_keyword_index in sorted(
+                [
+                    (difficulties[keyword_index], keyword_index)
+                    for keyword_index in (set(range(len(keywords))) - removed_keyword_indices)
+                ],
+                reverse=True,
+            )
+        ]
+        assignment = assign(
+            compatibility=compatibility[:, difficulty_sorted_keyword_indices],
+            count_weights=section_highlight_counts,
+            engine=assign_engine,
+        )
+        logging.debug(f"{assignment=}")
+        position_keywords = [
             [
-                f"{i+1:<2}| " + "".join([str(v) if v is not None else "N" for v in row])
-                for i, row in enumerate(compatibility)
+                keywords[difficulty_sorted_keyword_indices[internal_index]]
+                for internal_index, resume_section_index in assignment
+                if resume_section_index == current_resume_section_index
             ]
-        )
+            for current_resume_section_index in range(len(default_highlights))
+        ]
+        logging.info("position_keywords=")
+        logging.info(json.dumps(position_keywords, indent=4))
+        logging.info("---")
+        return position_keywords
+
+    pipeline.add_stage(
+        "position_keywords",
+        position_keywords_stage,
+        after=("keywords", "verbatim_compatibility", "difficulties", "compatibility"),
+        params={"assign_engine": assign_engine, "highlight_counts": section_highlight_counts},
     )
-    logging.info("---")
-    # Stage 5: Assign undeleted keywords to resume sections
-    # Sorting the keywords in order from most to least difficult encourages the LLM to use the most important ones first
-    difficulty_sorted_keyword_indices = [
-        sorted_keyword_index
-        for _difficulty, sorted_keyword_index in sorted(
-            [
-                (difficulties[keyword_index], keyword_index)
-                for keyword_index in (set(range(len(keywords))) - removed_keyword_indices)
-            ],
-            reverse=True,
+
+    # Stage 6: Insert the keywords into the corresponding optimal summarized resume sections.
+    # Have to call the sections separately rather than run batch() on the chain because the chain itself must be
+    # changed depending on how many sections we have to return.
+    async def optimized_highlights_stage(
+        position_summaries: list[str], position_keywords: list[list[str]]
+    ) -> list[list[str]]:
+        async def optimize_highlights(i: int) -> list[str]:
+            # Reuse the highlights of resume sections that are unchanged and were assigned the same keywords last time
+            previous_key = (section_hashes[i], tuple(position_keywords[i]), section_highlight_counts[i])
+            # Each section is checkpointed on its own, so that a failure in one section doesn't lose the others
+            checkpoint_key = digest(
+                [position_summaries[i], position_keywords[i], section_highlight_counts[i], tokens_per_highlight]
+            )
+            found, highlights = (
+                checkpoint.load(f"optimized_highlights.{i}", key=checkpoint_key) if checkpoint else (False, None)
+            )
+            if found:
+                logging.debug(f"Reusing the checkpointed highlights of resume section {i+1}")
+            elif previous_key in previous_highlights:
+                logging.debug(f"Reusing the previous highlights of resume section {i+1}")
+                highlights = previous_highlights[previous_key]
+            else:
+                highlights = await ainsert_keywords(
+                    position_summaries[i],
+                    position_keywords[i],
+                    section_highlight_counts[i],
+                    tokens_per_highlight,
+                    on_token=(lambda token: emit("section_token", section=i, token=token)) if on_event else None,
+                )
+            if checkpoint is not None and not found:
+                checkpoint.save(f"optimized_highlights.{i}", highlights, key=checkpoint_key)
+            emit("section_highlights", section=i, highlights=highlights)
+            return highlights
+
+        # Let the other sections finish (and be checkpointed) before failing because of one of them
+        optimized_highlights = await asyncio.gather(
+            *(optimize_highlights(i) for i in range(n_experiences)), return_exceptions=True
         )
-    ]
-    highlight_counts = [3, 3, 2]
-    assignment = assign(
-        compatibility=[
-            [compatibility_row[keyword_index] for keyword_index in difficulty_sorted_keyword_indices]
-            for compatibility_row in compatibility
-        ],
-        count_weights=highlight_counts,
+        for section_highlights in optimized_highlights:
+            if isinstance(section_highlights, BaseException):
+                raise section_highlights
+        logging.debug("optimized_highlights=")
+        logging.debug(optimized_highlights)
+        logging.debug("---")
+        return optimized_highlights
+
+    pipeline.add_stage(
+        "optimized_highlights",
+        optimized_highlights_stage,
+        after=("position_summaries", "position_keywords"),
+        params={"tokens_per_highlight": tokens_per_highlight, "highlight_counts": section_highlight_counts},
     )
-    logging.debug(f"{assignment=}")
-    position_keywords = [
-        [
-            keywords[difficulty_sorted_keyword_indices[internal_index]]
-            for internal_index, resume_section_index in assignment
-            if resume_section_index == current_resume_section_index
-        ]
-        for current_resume_section_index in range(len(default_highlights))
-    ]
-    logging.info("position_keywords=")
-    logging.info(json.dumps(position_keywords, indent=4))
-    logging.info("---")
 
-    # Stage 6: Insert the keywords into the corresponding optimal summarized resume sections
-    n_experiences = len(default_highlights)
-    logging.debug("optimized_highlights=")
-    # Have to do a pool rather than run batch() on the chain because the chain itself must be changed depending on
-    # how many sections we have to return.
-    with Pool(n_experiences) as pool:
-        optimized_highlights = pool.starmap(
-            func=insert_keywords,
-            iterable=zip(
-                position_summaries,
-                position_keywords,
-                [[3, 3, 2][i] if i < 3 else 1 for i in range(n_experiences)],
-                [tokens_per_highlight] * n_experiences,
-            ),
+    # Stage 7: Verify that the highlights of each resume section contain the keywords assigned to it, and regenerate
+    # the highlights of the sections that don't with the missing keywords called out, rather than rerunning everything
+    async def verified_highlights_stage(
+        position_summaries: list[str], position_keywords: list[list[str]], optimized_highlights: list[list[str]]
+    ) -> dict[str, Any]:
+        def verify(i: int, highlights: list[str]) -> SectionCoverage:
+            return verify_section(
+                i,
+                position=default_highlights[i][0],
+                highlights=highlights,
+                position_keywords=position_keywords[i],
+                expected_highlight_count=section_highlight_counts[i],
+            )
+
+        async def verify_highlights(i: int) -> tuple[list[str], SectionCoverage]:
+            highlights, coverage = optimized_highlights[i], verify(i, optimized_highlights[i])
+            for attempt in range(1, verify_attempts + 1):
+                if coverage.passed:
+                    break
+                logging.debug(f"Regenerating the highlights of resume section {i+1}: {coverage.problems()}")
+                revised_highlights = await arevise_highlights(
+                    position_summaries[i],
+                    position_keywords[i],
+                    section_highlight_counts[i],
+                    tokens_per_highlight,
+                    highlights=highlights,
+                    problems=coverage.problems(),
+                )
+                revised_coverage = verify(i, revised_highlights)
+                # Keep the previous highlights if the revision is worse
+                if revised_coverage.n_problems <= coverage.n_problems:
+                    highlights, coverage = revised_highlights, revised_coverage
+                coverage.regenerations = attempt
+                emit("section_highlights", section=i, highlights=highlights)
+            return highlights, coverage
+
+        verified = await asyncio.gather(*(verify_highlights(i) for i in range(n_experiences)))
+        report = coverage_report([coverage for _highlights, coverage in verified])
+        for section in report["sections"]:
+            logging.info(
+                f"Resume section {section['section']+1}: "
+                f"{len(section['position_keywords']) - len(section['missing_keywords'])}/"
+                f"{len(section['position_keywords'])} keywords, "
+                f"{section['highlight_count']}/{section['expected_highlight_count']} highlights, "
+                f"{section['regenerations']} regenerations"
+            )
+        if not report["passed"]:
+            logging.warning(
+                "WARNING: Some resume sections are still missing keywords or have the wrong number of highlights after "
+                f"verification: {[section['section']+1 for section in report['sections'] if not section['passed']]}"
+            )
+        emit("coverage_report", report=report)
+        return {"highlights": [highlights for highlights, _coverage in verified], "report": report}
+
+    if verify_attempts is not None:
+        pipeline.add_stage(
+            "verified_highlights",
+            verified_highlights_stage,
+            after=("position_summaries", "position_keywords", "optimized_highlights"),
+            params={"verify_attempts": verify_attempts},
+        )
+    unknown_stages = set(regenerate) - set(pipeline.stages)
+    if len(unknown_stages) > 0:
+        raise ValueError(
+            f"Can't regenerate unknown stages {sorted(unknown_stages)}, the stages are {list(pipeline.stages)}."
+        )
+
+    precomputed_outputs = {}
+    if position_summaries is not None:
+        precomputed_outputs["position_summaries"] = position_summaries
+    if keywords is not None:
+        precomputed_outputs["keywords"] = keywords
+    if difficulties is not None:
+        precomputed_outputs["difficulties"] = difficulties
+    if manifest is not None:
+        precomputed_outputs["keywords"] = manifest["keywords"]
+        precomputed_outputs["difficulties"] = manifest["difficulties"]
+
+    def stage_complete(stage: str, output: Any) -> None:
+        emit("stage_complete", stage=stage)
+        if stage == "keywords":
+            emit("keywords", keywords=output)
+        elif stage == "position_keywords":
+            emit("assignment", position_keywords=output)
+
+    try:
+        outputs = await pipeline.run(
+            precomputed_outputs,
+            checkpoint=checkpoint,
+            on_stage_start=lambda stage: emit("stage_start", stage=stage),
+            on_stage_complete=stage_complete,
+        )
+    finally:
+        # Don't leave keyword batches being scored in the background if a stage failed, or if the stages that use the
+        # scores were loaded from a checkpoint
+        early_tasks = [task for _keyword_batch, task in early_difficulties + early_compatibilities]
+        for task in early_tasks:
+            task.cancel()
+        await asyncio.gather(*early_tasks, return_exceptions=True)
+
+    if use_posting_index and near_duplicate is None:
+        posting_index.add(
+            job_title=job_title,
+            job_description=job_description,
+            keywords=outputs["keywords"],
+            difficulties=outputs["difficulties"],
+            **_posting_models(),
+        )
+    final_highlights = (
+        outputs["verified_highlights"]["highlights"] if verify_attempts is not None else outputs["optimized_highlights"]
+    )
+    if incremental:
+        stage_cache.set_manifest(
+            job_hash=manifest_job_hash,
+            manifest={
+                "keywords": outputs["keywords"],
+                "difficulties": outputs["difficulties"],
+                "tokens_per_highlight": tokens_per_highlight,
+                "sections": [
+                    {
+                        "hash": section_hashes[i],
+                        "position_keywords": outputs["position_keywords"][i],
+                        "highlight_count": section_highlight_counts[i],
+                        "highlights": final_highlights[i],
+                    }
+                    for i in range(n_experiences)
+                ],
+            },
         )
-    logging.debug(optimized_highlights)
-    logging.debug("---")
 
     # Replace the highlights with the generated ones
     for i in range(n_experiences):
-        resume["work"][i]["highlights"] = optimized_highlights[i]
+        resume["work"][i]["highlights"] = final_highlights[i]
+    emit("done")
 
     return resume
+
+
+async def aoptimize_resume_batch(
+    *,
+    resume: dict[str, Any],
+    jobs: Iterable[dict[str, str]],
+    tokens_per_highlight: int,
+    max_workers: int = 4,
+    assign_engine: str = "min_cost_flow",
+    prefilter_threshold: Optional[float] = None,
+    stream_keywords: bool = False,
+    max_tokens_budget: Optional[int] = None,
+    verify_attempts: Optional[int] = None,
+    highlight_counts: Optional[list[int]] = None,
+    incremental: bool = False,
+    run_dir: Optional[str] = None,
+    resume_run: bool = False,
+    regenerate: Iterable[str] = (),
+    on_event: Optional[Callable[[dict[str, Any]], None]] = None,
+) -> AsyncIterator[tuple[dict[str, str], dict[str, Any]]]:
+    """Optimize the resume for each job and yield (job, optimized resume) pairs in order of completion.
+    Each job is a dict with 'job_title' and 'job_description' keys.
+    The resume-only work is done once up front, and at most max_workers jobs are optimized at the same time.
+    on_event gets the events of optimize_resume, with the 'id' of the job (if any) under "job".
+    The spans traced for each job have the 'id' of the job under "job", and each job is traced with the time it spent
+    waiting for a worker.
+    Jobs whose planned tokens don't fit into the token budget are skipped with a warning, and jobs that fail are
+    logged and skipped.
+    """
+    position_summaries = await asummarize_resume_sections(position_highlights=get_default_highlights(resume))
+    logging.debug("position_summaries=")
+    logging.debug(json.dumps(position_summaries, indent=4))
+    logging.debug("---")
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def optimize_job(job: dict[str, str]) -> Optional[tuple[dict[str, str], dict[str, Any]]]:
+        wait_start = time.perf_counter()
+        async with semaphore:
+            wait_ms = 1000 * (time.perf_counter() - wait_start)
+            with trace_context(job=job.get("id")), span("job", category="job", worker_wait_ms=round(wait_ms, 3)):
+                try:
+                    return job, await aoptimize_resume(
+                        resume=copy.deepcopy(resume),
+                        job_description=job["job_description"],
+                        job_title=job["job_title"],
+                        tokens_per_highlight=tokens_per_highlight,
+                        position_summaries=position_summaries,
+                        assign_engine=assign_engine,
+                        prefilter_threshold=prefilter_threshold,
+                        stream_keywords=stream_keywords,
+                        max_tokens_budget=max_tokens_budget,
+                        verify_attempts=verify_attempts,
+                        highlight_counts=highlight_counts,
+                        incremental=incremental,
+                        run_dir=run_dir,
+                        resume_run=resume_run,
+                        regenerate=regenerate,
+                        on_event=(lambda event: on_event({"job": job.get("id"), **event})) if on_event else None,
+                    )
+                except BudgetExceededError as error:
+                    logging.warning(f"Skipping the job {job.get('id')!r}: {error}")
+                    return None
+                except Exception:
+                    # One failing job shouldn't lose the outputs of the jobs still in flight
+                    logging.exception(f"Optimizing the resume for the job {job.get('id')!r} failed.")
+                    return None
+
+    for job_result in asyncio.as_completed([optimize_job(job) for job in jobs]):
+        result = await job_result
+        if result is not None:
+            yield result
+
+
+def keyword_coverage(resume: dict[str, Any], keywords: list[str]) -> tuple[float, list[str]]:
+    """Share of the keywords that appear in the work positions and highlights of the resume, and the keywords that
+    don't.
+    """
+    found_keyword_indices = KeywordIndex(keywords).find(
+        "\n".join(line for experience in resume["work"] for line in [experience["position"], *experience["highlights"]])
+    )
+    missing_keywords = [keyword for i, keyword in enumerate(keywords) if i not in found_keyword_indices]
+    return (1 - len(missing_keywords) / len(keywords) if len(keywords) > 0 else 1.0), missing_keywords
+
+
+async def aoptimize_resume_portfolio(
+    *,
+    resumes: list[dict[str, Any]],
+    job_description: str,
+    job_title: str,
+    tokens_per_highlight: int,
+    assign_engine: str = "min_cost_flow",
+    prefilter_threshold: Optional[float] = None,
+    verify_attempts: Optional[int] = None,
+    highlight_counts: Optional[list[int]] = None,
+    on_event: Optional[Callable[[dict[str, Any]], None]] = None,
+) -> list[dict[str, Any]]:
+    """Optimize each of the resume variants for the job, to pick the best one.
+    The job-only work (the keywords and their difficulties) is done once up front, or reused from a near-duplicate
+    posting in the posting index, and then all variants are optimized at the same time.
+    Returns {"resume": ..., "coverage": ..., "missing_keywords": [...]} for each variant in order, where coverage is the
+    share of the job's keywords that appear in the optimized resume, see keyword_coverage().
+    on_event gets the events of optimize_resume, with the index of the resume under "resume".
+    """
+    posting_index = get_posting_index()
+    near_duplicate = None
+    if posting_index is not None:
+        near_duplicate = posting_index.find(job_title=job_title, job_description=job_description, **_posting_models())
+    if near_duplicate is not None:
+        logging.info(
+            "Reusing the keywords and difficulties of a near-duplicate posting with a similarity of "
+            f"{near_duplicate.similarity:.2f}"
+        )
+        keywords, difficulties = near_duplicate.keywords, near_duplicate.difficulties
+    else:
+        keywords = await aextract_keywords(job_description=job_description, job_title=job_title)
+        difficulties = await aget_difficulties(job_description_keywords=keywords, job_title=job_title)
+        if posting_index is not None:
+            posting_index.add(
+                job_title=job_title,
+                job_description=job_description,
+                keywords=keywords,
+                difficulties=difficulties,
+                **_posting_models(),
+            )
+    if on_event is not None:
+        on_event({"event": "keywords", "keywords": keywords})
+
+    async def optimize_variant(i: int) -> dict[str, Any]:
+        with trace_context(resume=i), span("variant", category="portfolio") as attributes:
+            optimized_resume = await aoptimize_resume(
+                resume=copy.deepcopy(resumes[i]),
+                job_description=job_description,
+                job_title=job_title,
+                tokens_per_highlight=tokens_per_highlight,
+                keywords=keywords,
+                difficulties=difficulties,
+                assign_engine=assign_engine,
+                prefilter_threshold=prefilter_threshold,
+                verify_attempts=verify_attempts,
+                highlight_counts=highlight_counts,
+                on_event=(lambda event: on_event({"resume": i, **event})) if on_event else None,
+            )
+            coverage, missing_keywords = keyword_coverage(optimized_resume, keywords)
+            attributes["coverage"] = coverage
+            return {"resume": optimized_resume, "coverage": coverage, "missing_keywords": missing_keywords}
+
+    return await asyncio.gather(*(optimize_variant(i) for i in range(len(resumes))))
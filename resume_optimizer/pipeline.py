@@ -0,0 +1,89 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from .checkpoint import RunCheckpoint, stage_key
+from .trace import span
+
+
+class Pipeline:
+    """A dependency graph of async stages.
+    Each stage is an async function whose keyword arguments are the outputs of the stages it depends on.
+    Running the pipeline starts every stage as soon as all of its dependencies have finished, so the end-to-end
+    latency is that of the critical path rather than the sum of all stages.
+    """
+
+    def __init__(self) -> None:
+        self.stages: dict[str, tuple[Callable[..., Awaitable[Any]], tuple[str, ...]]] = {}
+        self.params: dict[str, dict[str, Any]] = {}
+
+    def add_stage(
+        self,
+        name: str,
+        func: Callable[..., Awaitable[Any]],
+        *,
+        after: tuple[str, ...] = (),
+        params: Optional[dict[str, Any]] = None,
+    ) -> None:
+        """Add a stage that runs func with the outputs of the stages listed in after.
+        Stages have to be added after their dependencies, which also rules out cycles.
+        params are the other values the output of the stage depends on, which are part of its checkpoint key.
+        """
+        if name in self.stages:
+            raise ValueError(f"Stage {name!r} already exists.")
+        unknown_stages = [dependency for dependency in after if dependency not in self.stages]
+        if len(unknown_stages) > 0:
+            raise ValueError(f"Stage {name!r} depends on unknown stages {unknown_stages}.")
+        self.stages[name] = (func, after)
+        self.params[name] = dict(params or {})
+
+    async def run(
+        self,
+        outputs: Optional[dict[str, Any]] = None,
+        *,
+        checkpoint: Optional[RunCheckpoint] = None,
+        on_stage_start: Optional[Callable[[str], None]] = None,
+        on_stage_complete: Optional[Callable[[str, Any], None]] = None,
+    ) -> dict[str, Any]:
+        """Run all stages and return their outputs by stage name.
+        Stages whose outputs are passed in are not run again.
+        With a checkpoint, the output of each stage is saved as soon as it finishes, and loaded back instead of running
+        the stage if it was saved with the same parameters and dependency outputs.
+        on_stage_start is called with the name of each stage once its dependencies have finished, and
+        on_stage_complete is called with the name and output of each stage as soon as the stage finishes.
+        Each stage is traced with the time it spent waiting for its dependencies.
+        """
+        outputs = dict(outputs or {})
+        tasks: dict[str, asyncio.Task] = {}
+
+        async def run_stage(name: str) -> None:
+            func, after = self.stages[name]
+            wait_start = time.perf_counter()
+            await asyncio.gather(*(tasks[dependency] for dependency in after if dependency in tasks))
+            wait_ms = 1000 * (time.perf_counter() - wait_start)
+            if on_stage_start is not None:
+                on_stage_start(name)
+            inputs = {dependency: outputs[dependency] for dependency in after}
+            with span(name, category="stage", wait_ms=round(wait_ms, 3)) as attributes:
+                if checkpoint is None:
+                    outputs[name] = await func(**inputs)
+                else:
+                    key = stage_key(self.params[name], inputs)
+                    found, outputs[name] = checkpoint.load(name, key=key)
+                    attributes["checkpoint_hit"] = found
+                    if not found:
+                        outputs[name] = await func(**inputs)
+                        checkpoint.save(name, outputs[name], key=key)
+            if on_stage_complete is not None:
+                on_stage_complete(name, outputs[name])
+
+        for name in self.stages:
+            if name not in outputs:
+                tasks[name] = asyncio.create_task(run_stage(name))
+        try:
+            await asyncio.gather(*tasks.values())
+        finally:
+            # Don't leave the remaining stages running in the background if one of the stages failed
+            for task in tasks.values():
+                task.cancel()
+        return outputs
@@ -0,0 +1,271 @@
+import functools
+import logging
+import math
+import re
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from .cache import normalize_keyword
+from .chains import (
+    EXTRACT_KEYWORDS_PROMPT,
+    INSERT_KEYWORDS_PROMPT,
+    KEYWORD_COMPATIBILITY_PROMPT,
+    KEYWORD_DIFFICULTY_PROMPT,
+    PACKED_KEYWORD_COMPATIBILITY_PROMPT,
+    REVISE_HIGHLIGHTS_PROMPT,
+    STAGE_MODEL_NAMES,
+    SUMMARIZE_RESUME_SECTION_PROMPT,
+    SUMMARY_MAX_TOKENS,
+    _compatibility_inputs,
+    _numbered_list,
+    _pack_compatibility_requests,
+    stage_model_name,
+)
+from .preprocess import get_job_description_preprocessor
+from .scheduler import estimate_tokens, get_scheduler
+from .verify import SectionCoverage
+
+# Seconds until the first token and seconds per generated token of each model, to estimate latencies with
+MODEL_LATENCIES = {
+    "gpt-4": {"seconds_per_call": 1.0, "seconds_per_token": 0.05},
+    "gpt-3.5-turbo": {"seconds_per_call": 0.5, "seconds_per_token": 0.015},
+}
+DEFAULT_MODEL_LATENCY = MODEL_LATENCIES["gpt-4"]
+# Words of job description per extracted keyword, to estimate the number of keywords before they're extracted
+WORDS_PER_KEYWORD = 15
+# Least tokens per highlight that fit_to_budget() shrinks jobs to
+MIN_TOKENS_PER_HIGHLIGHT = 20
+
+
+class BudgetExceededError(ValueError):
+    """The planned tokens of an optimization exceed the token budget, even with the fewest tokens per highlight."""
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model: str) -> Any:
+    """tiktoken encoding of the model, or None if it isn't available, e.g. offline before it was ever downloaded."""
+    try:
+        import tiktoken
+
+        return tiktoken.encoding_for_model(model)
+    except Exception as exception:
+        logging.debug(f"Estimating the tokens of {model} without a tokenizer after {type(exception).__name__}")
+        return None
+
+
+def count_tokens(text: str, *, model: str) -> int:
+    """Tokens of the text for the model, with the model's tokenizer if available and estimate_tokens() otherwise."""
+    encoding = _encoding(model)
+    return len(encoding.encode(text)) if encoding is not None else estimate_tokens(text)
+
+
+@dataclass
+class StagePlan:
+    stage: str
+    model: str
+    requests: int = 0
+    prompt_tokens: int = 0
+    # At most, for stages with max_tokens
+    completion_tokens: int = 0
+    # Seconds of each request
+    request_latencies: list[float] = field(default_factory=list)
+    # Rounds the requests are sent in one after another, e.g. the attempts of regenerating highlights
+    rounds: int = 1
+
+    def add_request(self, prompt: str, *, completion_tokens: int) -> None:
+        latency = MODEL_LATENCIES.get(self.model, DEFAULT_MODEL_LATENCY)
+        self.requests += 1
+        self.prompt_tokens += count_tokens(prompt, model=self.model)
+        self.completion_tokens += completion_tokens
+        self.request_latencies.append(latency["seconds_per_call"] + latency["seconds_per_token"] * completion_tokens)
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def latency(self) -> float:
+        """Seconds the stage takes with its requests sent in waves of the scheduler's maximum concurrency."""
+        if len(self.request_latencies) == 0:
+            return 0.0
+        round_requests = math.ceil(len(self.request_latencies) / self.rounds)
+        return max(self.request_latencies) * self.rounds * math.ceil(round_requests / get_scheduler().max_concurrency)
+
+
+@dataclass
+class RunPlan:
+    """Planned LLM requests of an optimization, by stage."""
+
+    stages: dict[str, StagePlan]
+    tokens_per_highlight: int
+    # Whether the number of keywords is estimated rather than that of the given keywords
+    estimated_keywords: bool
+
+    @property
+    def tokens(self) -> int:
+        return sum(stage.tokens for stage in self.stages.values())
+
+    @property
+    def latency(self) -> float:
+        """Seconds of the critical path of the stages, which run at the same time where they don't depend on each
+        other.
+        """
+        latencies = {name: stage.latency for name, stage in self.stages.items()}
+        return (
+            max(latencies.get("extract_keywords", 0.0), latencies.get("summarize_resume_sections", 0.0))
+            + max(latencies.get("get_difficulties", 0.0), latencies.get("get_compatibility", 0.0))
+            + latencies.get("insert_keywords", 0.0)
+            + latencies.get("verify_regenerations", 0.0)
+        )
+
+    def rows(self) -> list[dict[str, Any]]:
+        return [
+            {
+                "stage": stage.stage,
+                "model": stage.model,
+                "requests": stage.requests,
+                "prompt_tokens": stage.prompt_tokens,
+                "completion_tokens": stage.completion_tokens,
+                "latency_s": round(stage.latency, 1),
+            }
+            for stage in self.stages.values()
+        ]
+
+
+def _placeholder_keywords(job_description: str) -> list[str]:
+    """Stand-ins for the keywords of the job description before they're extracted."""
+    n_keywords = min(60, max(5, len(re.findall(r"\w+", job_description)) // WORDS_PER_KEYWORD))
+    return [f"Keyword {i}" for i in range(1, n_keywords + 1)]
+
+
+def _placeholder_highlights(highlight_count: int, *, tokens_per_highlight: int) -> str:
+    """Stand-in for the Markdown list of generated highlights, of about tokens_per_highlight tokens per highlight."""
+    return "\n".join(f"-{' tok' * (tokens_per_highlight - 1)}" for _ in range(highlight_count))
+
+
+def plan_optimization(
+    *,
+    position_highlights: list[tuple[str, str]],
+    job_description: str,
+    job_title: str,
+    tokens_per_highlight: int,
+    highlight_counts: list[int],
+    keywords: Optional[list[str]] = None,
+    difficulties: Optional[list[int]] = None,
+    position_summaries: Optional[list[str]] = None,
+    summarize: bool = True,
+    verify_attempts: Optional[int] = None,
+) -> RunPlan:
+    """Plan the LLM requests of optimizing the (position, highlights) resume sections for the job, without sending any.
+    The prompts are the actual prompts of the chains, with the given keywords and position summaries, or with stand-ins
+    for them if they aren't known yet: WORDS_PER_KEYWORD words of job description per keyword, and the highlights of
+    each resume section for its summary. Keywords and summaries that are given aren't planned for, and neither are
+    summaries without summarize.
+    With verify_attempts, the highlights of every resume section are planned to be regenerated verify_attempts times,
+    under the "verify_regenerations" stage.
+    The plan is an upper bound: it doesn't know about the LLM and stage caches or the keywords found verbatim in the
+    resume, it counts the completions of the summaries and highlights at their max_tokens, and it counts every
+    regeneration that verification may need.
+    With a job description preprocessor, the keyword extraction is planned with the preprocessed job description.
+    """
+    preprocessor = get_job_description_preprocessor()
+    if preprocessor is not None and keywords is None:
+        job_description = preprocessor.preprocess(job_description, model=stage_model_name("extract_keywords")).text
+    planned_keywords = keywords if keywords is not None else _placeholder_keywords(job_description)
+    n_sections = len(position_highlights)
+    stages = {stage: StagePlan(stage=stage, model=stage_model_name(stage)) for stage in STAGE_MODEL_NAMES}
+    if keywords is None:
+        stages["extract_keywords"].add_request(
+            EXTRACT_KEYWORDS_PROMPT.format(job_description=job_description, job_title=job_title),
+            completion_tokens=count_tokens(_numbered_list(planned_keywords), model=stages["extract_keywords"].model),
+        )
+    if position_summaries is None and summarize:
+        for position, highlights in position_highlights:
+            stages["summarize_resume_sections"].add_request(
+                SUMMARIZE_RESUME_SECTION_PROMPT.format(position=position, highlights=highlights),
+                completion_tokens=SUMMARY_MAX_TOKENS,
+            )
+    if difficulties is None:
+        stages["get_difficulties"].add_request(
+            KEYWORD_DIFFICULTY_PROMPT.format(
+                job_title=job_title,
+                numbered_job_description_keywords=_numbered_list(planned_keywords),
+                n_keywords=len(planned_keywords),
+            ),
+            completion_tokens=count_tokens(
+                _numbered_list(["1"] * len(planned_keywords)), model=stages["get_difficulties"].model
+            ),
+        )
+    all_keywords = {normalize_keyword(keyword): keyword for keyword in planned_keywords}
+    for section_indices, request_keywords in _pack_compatibility_requests(
+        [all_keywords] * n_sections, position_highlights
+    ):
+        prompt = KEYWORD_COMPATIBILITY_PROMPT if len(section_indices) == 1 else PACKED_KEYWORD_COMPATIBILITY_PROMPT
+        section_scores = _numbered_list(["1"] * len(request_keywords))
+        if len(section_indices) > 1:
+            section_scores = "\n".join(f"Section {j}:\n{section_scores}" for j in range(1, len(section_indices) + 1))
+        stages["get_compatibility"].add_request(
+            prompt.format(**_compatibility_inputs(section_indices, request_keywords, position_highlights)),
+            completion_tokens=count_tokens(section_scores, model=stages["get_compatibility"].model),
+        )
+    keywords_per_section = math.ceil(len(planned_keywords) / max(1, n_sections))
+    if verify_attempts:
+        stages["verify_regenerations"] = StagePlan(
+            stage="verify_regenerations", model=stage_model_name("insert_keywords"), rounds=verify_attempts
+        )
+    for i, (_position, highlights) in enumerate(position_highlights):
+        insert_inputs = {
+            "position_summary": position_summaries[i] if position_summaries is not None else highlights,
+            "position_keywords": planned_keywords[i * keywords_per_section : (i + 1) * keywords_per_section],
+            "highlight_count": highlight_counts[i],
+        }
+        stages["insert_keywords"].add_request(
+            INSERT_KEYWORDS_PROMPT.format(**insert_inputs),
+            completion_tokens=tokens_per_highlight * highlight_counts[i],
+        )
+        # At worst, every attempt regenerates highlights of max_tokens that miss all keywords and have the wrong count
+        problems = SectionCoverage(
+            section=i,
+            position_keywords=insert_inputs["position_keywords"],
+            missing_keywords=insert_inputs["position_keywords"],
+            highlight_count=0,
+            expected_highlight_count=highlight_counts[i],
+        ).problems()
+        for _attempt in range(verify_attempts or 0):
+            stages["verify_regenerations"].add_request(
+                REVISE_HIGHLIGHTS_PROMPT.format(
+                    **insert_inputs,
+                    highlights=_placeholder_highlights(highlight_counts[i], tokens_per_highlight=tokens_per_highlight),
+                    problems=problems,
+                ),
+                completion_tokens=tokens_per_highlight * highlight_counts[i],
+            )
+    return RunPlan(
+        stages={stage: stage_plan for stage, stage_plan in stages.items() if stage_plan.requests > 0},
+        tokens_per_highlight=tokens_per_highlight,
+        estimated_keywords=keywords is None,
+    )
+
+
+def fit_to_budget(*, max_tokens_budget: int, tokens_per_highlight: int, **plan_kwargs: Any) -> RunPlan:
+    """Plan the optimization with the most tokens per highlight, up to the given ones and down to
+    MIN_TOKENS_PER_HIGHLIGHT, whose planned tokens are within the budget. See plan_optimization() for the arguments.
+    Raises BudgetExceededError if there are none.
+    """
+    plan = plan_optimization(tokens_per_highlight=tokens_per_highlight, **plan_kwargs)
+    if plan.tokens <= max_tokens_budget:
+        return plan
+    # The planned tokens grow by the number of highlights with each token per highlight, plus twice that for each
+    # verification attempt, whose prompt also has the highlights it regenerates
+    n_highlights = sum(plan_kwargs["highlight_counts"]) * (1 + 2 * (plan_kwargs.get("verify_attempts") or 0))
+    fitting_tokens_per_highlight = tokens_per_highlight - math.ceil((plan.tokens - max_tokens_budget) / n_highlights)
+    if fitting_tokens_per_highlight < MIN_TOKENS_PER_HIGHLIGHT:
+        raise BudgetExceededError(
+            f"The optimization is planned to take {plan.tokens} tokens, over the budget of {max_tokens_budget} tokens "
+            f"even with {MIN_TOKENS_PER_HIGHLIGHT} tokens per highlight."
+        )
+    logging.warning(
+        f"Shrinking the tokens per highlight from {tokens_per_highlight} to {fitting_tokens_per_highlight} to fit the "
+        f"optimization planned to take {plan.tokens} tokens into the budget of {max_tokens_budget} tokens"
+    )
+    return plan_optimization(tokens_per_highlight=fitting_tokens_per_highlight, **plan_kwargs)
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+from .keywords import job_title_family
+from .match import tokenize
+
+# Tokens per shingle. Short shingles keep small wording changes from changing much of a posting's shingles.
+SHINGLE_SIZE = 3
+# The MinHash signature of a posting is split into bands of rows, and postings that share a band are candidate
+# duplicates. 16 bands of 8 rows find 95% of the postings with a similarity of 0.8 and 5% of those with 0.5.
+MINHASH_BANDS = 16
+MINHASH_ROWS = 8
+MINHASH_SEED = 338598
+# Seeds of the hash functions that stand in for random permutations of the shingles
+_MINHASH_SEEDS = np.random.default_rng(MINHASH_SEED).integers(
+    0, np.iinfo(np.uint64).max, size=MINHASH_BANDS * MINHASH_ROWS, dtype=np.uint64
+)
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer, a bijection of 64-bit integers that scrambles all bits. Overflows wrap around."""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def minhash_signature(text: str) -> Optional[np.ndarray]:
+    """MinHash signature of the token shingles of the text, or None for texts without tokens."""
+    tokens = tokenize(text)
+    if len(tokens) == 0:
+        return None
+    shingles = {" ".join(tokens[i : i + SHINGLE_SIZE]) for i in range(max(1, len(tokens) - SHINGLE_SIZE + 1))}
+    shingle_hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "little") for shingle in shingles],
+        dtype=np.uint64,
+    )
+    return _mix(shingle_hashes[:, np.newaxis] ^ _MINHASH_SEEDS).min(axis=0)
+
+
+def _bands(signature: np.ndarray) -> list[tuple[int, str]]:
+    return [
+        (band, hashlib.sha1(signature[band * MINHASH_ROWS : (band + 1) * MINHASH_ROWS].tobytes()).hexdigest())
+        for band in range(MINHASH_BANDS)
+    ]
+
+
+@dataclass
+class NearDuplicate:
+    # Estimated Jaccard similarity of the shingles of the postings
+    similarity: float
+    keywords: list[str]
+    difficulties: list[int]
+
+
+class PostingIndex:
+    """SQLite index of the keywords and difficulties of previously processed postings, by MinHash signature of the job
+    description with LSH buckets, so that reposts with small wording changes reuse them instead of extracting and
+    estimating them again.
+    Postings are near-duplicates if the estimated similarity of their job descriptions is at least the threshold, their
+    job titles are of the same family (see job_title_family()), and their keywords and difficulties came from the same
+    models.
+    """
+
+    def __init__(self, database_path: str = ".resume_optimizer.db", *, threshold: float = 0.8) -> None:
+        self.database_path = database_path
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(database_path, timeout=60, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS posting (
+                    id INTEGER PRIMARY KEY, job_title_family TEXT, keywords_model TEXT, difficulties_model TEXT,
+                    signature BLOB, keywords TEXT, difficulties TEXT
+                );
+                CREATE TABLE IF NOT EXISTS posting_band (
+                    band INTEGER, bucket TEXT, posting_id INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS posting_band_bucket ON posting_band (band, bucket);
+                """
+            )
+
+    def find(
+        self, *, job_title: str, job_description: str, keywords_model: str, difficulties_model: str
+    ) -> Optional[NearDuplicate]:
+        """Return the most similar near-duplicate of the posting, if any."""
+        signature = minhash_signature(job_description)
+        if signature is None:
+            return None
+        with self._lock:
+            candidates = {
+                posting_id: row
+                for band, bucket in _bands(signature)
+                for posting_id, *row in self._connection.execute(
+                    "SELECT posting.id, posting.signature, posting.keywords, posting.difficulties FROM posting_band "
+                    "JOIN posting ON posting.id = posting_band.posting_id WHERE band = ? AND bucket = ? AND "
+                    "job_title_family = ? AND keywords_model = ? AND difficulties_model = ?",
+                    (band, bucket, job_title_family(job_title), keywords_model, difficulties_model),
+                )
+            }
+        near_duplicates = [
+            NearDuplicate(
+                similarity=float((np.frombuffer(candidate_signature, dtype=np.uint64) == signature).mean()),
+                keywords=json.loads(keywords),
+                difficulties=json.loads(difficulties),
+            )
+            for candidate_signature, keywords, difficulties in candidates.values()
+        ]
+        return max(
+            (near_duplicate for near_duplicate in near_duplicates if near_duplicate.similarity >= self.threshold),
+            key=lambda near_duplicate: near_duplicate.similarity,
+            default=None,
+        )
+
+    def add(
+        self,
+        *,
+        job_title: str,
+        job_description: str,
+        keywords: list[str],
+        difficulties: list[int],
+        keywords_model: str,
+        difficulties_model: str,
+    ) -> None:
+        signature = minhash_signature(job_description)
+        if signature is None:
+            return
+        with self._lock, self._connection:
+            posting_id = self._connection.execute(
+                "INSERT INTO posting (job_title_family, keywords_model, difficulties_model, signature, keywords, "
+                "difficulties) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    job_title_family(job_title),
+                    keywords_model,
+                    difficulties_model,
+                    signature.tobytes(),
+                    json.dumps(keywords),
+                    json.dumps(difficulties),
+                ),
+            ).lastrowid
+            self._connection.executemany(
+                "INSERT INTO posting_band VALUES (?, ?, ?)",
+                [(band, bucket, posting_id) for band, bucket in _bands(signature)],
+            )
+
+
+_posting_index: Optional[PostingIndex] = None
+
+
+def set_posting_index(posting_index: Optional[PostingIndex]) -> None:
+    """Set the index of the keywords and difficulties of previous postings, or disable it with None."""
+    global _posting_index
+    _posting_index = posting_index
+
+
+def get_posting_index() -> Optional[PostingIndex]:
+    return _posting_index
@@ -0,0 +1,74 @@
+import itertools
+import re
+import zlib
+from typing import Iterable
+
+import numpy as np
+
+# Compatibility of the (resume section, keyword) cells that the prefilter isn't confident about
+UNCERTAIN = -1
+# Thresholds that prefilter_report() counts the skipped cells of
+REPORT_THRESHOLDS = (0.0, 0.1, 0.2, 0.3, 0.4)
+
+
+def _ngram_hashes(text: str, *, n: int = 3) -> list[int]:
+    """Hashes of the character n-grams of the words of the text, padded with spaces so that n-grams at word boundaries
+    are told apart, e.g. "Java" doesn't fully match "JavaScript".
+    """
+    hashes = []
+    for word in re.findall(r"\w+", text.lower()):
+        padded = f" {word} "
+        hashes += [zlib.crc32(padded[i : i + n].encode()) for i in range(max(1, len(padded) - n + 1))]
+    return hashes
+
+
+def _ngram_counts(texts: list[str]) -> np.ndarray:
+    """Matrix of the counts of each n-gram (column) in each text (row)."""
+    text_hashes = [_ngram_hashes(text) for text in texts]
+    rows = np.repeat(np.arange(len(texts)), [len(hashes) for hashes in text_hashes])
+    _ngrams, columns = np.unique(
+        np.array(list(itertools.chain.from_iterable(text_hashes)), dtype=np.int64), return_inverse=True
+    )
+    counts = np.zeros((len(texts), columns.max(initial=-1) + 1), dtype=np.float32)
+    np.add.at(counts, (rows, columns), 1)
+    return counts
+
+
+def keyword_similarity(keywords: list[str], sections: list[str]) -> np.ndarray:
+    """Similarity from 0 to 1 of each (section, keyword) cell: the TF-IDF weighted share of the character n-grams of the
+    keyword that also appear in the section, with IDF computed over the sections.
+    """
+    counts = _ngram_counts(keywords + sections)
+    keyword_counts, section_present = counts[: len(keywords)], counts[len(keywords) :] > 0
+    idf = np.log((1 + len(sections)) / (1 + section_present.sum(axis=0))) + 1
+    weights = keyword_counts * idf
+    totals = weights.sum(axis=1)
+    return (section_present.astype(np.float32) @ weights.T) / np.where(totals > 0, totals, 1)
+
+
+def check_threshold(threshold: float) -> None:
+    """Raise ValueError unless 0 <= threshold < 0.5. From 0.5 on, the cells that are confidently compatible and
+    incompatible overlap, and no cell is left to the LLM.
+    """
+    if not 0 <= threshold < 0.5:
+        raise ValueError(f"The prefilter threshold must be at least 0 and less than 0.5, not {threshold}.")
+
+
+def confident_compatibility(similarity: np.ndarray, *, threshold: float) -> np.ndarray:
+    """Compatibility 0 for the cells with similarity up to the threshold, 2 for the cells with similarity of at least
+    1 minus the threshold, and UNCERTAIN for the rest. Higher thresholds skip more LLM calls at the cost of accuracy.
+    See check_threshold() for the valid thresholds.
+    """
+    check_threshold(threshold)
+    compatibility = np.full(similarity.shape, UNCERTAIN, dtype=np.int8)
+    compatibility[similarity <= threshold] = 0
+    compatibility[similarity >= 1 - threshold] = 2
+    return compatibility
+
+
+def prefilter_report(similarity: np.ndarray, thresholds: Iterable[float] = REPORT_THRESHOLDS) -> dict[float, int]:
+    """Number of cells that each threshold would set without asking the LLM."""
+    return {
+        threshold: int((confident_compatibility(similarity, threshold=threshold) != UNCERTAIN).sum())
+        for threshold in thresholds
+    }
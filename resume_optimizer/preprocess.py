@@ -0,0 +1,152 @@
+import re
+import unicodedata
+from dataclasses import dataclass
+from typing import Optional
+
+# Regular expressions of the boilerplate of job postings, matched case-insensitively against each line:
+# - "lines": navigation and UI text copied along with the posting, matching whole lines
+# - "statements": legal and HR statements, matching anywhere in a sentence
+# - "sections": headings of sections that are all boilerplate, matching whole lines with or without a colon. The
+#   section runs until the next heading, or the next blank line after its first line.
+DEFAULT_BOILERPLATE_PATTERNS = {
+    "lines": [
+        r"(easy )?apply( now| for this job)?",
+        r"save( job| this job)?",
+        r"share( this job)?",
+        r"(sign|log) in( to apply)?",
+        r"back to (search )?results",
+        r"skip to (main )?content",
+        r"report (this )?job",
+        r"show (more|less)",
+        r"see (more|less)",
+        r"(promoted|actively recruiting|be an early applicant)",
+        r"(over )?\d+ applicants?",
+        r"(posted|reposted) .* ago",
+    ],
+    "statements": [
+        r"equal (employment )?opportunity",
+        r"without regard to (race|age|sex|gender|color|religion)",
+        r"reasonable accommodations?",
+        r"e-verify",
+        r"affirmative action",
+        r"(applicant|candidate) privacy (notice|policy)",
+        r"we do not accept (unsolicited )?(resumes|applications) from (agencies|recruiters)",
+    ],
+    "sections": [
+        r"(our |the )?(benefits|perks)( (and|&) (benefits|perks))?",
+        r"what we offer",
+        r"why (join|work (for|with)) us\??",
+        r"(compensation|pay|salary) (and|&) benefits",
+        r"(equal (employment )?opportunity|eeo)( employer| statement)?",
+    ],
+}
+
+# Zero-width and non-breaking characters that pasted postings are full of
+INVISIBLE_CHARACTERS = str.maketrans({"\u200b": "", "\u200c": "", "\u200d": "", "\ufeff": "", "\xa0": " "})
+SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?])\s+")
+# Lines that look like headings of the next section of a posting rather than list items or sentences: short and ending
+# with a colon, or up to 5 words starting with a capital letter and without punctuation, like "About You"
+HEADING_PATTERN = re.compile(r"^(?![-*•·]|\d+[.)] )(?:.{1,60}:|[A-Z][^\s.,;:!?]*(?: [^\s.,;:!?]+){0,4}\??)$")
+
+
+@dataclass
+class PreprocessedJobDescription:
+    text: str
+    duplicate_lines: int
+    boilerplate_lines: int
+    boilerplate_sentences: int
+    tokens_before: int
+    tokens_after: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+
+class JobDescriptionPreprocessor:
+    """Local cleanup of a job description before its keywords are extracted: whitespace is normalized, and duplicate
+    lines and boilerplate are dropped. patterns extend the DEFAULT_BOILERPLATE_PATTERNS of each kind.
+    """
+
+    def __init__(self, patterns: Optional[dict[str, list[str]]] = None) -> None:
+        unknown_kinds = set(patterns or {}) - set(DEFAULT_BOILERPLATE_PATTERNS)
+        if len(unknown_kinds) > 0:
+            raise ValueError(
+                f"Unknown kinds of boilerplate patterns {sorted(unknown_kinds)}, the kinds are "
+                f"{list(DEFAULT_BOILERPLATE_PATTERNS)}."
+            )
+        self.patterns = {
+            kind: [*kind_patterns, *(patterns or {}).get(kind, [])]
+            for kind, kind_patterns in DEFAULT_BOILERPLATE_PATTERNS.items()
+        }
+        self._line_pattern = re.compile("|".join(f"(?:{pattern})" for pattern in self.patterns["lines"]), re.I)
+        self._statement_pattern = re.compile(
+            "|".join(f"(?:{pattern})" for pattern in self.patterns["statements"]), re.I
+        )
+        self._section_pattern = re.compile("|".join(f"(?:{pattern})" for pattern in self.patterns["sections"]), re.I)
+
+    def preprocess(self, job_description: str, *, model: str) -> PreprocessedJobDescription:
+        """Clean up the job description, counting the tokens it takes for the model before and after."""
+        # Imported here since the planner imports the chains, which import this module
+        from .planner import count_tokens
+
+        lines = []
+        seen_lines = set()
+        duplicate_lines = boilerplate_lines = boilerplate_sentences = 0
+        in_boilerplate_section = False
+        # Whether the last line was the heading of a boilerplate section, whose list may follow after a blank line
+        after_boilerplate_heading = False
+        for line in unicodedata.normalize("NFC", job_description).translate(INVISIBLE_CHARACTERS).splitlines():
+            line = re.sub(r"\s+", " ", line).strip()
+            # Compare lines without their list markers and punctuation, so that e.g. the same bullet point with a
+            # different bullet character is a duplicate
+            key = re.sub(r"\W+", " ", line).strip().casefold()
+            heading = line.rstrip(":").strip()
+            if len(key) == 0:
+                in_boilerplate_section = in_boilerplate_section and after_boilerplate_heading
+                if len(lines) > 0 and lines[-1] != "":
+                    lines.append("")
+                continue
+            after_boilerplate_heading = bool(self._section_pattern.fullmatch(heading))
+            if after_boilerplate_heading:
+                in_boilerplate_section = True
+            elif HEADING_PATTERN.match(line):
+                in_boilerplate_section = False
+            if in_boilerplate_section or self._line_pattern.fullmatch(heading):
+                boilerplate_lines += 1
+                continue
+            if self._statement_pattern.search(line):
+                sentences = SENTENCE_END_PATTERN.split(line)
+                kept_sentences = [sentence for sentence in sentences if not self._statement_pattern.search(sentence)]
+                boilerplate_sentences += len(sentences) - len(kept_sentences)
+                line = " ".join(kept_sentences)
+                key = re.sub(r"\W+", " ", line).strip().casefold()
+                if len(key) == 0:
+                    continue
+            if key in seen_lines:
+                duplicate_lines += 1
+            else:
+                seen_lines.add(key)
+                lines.append(line)
+        text = "\n".join(lines).strip()
+        return PreprocessedJobDescription(
+            text=text,
+            duplicate_lines=duplicate_lines,
+            boilerplate_lines=boilerplate_lines,
+            boilerplate_sentences=boilerplate_sentences,
+            tokens_before=count_tokens(job_description, model=model),
+            tokens_after=count_tokens(text, model=model),
+        )
+
+
+_job_description_preprocessor: Optional[JobDescriptionPreprocessor] = None
+
+
+def set_job_description_preprocessor(job_description_preprocessor: Optional[JobDescriptionPreprocessor]) -> None:
+    """Set the preprocessor of the job descriptions whose keywords are extracted, or disable it with None."""
+    global _job_description_preprocessor
+    _job_description_preprocessor = job_description_preprocessor
+
+
+def get_job_description_preprocessor() -> Optional[JobDescriptionPreprocessor]:
+    return _job_description_preprocessor
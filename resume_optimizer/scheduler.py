@@ -0,0 +1,178 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from .trace import span
+
+T = TypeVar("T")
+
+# Lower priorities go first. The keyword extraction -> compatibility -> keyword insertion chain is the critical path of
+# optimize_resume, while difficulties and summaries have slack. Keyword insertion goes first of all so that jobs that
+# are almost done finish before new ones start.
+STAGE_PRIORITIES = {
+    "insert_keywords": 0,
+    "extract_keywords": 1,
+    "get_compatibility": 1,
+    "get_difficulties": 2,
+    "summarize_resume_sections": 2,
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of English text, at about 4 characters per token."""
+    return max(1, len(text) // 4)
+
+
+class TokenBucket:
+    """Token bucket that refills at `per_minute` tokens per minute up to a burst of a minute's worth of tokens."""
+
+    def __init__(self, per_minute: float) -> None:
+        self.per_minute = per_minute
+        self.tokens = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.per_minute, self.tokens + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+
+    async def acquire(self, amount: float) -> None:
+        """Wait until the amount of tokens is available and take it. Amounts over the burst wait for a full bucket."""
+        amount = min(amount, self.per_minute)
+        self._refill()
+        while self.tokens < amount:
+            await asyncio.sleep((amount - self.tokens) * 60 / self.per_minute)
+            self._refill()
+        self.tokens -= amount
+
+
+def _retry_after(exception: BaseException) -> Optional[float]:
+    """Seconds to wait before retrying the failed request, or None if it shouldn't be retried."""
+    import openai
+
+    if isinstance(exception, (openai.RateLimitError, openai.InternalServerError)):
+        retry_after = exception.response.headers.get("retry-after")
+        try:
+            return float(retry_after) if retry_after is not None else 0.0
+        except ValueError:
+            return 0.0
+    if isinstance(exception, (openai.APITimeoutError, openai.APIConnectionError, asyncio.TimeoutError)):
+        return 0.0
+    return None
+
+
+class Scheduler:
+    """Runs the LLM requests of the chains within the requests per minute (rpm) and tokens per minute (tpm) limits of
+    each model, with at most max_concurrency requests in flight, highest priority first.
+    Requests that fail with rate limit or transient errors are retried with full-jitter exponential backoff, waiting at
+    least as long as the Retry-After header asks for, without holding a concurrency slot while they wait.
+    """
+
+    def __init__(
+        self,
+        *,
+        rate_limits: Optional[dict[str, dict[str, float]]] = None,
+        max_concurrency: int = 16,
+        max_retries: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._request_buckets = {
+            model: TokenBucket(limits["rpm"]) for model, limits in (rate_limits or {}).items() if "rpm" in limits
+        }
+        self._token_buckets = {
+            model: TokenBucket(limits["tpm"]) for model, limits in (rate_limits or {}).items() if "tpm" in limits
+        }
+        self._running = 0
+        # Heap of (priority, arrival order, future) of the requests waiting for a concurrency slot
+        self._waiting: list[tuple[int, int, asyncio.Future]] = []
+        self._arrivals = itertools.count()
+
+    async def _acquire_slot(self, priority: int) -> None:
+        if self._running < self.max_concurrency and len(self._waiting) == 0:
+            self._running += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._arrivals), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Pass the slot on if it was handed over just as the wait was cancelled
+            if future.done() and not future.cancelled():
+                self._release_slot()
+            raise
+
+    def _release_slot(self) -> None:
+        while self._waiting:
+            _priority, _arrival, future = heapq.heappop(self._waiting)
+            if not future.done():
+                # The slot goes straight to the waiting request, so the running count stays the same
+                future.set_result(None)
+                return
+        self._running -= 1
+
+    async def run(
+        self,
+        request: Callable[[], Awaitable[T]],
+        *,
+        stage: str,
+        model: str,
+        estimated_tokens: int,
+        priority: Optional[int] = None,
+    ) -> T:
+        """Run the request once a concurrency slot and the model's rate limits allow, retrying transient failures.
+        Priority defaults to that of the stage in STAGE_PRIORITIES.
+        """
+        priority = STAGE_PRIORITIES.get(stage, 1) if priority is None else priority
+        with span("request", category="scheduler", stage=stage, model=model, priority=priority) as attributes:
+            wait_start = time.perf_counter()
+            await self._acquire_slot(priority)
+            holds_slot = True
+            try:
+                for attempt in range(self.max_retries + 1):
+                    if model in self._request_buckets:
+                        await self._request_buckets[model].acquire(1)
+                    if model in self._token_buckets:
+                        await self._token_buckets[model].acquire(estimated_tokens)
+                    attributes["wait_ms"] = round(1000 * (time.perf_counter() - wait_start), 3)
+                    attributes["retries"] = attempt
+                    try:
+                        return await request()
+                    except Exception as exception:
+                        retry_after = _retry_after(exception)
+                        if retry_after is None or attempt == self.max_retries:
+                            raise
+                        delay = max(retry_after, random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt)))
+                        logging.warning(
+                            f"Retrying the {stage} request in {delay:.1f} seconds after {type(exception).__name__}"
+                        )
+                        # Ready requests can use the slot while this one backs off
+                        self._release_slot()
+                        holds_slot = False
+                        await asyncio.sleep(delay)
+                        await self._acquire_slot(priority)
+                        holds_slot = True
+            finally:
+                if holds_slot:
+                    self._release_slot()
+
+
+_scheduler = Scheduler()
+
+
+def set_scheduler(scheduler: Scheduler) -> None:
+    """Set the scheduler that all LLM requests of the chains go through."""
+    global _scheduler
+    _scheduler = scheduler
+
+
+def get_scheduler() -> Scheduler:
+    return _scheduler
@@ -0,0 +1,264 @@
+"""Long-running optimizer service over HTTP on a TCP port or a Unix socket.
+
+The chat models, their HTTP connection pool, and the caches stay warm between requests, and jobs are run concurrently
+in a single event loop. Endpoints:
+- POST /optimize with a JSON body {"resume": ..., "job_title": ..., "job_description": ...} and optionally
+  "tokens_per_highlight", "assign_engine", "prefilter_threshold", "verify_attempts", "highlight_counts",
+  "incremental" and "stream".
+  Responds with {"resume": ...}, or with "stream" with the progress events of optimize_resume as newline-delimited JSON
+  followed by {"event": "result", "resume": ...}.
+  Responds with 503 when the queue is full.
+- GET /health responds with the number of queued and running jobs.
+"""
+
+import asyncio
+import json
+import logging
+from http import HTTPStatus
+from typing import Any, Optional
+
+from .assign import ENGINES
+from .chains import ChatModelFactory, openai_chat_model
+from .optimize import aoptimize_resume
+from .prefilter import check_threshold
+
+# (method, path, lowercased headers, body)
+Request = tuple[str, str, dict[str, str], bytes]
+
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Request]:
+    """Read an HTTP/1.1 request with a Content-Length body, or return None if the client closed the connection.
+    Raises ValueError for a malformed request line or Content-Length.
+    """
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, target, _version = request_line.decode("latin-1").split()
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, target.partition("?")[0], headers, body
+
+
+def write_response(
+    writer: asyncio.StreamWriter,
+    status: HTTPStatus,
+    body: Any,
+    *,
+    content_type: str = "application/json",
+    headers: Optional[dict[str, str]] = None,
+) -> None:
+    """Write a complete response. Bodies that aren't bytes are sent as JSON."""
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode()
+    head = [f"HTTP/1.1 {status.value} {status.phrase}", f"Content-Type: {content_type}", f"Content-Length: {len(body)}"]
+    head += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+
+
+def start_chunked_response(writer: asyncio.StreamWriter, *, content_type: str) -> None:
+    """Start a 200 response whose body is sent piece by piece with write_chunk(), ending with write_chunk(b"")."""
+    writer.write(
+        f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\nTransfer-Encoding: chunked\r\n\r\n".encode("latin-1")
+    )
+
+
+def write_chunk(writer: asyncio.StreamWriter, data: bytes) -> None:
+    writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+
+
+async def write_events(writer: asyncio.StreamWriter, events: asyncio.Queue) -> None:
+    """Write the events of the queue as NDJSON chunks until a None, waiting for slow clients to take each one."""
+    while (event := await events.get()) is not None:
+        write_chunk(writer, json.dumps(event).encode() + b"\n")
+        await writer.drain()
+
+
+def pooled_openai_chat_model_factory(
+    *, base_url: Optional[str] = None, api_key: Optional[str] = None, max_connections: int = 100
+) -> ChatModelFactory:
+    """Chat model factory for set_chat_model_factory() whose chat models all share one OpenAI client, and so one pool
+    of keep-alive HTTP connections. base_url can point to an OpenAI-compatible stand-in, and api_key defaults to the
+    OPENAI_API_KEY environment variable.
+    """
+    import httpx
+    import openai
+
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    # Retries are up to the scheduler
+    client_kwargs = {"base_url": base_url, "api_key": api_key, "max_retries": 0}
+    client = openai.OpenAI(**client_kwargs, http_client=httpx.Client(limits=limits))
+    async_client = openai.AsyncOpenAI(**client_kwargs, http_client=httpx.AsyncClient(limits=limits))
+
+    def factory(stage: str, **model_kwargs: Any) -> Any:
+        return openai_chat_model(
+            stage,
+            client=client.chat.completions,
+            async_client=async_client.chat.completions,
+            openai_api_key=client.api_key,
+            **model_kwargs,
+        )
+
+    return factory
+
+
+class OptimizerServer:
+    """Runs up to `workers` optimization jobs at the same time and queues up to `queue_size` more."""
+
+    def __init__(
+        self,
+        *,
+        workers: int = 4,
+        queue_size: int = 16,
+        tokens_per_highlight: int = 60,
+        assign_engine: str = "min_cost_flow",
+        prefilter_threshold: Optional[float] = None,
+        verify_attempts: Optional[int] = None,
+        highlight_counts: Optional[list[int]] = None,
+    ) -> None:
+        self.workers = workers
+        self.tokens_per_highlight = tokens_per_highlight
+        self.assign_engine = assign_engine
+        self.prefilter_threshold = prefilter_threshold
+        self.verify_attempts = verify_attempts
+        self.highlight_counts = highlight_counts
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.running = 0
+
+    async def _work(self) -> None:
+        while True:
+            job, on_event, future = await self.queue.get()
+            self.running += 1
+            try:
+                resume = await aoptimize_resume(**job, on_event=on_event)
+            except Exception as exception:
+                # The future of a request whose client went away is cancelled, and can't take the exception
+                if future.done():
+                    logging.exception("Optimization failed after its request was cancelled")
+                else:
+                    future.set_exception(exception)
+            else:
+                if not future.done():
+                    future.set_result(resume)
+            finally:
+                self.running -= 1
+                self.queue.task_done()
+
+    def _job(self, request: dict[str, Any]) -> dict[str, Any]:
+        """optimize_resume arguments of a request, raising KeyError, TypeError or ValueError for malformed requests."""
+        job = {
+            "resume": dict(request["resume"]),
+            "job_title": str(request["job_title"]),
+            "job_description": str(request["job_description"]),
+            "tokens_per_highlight": int(request.get("tokens_per_highlight", self.tokens_per_highlight)),
+            "assign_engine": str(request.get("assign_engine", self.assign_engine)),
+            "prefilter_threshold": (
+                float(request["prefilter_threshold"])
+                if request.get("prefilter_threshold") is not None
+                else self.prefilter_threshold
+            ),
+            "verify_attempts": (
+                int(request["verify_attempts"]) if request.get("verify_attempts") is not None else self.verify_attempts
+            ),
+            "highlight_counts": (
+                [int(highlight_count) for highlight_count in request["highlight_counts"]]
+                if request.get("highlight_counts") is not None
+                else self.highlight_counts
+            ),
+            "incremental": bool(request.get("incremental", False)),
+        }
+        if job["assign_engine"] not in ENGINES:
+            raise ValueError(f"Unknown assignment engine {job['assign_engine']!r}, expected one of {ENGINES}.")
+        if job["prefilter_threshold"] is not None:
+            check_threshold(job["prefilter_threshold"])
+        return job
+
+    async def _optimize(self, writer: asyncio.StreamWriter, body: bytes) -> None:
+        try:
+            request = json.loads(body)
+            job = self._job(request)
+        except (ValueError, KeyError, TypeError) as exception:
+            write_response(writer, HTTPStatus.BAD_REQUEST, {"error": f"Invalid optimization request: {exception!r}"})
+            return
+        stream = bool(request.get("stream", False))
+        events: asyncio.Queue = asyncio.Queue()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((job, events.put_nowait if stream else None, future))
+        except asyncio.QueueFull:
+            write_response(
+                writer, HTTPStatus.SERVICE_UNAVAILABLE, {"error": "The queue is full."}, headers={"Retry-After": "1"}
+            )
+            return
+        if not stream:
+            try:
+                resume = await future
+            except Exception as exception:
+                logging.exception("Optimization failed")
+                write_response(writer, HTTPStatus.INTERNAL_SERVER_ERROR, {"error": repr(exception)})
+            else:
+                write_response(writer, HTTPStatus.OK, {"resume": resume})
+            return
+        start_chunked_response(writer, content_type="application/x-ndjson")
+        event_writer = asyncio.create_task(write_events(writer, events))
+        try:
+            try:
+                resume = await future
+            except Exception as exception:
+                logging.exception("Optimization failed")
+                events.put_nowait({"event": "error", "error": repr(exception)})
+            else:
+                events.put_nowait({"event": "result", "resume": resume})
+            events.put_nowait(None)
+            await event_writer
+        finally:
+            event_writer.cancel()
+        write_chunk(writer, b"")
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Serve the requests of a keep-alive connection one after the other."""
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except ValueError as exception:
+                    # The rest of the connection can't be told apart from the body of a malformed request
+                    write_response(writer, HTTPStatus.BAD_REQUEST, {"error": f"Malformed HTTP request: {exception!r}"})
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, _headers, body = request
+                if method == "POST" and path == "/optimize":
+                    await self._optimize(writer, body)
+                elif method == "GET" and path == "/health":
+                    write_response(
+                        writer,
+                        HTTPStatus.OK,
+                        {"status": "ok", "queued": self.queue.qsize(), "running": self.running},
+                    )
+                else:
+                    write_response(writer, HTTPStatus.NOT_FOUND, {"error": f"No such endpoint {method} {path}."})
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # Clients closing their connections are a normal end of a connection
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, *, host: str = "127.0.0.1", port: int = 8080, unix_socket: Optional[str] = None) -> None:
+        """Serve forever on the Unix socket if given, otherwise on the TCP host and port."""
+        workers = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+        logging.info(f"Serving on {unix_socket or f'http://{host}:{port}'}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
@@ -0,0 +1,436 @@
+"""Stand-ins for the OpenAI chat models of the chains, to run the resume optimizer without network access."""
+
+import argparse
+import ast
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from http import HTTPStatus
+from typing import Any, AsyncIterator, Optional
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.pydantic_v1 import Field
+
+from .chains import ChatModelFactory, openai_chat_model
+from .scheduler import estimate_tokens
+
+DEFAULT_KEYWORDS = [
+    "Python",
+    "SQL",
+    "data pipelines",
+    "Airflow",
+    "dbt",
+    "Snowflake",
+    "Terraform",
+    "Kubernetes",
+    "Docker",
+    "AWS",
+    "Spark",
+    "Kafka",
+    "data modeling",
+    "CI/CD",
+    "stakeholder communication",
+    "data quality",
+    "ETL",
+    "Git",
+    "REST APIs",
+    "machine learning",
+]
+
+
+class ChatModelStats:
+    """Call and token counts of the stand-in chat models, shared by all models created by the same factory."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, *, prompt_tokens: int, completion_tokens: int) -> None:
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+
+def _score(*parts: str, levels: int) -> int:
+    """Deterministic pseudo-random score from 0 to levels - 1."""
+    return zlib.crc32("\n".join(parts).encode()) % levels
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic chat model that answers the prompts of each stage in the format the chains expect.
+    Latency is simulated with seconds_per_call plus seconds_per_token for each generated token.
+    """
+
+    stage: str
+    model_name: str = "fake"
+    keywords: list[str] = Field(default_factory=lambda: list(DEFAULT_KEYWORDS))
+    seconds_per_call: float = 0.0
+    seconds_per_token: float = 0.0
+    # Share of the rows of numbered lists of scores to garble, to exercise the recovery from malformed responses
+    malformed_row_rate: float = 0.0
+    # Share of the keywords to leave out of generated highlights, to exercise their verification. Revisions of
+    # highlights don't leave any out.
+    dropped_keyword_rate: float = 0.0
+    stats: ChatModelStats = Field(default_factory=ChatModelStats)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    @property
+    def _identifying_params(self) -> dict[str, Any]:
+        return {"model_name": self.model_name}
+
+    def _respond(self, messages: list[BaseMessage]) -> str:
+        system_text = "\n".join(message.content for message in messages if not isinstance(message, HumanMessage))
+        human_text = "\n".join(message.content for message in messages if isinstance(message, HumanMessage))
+        prompt_text = "\n".join(message.content for message in messages)
+        if self.stage == "extract_keywords":
+            return "\n".join(f"{i}. {keyword}" for i, keyword in enumerate(self.keywords, start=1))
+        elif self.stage == "get_difficulties":
+            keywords = re.findall(r"^\d+\. (.*)$", human_text, flags=re.MULTILINE)
+            # Difficulties range from 1 to 3 and depend on the keyword
+            return self._garble(
+                "\n".join(f"{i}. {_score(keyword, levels=3) + 1}" for i, keyword in enumerate(keywords, start=1)),
+                prompt_text,
+            )
+        elif self.stage == "get_compatibility":
+            sections_text, _, keywords_text = human_text.partition("Job description keywords")
+            keywords = re.findall(r"^\d+\. (.*)$", keywords_text, flags=re.MULTILINE)
+            # Packed requests have a "Section N:" header before each resume section
+            sections = re.split(r"^Section \d+:$", sections_text.split("\n", 1)[1], flags=re.MULTILINE)
+            sections = [section.strip() for section in (sections[1:] if len(sections) > 1 else sections)]
+            # Compatibilities range from 0 to 2 and depend on the keyword and the resume section
+            numbered_scores = [
+                "\n".join(f"{i}. {_score(keyword, section, levels=3)}" for i, keyword in enumerate(keywords, start=1))
+                for section in sections
+            ]
+            if "Section 1:" not in sections_text:
+                return self._garble(numbered_scores[0], prompt_text)
+            return self._garble(
+                "\n".join(f"Section {j}:\n{scores}" for j, scores in enumerate(numbered_scores, start=1)), prompt_text
+            )
+        elif self.stage == "summarize_resume_sections":
+            position = re.search(r"Job title: (.*)", human_text).group(1).strip()
+            return f"Has experience as {position}, delivering projects of varying scope."
+        elif self.stage == "insert_keywords":
+            highlight_count = int(re.search(r"list of (\d+) position", system_text).group(1))
+            human_messages = [message.content for message in messages if isinstance(message, HumanMessage)]
+            keywords = ast.literal_eval(human_messages[0].split(":", 1)[1].strip())
+            if len(human_messages) == 1:
+                keywords = [
+                    keyword
+                    for keyword in keywords
+                    if _score(keyword, prompt_text, levels=1000) >= 1000 * self.dropped_keyword_rate
+                ]
+            return "\n".join(
+                f"- Delivered projects using {', '.join(keywords[i::highlight_count]) or 'a variety of tools'}."
+                for i in range(highlight_count)
+            )
+        else:
+            raise ValueError(f"FakeChatModel doesn't know how to answer for stage {self.stage!r}.")
+
+    def _garble(self, content: str, prompt_text: str) -> str:
+        """Deterministically garble malformed_row_rate of the numbered rows of the content for the prompt."""
+        return "\n".join(
+            f"{row} (see above)"
+            if re.match(r"\d+\.", row) and _score(row, prompt_text, levels=1000) < 1000 * self.malformed_row_rate
+            else row
+            for row in content.split("\n")
+        )
+
+    def _result(self, messages: list[BaseMessage], content: str) -> ChatResult:
+        prompt_tokens = estimate_tokens("\n".join(message.content for message in messages))
+        completion_tokens = estimate_tokens(content)
+        self.stats.record(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=content))],
+            llm_output={
+                "token_usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+                "model_name": self.model_name,
+            },
+        )
+
+    def _latency(self, content: str) -> float:
+        return self.seconds_per_call + self.seconds_per_token * estimate_tokens(content)
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, **kwargs: Any) -> ChatResult:
+        content = self._respond(messages)
+        time.sleep(self._latency(content))
+        return self._result(messages, content)
+
+    async def _agenerate(
+        self, messages: list[BaseMessage], stop: Optional[list[str]] = None, **kwargs: Any
+    ) -> ChatResult:
+        content = self._respond(messages)
+        await asyncio.sleep(self._latency(content))
+        return self._result(messages, content)
+
+    async def _astream(
+        self, messages: list[BaseMessage], stop: Optional[list[str]] = None, **kwargs: Any
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        # Streamed like FakeOpenAIServer streams, one whitespace-separated token at a time
+        content = self._respond(messages)
+        self._result(messages, content)
+        await asyncio.sleep(self.seconds_per_call)
+        for token in re.findall(r"\s*\S+", content):
+            await asyncio.sleep(self.seconds_per_token)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+def fake_chat_model_factory(**fake_kwargs: Any) -> ChatModelFactory:
+    """Chat model factory for set_chat_model_factory() that creates FakeChatModels with the given fields.
+    The model names of the stages are kept, so that cache keys look like they would with OpenAI.
+    """
+
+    def factory(stage: str, **model_kwargs: Any) -> BaseChatModel:
+        return FakeChatModel(stage=stage, model_name=model_kwargs.get("model_name", "fake"), **fake_kwargs)
+
+    return factory
+
+
+class Cassette:
+    """Recorded chat model responses by request key, stored as newline-delimited JSON."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._responses: dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path) as cassette_file:
+                for line in cassette_file:
+                    if line.strip():
+                        recording = json.loads(line)
+                        self._responses[recording["key"]] = recording["content"]
+
+    def get(self, key: str) -> Optional[str]:
+        return self._responses.get(key)
+
+    def record(self, key: str, content: str) -> None:
+        with self._lock:
+            self._responses[key] = content
+            with open(self.path, "a") as cassette_file:
+                cassette_file.write(json.dumps({"key": key, "content": content}) + "\n")
+
+
+class CassetteChatModel(BaseChatModel):
+    """Chat model that replays the responses recorded in a cassette.
+    If a model to record with is given, requests that aren't in the cassette yet are sent to it and recorded.
+    Otherwise they raise a KeyError, so that replays never reach the network.
+    """
+
+    stage: str
+    model_kwargs: dict[str, Any]
+    cassette: Cassette
+    model: Optional[BaseChatModel] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @property
+    def _llm_type(self) -> str:
+        return "cassette"
+
+    @property
+    def model_name(self) -> str:
+        return self.model_kwargs.get("model_name", "cassette")
+
+    @property
+    def _identifying_params(self) -> dict[str, Any]:
+        return {"model_name": self.model_name}
+
+    def _key(self, messages: list[BaseMessage]) -> str:
+        request = [self.stage, self.model_kwargs, [(message.type, message.content) for message in messages]]
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    def _result(self, content: str) -> ChatResult:
+        # Replays report an LLM output like real responses do, so that tracing doesn't count them as LLM cache hits
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=content))], llm_output={"model_name": self.model_name}
+        )
+
+    def _missing(self, key: str) -> KeyError:
+        return KeyError(f"No response recorded for the {self.stage} request {key} in {self.cassette.path}.")
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, **kwargs: Any) -> ChatResult:
+        key = self._key(messages)
+        content = self.cassette.get(key)
+        if content is None:
+            if self.model is None:
+                raise self._missing(key)
+            content = self.model.invoke(messages).content
+            self.cassette.record(key, content)
+        return self._result(content)
+
+    async def _agenerate(
+        self, messages: list[BaseMessage], stop: Optional[list[str]] = None, **kwargs: Any
+    ) -> ChatResult:
+        key = self._key(messages)
+        content = self.cassette.get(key)
+        if content is None:
+            if self.model is None:
+                raise self._missing(key)
+            content = (await self.model.ainvoke(messages)).content
+            self.cassette.record(key, content)
+        return self._result(content)
+
+
+def cassette_chat_model_factory(
+    path: str, *, record: bool = False, model_factory: ChatModelFactory = openai_chat_model
+) -> ChatModelFactory:
+    """Chat model factory for set_chat_model_factory() that replays the responses in the cassette file.
+    With record, requests missing from the cassette are sent to the models of model_factory and recorded.
+    """
+    cassette = Cassette(path)
+
+    def factory(stage: str, **model_kwargs: Any) -> BaseChatModel:
+        return CassetteChatModel(
+            stage=stage,
+            model_kwargs=model_kwargs,
+            cassette=cassette,
+            model=model_factory(stage, **model_kwargs) if record else None,
+        )
+
+    return factory
+
+
+# Phrases of the system prompts that identify the stage of a request to the OpenAI-compatible stand-in
+STAGE_MARKERS = {
+    "keyword extractor": "extract_keywords",
+    "Assign difficulty values": "get_difficulties",
+    "Estimate how compatible": "get_compatibility",
+    "resume section summarizer": "summarize_resume_sections",
+    "expert resume writer": "insert_keywords",
+}
+
+
+class FakeOpenAIServer:
+    """OpenAI-compatible /v1/chat/completions endpoint that answers like FakeChatModel, including streamed responses.
+    Point ChatOpenAI at it with base_url="http://<host>:<port>/v1" to exercise the real HTTP client code without
+    network access.
+    """
+
+    def __init__(self, **fake_kwargs: Any) -> None:
+        self.fake_kwargs = fake_kwargs
+        self.stats = fake_kwargs.setdefault("stats", ChatModelStats())
+        self.connections = 0
+
+    def _model(self, messages: list[BaseMessage], model_name: str) -> FakeChatModel:
+        system_text = "\n".join(message.content for message in messages if isinstance(message, SystemMessage))
+        stage = next((stage for marker, stage in STAGE_MARKERS.items() if marker in system_text), "unknown")
+        return FakeChatModel(stage=stage, model_name=model_name, **self.fake_kwargs)
+
+    async def _complete(self, writer: asyncio.StreamWriter, request: dict[str, Any]) -> None:
+        from .server import start_chunked_response, write_chunk, write_response
+
+        messages = [
+            {"user": HumanMessage, "assistant": AIMessage}.get(message["role"], SystemMessage)(
+                content=message["content"]
+            )
+            for message in request["messages"]
+        ]
+        model = self._model(messages, request.get("model", "fake"))
+        content = model._respond(messages)
+        result = model._result(messages, content)
+        completion = {"id": "chatcmpl-fake", "created": int(time.time()), "model": model.model_name}
+        if not request.get("stream"):
+            await asyncio.sleep(model._latency(content))
+            write_response(
+                writer,
+                HTTPStatus.OK,
+                {
+                    **completion,
+                    "object": "chat.completion",
+                    "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                    ],
+                    "usage": result.llm_output["token_usage"],
+                },
+            )
+            return
+        start_chunked_response(writer, content_type="text/event-stream")
+        await asyncio.sleep(model.seconds_per_call)
+        tokens = re.findall(r"\s*\S+", content)
+        for i, token in enumerate(tokens):
+            await asyncio.sleep(model.seconds_per_token)
+            chunk = {
+                **completion,
+                "object": "chat.completion.chunk",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"role": "assistant", "content": token} if i == 0 else {"content": token},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            write_chunk(writer, f"data: {json.dumps(chunk)}\n\n".encode())
+            await writer.drain()
+        write_chunk(writer, b"data: [DONE]\n\n")
+        write_chunk(writer, b"")
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        from .server import read_request, write_response
+
+        self.connections += 1
+        try:
+            while (request := await read_request(reader)) is not None:
+                method, path, _headers, body = request
+                if method == "POST" and path.endswith("/chat/completions"):
+                    await self._complete(writer, json.loads(body))
+                else:
+                    write_response(writer, HTTPStatus.NOT_FOUND, {"error": {"message": f"No such endpoint {path}."}})
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, *, host: str = "127.0.0.1", port: int = 0) -> asyncio.AbstractServer:
+        """Start serving in the background. Port 0 picks a free port, see server.sockets[0].getsockname()."""
+        return await asyncio.start_server(self.handle_connection, host=host, port=port)
+
+
+async def _serve_fake_openai(*, host: str, port: int, **fake_kwargs: Any) -> None:
+    server = await FakeOpenAIServer(**fake_kwargs).start(host=host, port=port)
+    print(f"Serving a fake OpenAI API on http://{host}:{port}/v1", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a fake OpenAI-compatible API for offline testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8081)
+    parser.add_argument("--seconds-per-call", type=float, default=0.0, help="Simulated latency per call")
+    parser.add_argument("--seconds-per-token", type=float, default=0.0, help="Simulated latency per token")
+    parser.add_argument(
+        "--dropped-keyword-rate", type=float, default=0.0, help="Share of keywords to leave out of generated highlights"
+    )
+    args = parser.parse_args()
+    try:
+        asyncio.run(
+            _serve_fake_openai(
+                host=args.host,
+                port=args.port,
+                seconds_per_call=args.seconds_per_call,
+                seconds_per_token=args.seconds_per_token,
+                dropped_keyword_rate=args.dropped_keyword_rate,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,188 @@
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Iterator, Optional
+
+# Attributes added to every span recorded in the current context, e.g. the id of the job being optimized
+_context_attributes: ContextVar[dict[str, Any]] = ContextVar("trace_context_attributes", default={})
+# Attributes of the innermost open span, which annotate() adds to
+_span_attributes: ContextVar[Optional[dict[str, Any]]] = ContextVar("trace_span_attributes", default=None)
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    """Percentile of the values with linear interpolation, like numpy.percentile."""
+    values = sorted(values)
+    position = (len(values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+@dataclass
+class Span:
+    name: str
+    category: str
+    # Seconds since the creation of the tracer
+    start: float
+    duration: float
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+
+class Tracer:
+    """Records the spans of the stages, chain calls, LLM calls, and assignment solves of the optimizer.
+    Hooks are called with each span as soon as it ends.
+    """
+
+    def __init__(self, hooks: Optional[list[Callable[[Span], None]]] = None) -> None:
+        self.spans: list[Span] = []
+        self.hooks = list(hooks or [])
+        self._epoch = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook: Callable[[Span], None]) -> None:
+        self.hooks.append(hook)
+
+    def now(self) -> float:
+        return time.perf_counter() - self._epoch
+
+    def record(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+        for hook in self.hooks:
+            hook(span)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """Count, total, p50 and p95 wall time in milliseconds of the spans by category and name."""
+        durations: dict[str, list[float]] = {}
+        for span in self.spans:
+            durations.setdefault(f"{span.category}:{span.name}", []).append(1000 * span.duration)
+        return {
+            name: {
+                "count": len(span_durations),
+                "total_ms": sum(span_durations),
+                "p50_ms": _percentile(span_durations, 50),
+                "p95_ms": _percentile(span_durations, 95),
+            }
+            for name, span_durations in sorted(durations.items())
+        }
+
+    def to_json(self) -> dict[str, Any]:
+        return {"spans": [asdict(span) for span in self.spans], "summary": self.summary()}
+
+    def to_chrome_trace(self) -> dict[str, Any]:
+        """Trace in the Chrome trace event format, viewable in chrome://tracing or https://ui.perfetto.dev.
+        Overlapping spans are spread over as many rows (thread ids) as needed.
+        """
+        row_ends: list[float] = []
+        events = []
+        for span in sorted(self.spans, key=lambda span: span.start):
+            row = next((row for row, row_end in enumerate(row_ends) if row_end <= span.start), len(row_ends))
+            if row == len(row_ends):
+                row_ends.append(0.0)
+            row_ends[row] = span.start + span.duration
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": 1e6 * span.start,
+                    "dur": 1e6 * span.duration,
+                    "pid": os.getpid(),
+                    "tid": row,
+                    "args": span.attributes,
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path: str, *, format: str = "chrome") -> None:
+        """Write the trace to a file in the chrome or json format."""
+        with open(path, "w") as trace_file:
+            json.dump(self.to_chrome_trace() if format == "chrome" else self.to_json(), trace_file, default=str)
+
+
+_tracer: Optional[Tracer] = None
+
+
+def set_tracer(tracer: Optional[Tracer]) -> None:
+    """Set the tracer that records the spans of the optimizer, or disable tracing with None."""
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+def context_attributes() -> dict[str, Any]:
+    """Attributes added by trace_context() to the spans recorded in the current context."""
+    return _context_attributes.get()
+
+
+@contextmanager
+def trace_context(**attributes: Any) -> Iterator[None]:
+    """Add the attributes to all spans recorded inside the context, including in tasks started from it."""
+    token = _context_attributes.set({**_context_attributes.get(), **attributes})
+    try:
+        yield
+    finally:
+        _context_attributes.reset(token)
+
+
+@contextmanager
+def span(name: str, *, category: str, **attributes: Any) -> Iterator[dict[str, Any]]:
+    """Record a span with the current tracer, if any.
+    The yielded attributes dict can be added to while the span is open, also with annotate().
+    """
+    tracer = _tracer
+    attributes = {**_context_attributes.get(), **attributes}
+    if tracer is None:
+        yield attributes
+        return
+    token = _span_attributes.set(attributes)
+    start = tracer.now()
+    try:
+        yield attributes
+    except BaseException as exception:
+        attributes["error"] = repr(exception)
+        raise
+    finally:
+        _span_attributes.reset(token)
+        tracer.record(
+            Span(name=name, category=category, start=start, duration=tracer.now() - start, attributes=attributes)
+        )
+
+
+def annotate(**attributes: Any) -> None:
+    """Add the attributes to the innermost open span, if any."""
+    span_attributes = _span_attributes.get()
+    if span_attributes is not None:
+        span_attributes.update(attributes)
+
+
+def traced(name: str, *, category: str) -> Callable[[Callable], Callable]:
+    """Decorator that records a span for each call of the sync or async function."""
+
+    def decorator(func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, category=category):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, category=category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,66 @@
+"""Checks of generated highlights against the keywords assigned to their resume sections."""
+
+from dataclasses import asdict, dataclass
+from typing import Any
+
+from .match import KeywordIndex
+
+
+@dataclass
+class SectionCoverage:
+    section: int
+    position_keywords: list[str]
+    # Assigned keywords that appear in neither the position nor the highlights
+    missing_keywords: list[str]
+    highlight_count: int
+    expected_highlight_count: int
+    # Number of times the highlights were regenerated to fix them
+    regenerations: int = 0
+
+    @property
+    def passed(self) -> bool:
+        return len(self.missing_keywords) == 0 and self.highlight_count == self.expected_highlight_count
+
+    @property
+    def n_problems(self) -> int:
+        """Missing keywords plus missing or extra highlights."""
+        return len(self.missing_keywords) + abs(self.highlight_count - self.expected_highlight_count)
+
+    def problems(self) -> str:
+        """Description of what's wrong with the highlights, to call out when regenerating them."""
+        problems = []
+        if len(self.missing_keywords) > 0:
+            problems.append(f"These highlights are missing the ATS keywords {self.missing_keywords}.")
+        if self.highlight_count != self.expected_highlight_count:
+            problems.append(
+                f"There are {self.highlight_count} highlights instead of {self.expected_highlight_count} highlights."
+            )
+        return "\n".join(problems)
+
+
+def verify_section(
+    section: int, *, position: str, highlights: list[str], position_keywords: list[str], expected_highlight_count: int
+) -> SectionCoverage:
+    """Check that the highlights of the resume section contain the keywords assigned to it, counting the keywords of the
+    position title as present, and that there are as many as requested.
+    """
+    found_keyword_indices = KeywordIndex(position_keywords).find("\n".join([position, *highlights]))
+    return SectionCoverage(
+        section=section,
+        position_keywords=position_keywords,
+        missing_keywords=[keyword for i, keyword in enumerate(position_keywords) if i not in found_keyword_indices],
+        highlight_count=len(highlights),
+        expected_highlight_count=expected_highlight_count,
+    )
+
+
+def coverage_report(sections: list[SectionCoverage]) -> dict[str, Any]:
+    """Coverage of the assigned keywords by the highlights of all resume sections, and of each resume section."""
+    n_keywords = sum(len(section.position_keywords) for section in sections)
+    n_missing_keywords = sum(len(section.missing_keywords) for section in sections)
+    return {
+        "coverage": 1 - n_missing_keywords / n_keywords if n_keywords > 0 else 1.0,
+        "passed": all(section.passed for section in sections),
+        "regenerated_sections": sum(section.regenerations > 0 for section in sections),
+        "sections": [{**asdict(section), "passed": section.passed} for section in sections],
+    }
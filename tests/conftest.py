@@ -0,0 +1,24 @@
+import os
+
+import pytest
+
+from resume_optimizer.chains import set_chat_model_factory
+from resume_optimizer.testing import fake_chat_model_factory
+from resume_optimizer.trace import Tracer, set_tracer
+
+
+@pytest.fixture
+def llm_request_stages():
+    """Answer all chains with FakeChatModels, and list the stage of each LLM request that's sent."""
+    os.environ.setdefault("OPENAI_API_KEY", "none")
+    stages = []
+
+    def record_request(span):
+        if span.category == "llm":
+            stages.append(span.attributes["stage"])
+
+    set_chat_model_factory(fake_chat_model_factory())
+    set_tracer(Tracer(hooks=[record_request]))
+    yield stages
+    set_tracer(None)
+    set_chat_model_factory(None)
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from resume_optimizer.assign import _section_keyword_counts, assign
+
+
+def _objective(compatibility, assignment):
+    return sum(compatibility[resume_section_index][keyword_index] for keyword_index, resume_section_index in assignment)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_min_cost_flow_matches_scip(seed):
+    rng = np.random.default_rng(seed)
+    n_resume_sections, n_keywords = rng.integers(2, 6), rng.integers(5, 30)
+    compatibility = rng.integers(0, 4, size=(n_resume_sections, n_keywords))
+    count_weights = [3, 3, 2]
+    assignments = {
+        engine: assign(compatibility=compatibility, count_weights=count_weights, engine=engine)
+        for engine in ("min_cost_flow", "scip")
+    }
+    assert _objective(compatibility, assignments["min_cost_flow"]) == _objective(compatibility, assignments["scip"])
+    section_keyword_counts = _section_keyword_counts(
+        n_keywords=n_keywords, n_resume_sections=n_resume_sections, count_weights=count_weights
+    )
+    for assignment in assignments.values():
+        assert sorted(keyword_index for keyword_index, _ in assignment) == list(range(n_keywords))
+        assert (
+            np.bincount(
+                [resume_section_index for _, resume_section_index in assignment], minlength=n_resume_sections
+            ).tolist()
+            == section_keyword_counts
+        )
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        assign(compatibility=[[1, 2]], engine="simplex")
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from resume_optimizer.cache import StageCache, section_hash, set_stage_cache
+from resume_optimizer.chains import aget_compatibility, aget_difficulties, stage_model_name
+
+POSITION_HIGHLIGHTS = [("Data Engineer", "- Built pipelines"), ("Data Analyst", "- Built dashboards")]
+
+
+@pytest.fixture
+def stage_cache(tmp_path):
+    stage_cache = StageCache(str(tmp_path / "stage_cache.db"))
+    set_stage_cache(stage_cache)
+    yield stage_cache
+    set_stage_cache(None)
+
+
+def test_difficulties_merge_cached_and_new_values(stage_cache, llm_request_stages):
+    model = stage_model_name("get_difficulties")
+    # A value the LLM wouldn't give, to tell it apart
+    stage_cache.set_difficulties(difficulties={"Python": 7}, job_title="Data Engineer", model=model)
+    keywords = ["Python", "SQL", "dbt"]
+    difficulties = asyncio.run(aget_difficulties(job_description_keywords=keywords, job_title="Data Engineer"))
+    assert difficulties[0] == 7
+    assert llm_request_stages == ["get_difficulties"]
+    assert len(stage_cache.get_difficulties(keywords=keywords, job_title="Data Engineer", model=model)) == 3
+
+    llm_request_stages.clear()
+    assert asyncio.run(aget_difficulties(job_description_keywords=keywords, job_title="data engineer")) == difficulties
+    assert llm_request_stages == []
+
+
+def test_compatibilities_merge_cached_and_new_cells(stage_cache, llm_request_stages):
+    model = stage_model_name("get_compatibility")
+    stage_cache.set_compatibilities(
+        compatibilities={"Python": 9, "SQL": 9}, section_hash=section_hash(*POSITION_HIGHLIGHTS[0]), model=model
+    )
+    compatibility = asyncio.run(
+        aget_compatibility(job_description_keywords=["Python", "SQL"], position_highlights=POSITION_HIGHLIGHTS)
+    )
+    assert compatibility[0] == [9, 9]
+    assert all(value in range(3) for value in compatibility[1])
+    assert llm_request_stages == ["get_compatibility"]
+
+    llm_request_stages.clear()
+    assert (
+        asyncio.run(
+            aget_compatibility(job_description_keywords=["python", "SQL"], position_highlights=POSITION_HIGHLIGHTS)
+        )
+        == compatibility
+    )
+    assert llm_request_stages == []
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from resume_optimizer.chains import (
+    MAX_PACKED_SECTION_TOKENS,
+    MAX_PARSE_RETRIES,
+    MAX_SCORES_PER_REQUEST,
+    _pack_compatibility_requests,
+    _parse_numbered_scores,
+    _resume_section,
+    aget_difficulties,
+    set_chat_model_factory,
+)
+from resume_optimizer.scheduler import estimate_tokens
+from resume_optimizer.testing import DEFAULT_KEYWORDS, fake_chat_model_factory
+
+
+def _check_requests(missing_keywords, position_highlights):
+    requests = _pack_compatibility_requests(missing_keywords, position_highlights)
+    requested_cells = set()
+    for section_indices, keywords in requests:
+        assert len(section_indices) * len(keywords) <= MAX_SCORES_PER_REQUEST
+        if len(section_indices) > 1:
+            section_tokens = [estimate_tokens(_resume_section(*position_highlights[i])) for i in section_indices]
+            assert sum(section_tokens) <= MAX_PACKED_SECTION_TOKENS
+        requested_cells |= {(i, keyword) for i in section_indices for keyword in keywords}
+    assert requested_cells >= {(i, keyword) for i, keywords in enumerate(missing_keywords) for keyword in keywords}
+    return requests
+
+
+def test_long_keyword_lists_are_split_into_even_chunks():
+    keywords = {f"keyword {k}": f"Keyword {k}" for k in range(2 * MAX_SCORES_PER_REQUEST + 1)}
+    requests = _check_requests([keywords], [("Data Engineer", "- Built pipelines")])
+    assert sorted(len(keywords) for _, keywords in requests) == [40, 40, 41]
+
+
+def test_short_sections_are_packed_within_the_scores_limit():
+    keywords = {f"keyword {k}": f"Keyword {k}" for k in range(20)}
+    position_highlights = [(f"Position {i}", "- Built pipelines") for i in range(7)]
+    requests = _check_requests([keywords] * 7, position_highlights)
+    assert [section_indices for section_indices, _ in requests] == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_long_sections_are_packed_within_the_token_limit():
+    keywords = {"python": "Python"}
+    highlights = "- Built pipelines with Python and SQL for reporting.\n" * (MAX_PACKED_SECTION_TOKENS // 30)
+    position_highlights = [(f"Position {i}", highlights) for i in range(6)]
+    requests = _check_requests([keywords] * 6, position_highlights)
+    # Three sections would exceed the token limit even though they'd be asked for only 3 values
+    assert [section_indices for section_indices, _ in requests] == [[0, 1], [2, 3], [4, 5]]
+
+
+def test_sections_without_missing_keywords_are_skipped():
+    position_highlights = [(f"Position {i}", "- Built pipelines") for i in range(3)]
+    requests = _check_requests([{}, {"python": "Python"}, {}], position_highlights)
+    assert requests == [([1], {"python": "Python"})]
+
+
+def test_numbered_scores_tolerate_separators_and_skip_malformed_rows():
+    keywords = {"python": "Python", "sql": "SQL", "dbt": "dbt", "spark": "Spark"}
+    rows = ["1) 2", " 2: 1 ", "3. 3 (see above)", "4. 9", "5. 1", "1. 3", "Here are the values:"]
+    assert _parse_numbered_scores(rows, keywords=keywords, values=range(1, 4)) == {"python": 2, "sql": 1}
+
+
+def test_missing_scores_are_requested_again(llm_request_stages):
+    expected_difficulties = asyncio.run(
+        aget_difficulties(job_description_keywords=DEFAULT_KEYWORDS, job_title="Data Engineer")
+    )
+    set_chat_model_factory(fake_chat_model_factory(malformed_row_rate=0.1))
+    llm_request_stages.clear()
+    difficulties = asyncio.run(aget_difficulties(job_description_keywords=DEFAULT_KEYWORDS, job_title="Data Engineer"))
+    assert difficulties == expected_difficulties
+    assert 1 < len(llm_request_stages) <= 1 + MAX_PARSE_RETRIES
+
+
+def test_scores_still_missing_after_the_retries_raise(llm_request_stages):
+    set_chat_model_factory(fake_chat_model_factory(malformed_row_rate=1.0))
+    with pytest.raises(ValueError, match="didn't return valid get_difficulties values"):
+        asyncio.run(aget_difficulties(job_description_keywords=DEFAULT_KEYWORDS, job_title="Data Engineer"))
+    assert llm_request_stages == ["get_difficulties"] * (1 + MAX_PARSE_RETRIES)
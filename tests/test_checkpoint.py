@@ -0,0 +1,54 @@
+import copy
+
+from resume_optimizer.checkpoint import RunCheckpoint
+from resume_optimizer.optimize import optimize_resume
+from resume_optimizer.testing import DEFAULT_KEYWORDS
+
+RESUME = {
+    "work": [
+        {"position": "Data Engineer", "highlights": ["Built pipelines with Python", "Maintained SQL reports"]},
+        {"position": "Data Analyst", "highlights": ["Built dashboards", "Automated reports with Airflow"]},
+    ]
+}
+
+
+def _optimize(run_dir, **kwargs):
+    return optimize_resume(
+        resume=copy.deepcopy(RESUME),
+        job_description=f"Uses {', '.join(DEFAULT_KEYWORDS)}.",
+        job_title="Data Engineer",
+        tokens_per_highlight=20,
+        run_dir=str(run_dir),
+        **kwargs,
+    )
+
+
+def test_checkpoint_only_loads_outputs_saved_with_the_key(tmp_path):
+    RunCheckpoint(str(tmp_path)).save("keywords", ["SQL"], key="a")
+    assert RunCheckpoint(str(tmp_path)).load("keywords", key="a") == (True, ["SQL"])
+    assert RunCheckpoint(str(tmp_path)).load("keywords", key="b") == (False, None)
+    assert RunCheckpoint(str(tmp_path), resume=False).load("keywords", key="a") == (False, None)
+    assert RunCheckpoint(str(tmp_path), regenerate=["keywords"]).load("keywords", key="a") == (False, None)
+
+
+def test_resume_run_reuses_finished_stages(tmp_path, llm_request_stages):
+    first = _optimize(tmp_path)
+    llm_request_stages.clear()
+    assert _optimize(tmp_path, resume_run=True) == first
+    assert llm_request_stages == []
+
+
+def test_regenerate_reruns_the_stage(tmp_path, llm_request_stages):
+    _optimize(tmp_path)
+    llm_request_stages.clear()
+    _optimize(tmp_path, resume_run=True, regenerate=["difficulties"])
+    # The fake difficulties don't change, so the stages that depend on them are loaded back
+    assert llm_request_stages == ["get_difficulties"]
+
+
+def test_other_highlight_counts_only_reassign_and_regenerate(tmp_path, llm_request_stages):
+    _optimize(tmp_path, highlight_counts=[2, 2])
+    llm_request_stages.clear()
+    optimized = _optimize(tmp_path, resume_run=True, highlight_counts=[1, 3])
+    assert [len(work["highlights"]) for work in optimized["work"]] == [1, 3]
+    assert set(llm_request_stages) == {"insert_keywords"}
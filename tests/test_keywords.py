@@ -0,0 +1,37 @@
+import pytest
+
+from resume_optimizer.cache import normalize_keyword
+from resume_optimizer.keywords import KeywordStore
+
+
+@pytest.fixture
+def keyword_store(tmp_path):
+    return KeywordStore(str(tmp_path / "keywords.db"))
+
+
+def test_deduplicate_keeps_the_posting_spelling(keyword_store):
+    assert keyword_store.deduplicate(["SQL Server Integration Services (SSIS)", "SSIS", "Kubernetes", "k8s"]) == [
+        "SQL Server Integration Services (SSIS)",
+        "Kubernetes",
+    ]
+    assert keyword_store.deduplicate(["SSIS", "Golang"]) == ["SSIS", "Golang"]
+
+
+def test_canonical_keys_store_abbreviations(keyword_store):
+    keyword_store.canonical_keys(["Infrastructure as Code (IaC)"])
+    assert keyword_store.canonical_keys(["IaC", "Kafka"]) == list(
+        map(normalize_keyword, ["Infrastructure as Code", "Kafka"])
+    )
+
+
+def test_canonical_keys_keep_other_parentheticals_to_the_posting(keyword_store):
+    assert keyword_store.canonical_keys(["Cloud (AWS)", "AWS", "Databases (Snowflake)"]) == list(
+        map(normalize_keyword, ["Cloud", "Cloud", "Databases"])
+    )
+    assert keyword_store.canonical_keys(["AWS", "Snowflake", "k8s"]) == list(
+        map(normalize_keyword, ["AWS", "Snowflake", "Kubernetes"])
+    )
+
+
+def test_golang_isnt_an_alias_of_go(keyword_store):
+    assert keyword_store.resolve("Golang") is None
@@ -0,0 +1,42 @@
+import time
+
+from langchain_core.load import dumps
+from langchain_core.outputs import Generation
+
+from resume_optimizer.llm_cache import BoundedLLMCache, _cache_key
+
+RESPONSE = [Generation(text="1. Python\n2. SQL")]
+
+
+def test_evicts_least_recently_used_responses_down_to_90_percent(tmp_path):
+    entry_size = len(_cache_key("prompt 0", "llm")) + len("\n".join(dumps(generation) for generation in RESPONSE))
+    cache = BoundedLLMCache(str(tmp_path / "llm_cache.db"), max_bytes=10 * entry_size, batch_size=1)
+    for i in range(10):
+        cache.update(f"prompt {i}", "llm", RESPONSE)
+    assert cache.stats()["evictions"] == 0
+    # Make the first response the most recently used one
+    assert cache.lookup("prompt 0", "llm") is not None
+
+    cache.update("prompt 10", "llm", RESPONSE)
+    assert cache.stats()["evictions"] == 2
+    assert cache.stats()["bytes"] <= 0.9 * cache.max_bytes
+    assert cache.lookup("prompt 0", "llm") == RESPONSE
+    assert cache.lookup("prompt 1", "llm") is None
+    assert cache.lookup("prompt 2", "llm") is None
+    assert cache.lookup("prompt 10", "llm") == RESPONSE
+
+
+def test_responses_older_than_the_ttl_are_neither_served_nor_kept(tmp_path, monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    cache = BoundedLLMCache(str(tmp_path / "llm_cache.db"), ttl=60, batch_size=1)
+    cache.update("old prompt", "llm", RESPONSE)
+    assert cache.lookup("old prompt", "llm") == RESPONSE
+
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert cache.lookup("old prompt", "llm") is None
+    cache.update("new prompt", "llm", RESPONSE)
+    assert cache.stats()["evictions"] == 1
+    assert cache.lookup("new prompt", "llm") == RESPONSE
+    # A second cache on the same database keeps the size of the responses
+    assert BoundedLLMCache(str(tmp_path / "llm_cache.db")).stats()["bytes"] == cache.stats()["bytes"]
@@ -0,0 +1,22 @@
+from resume_optimizer.match import KeywordIndex
+
+
+def _found(keywords, text):
+    return {keywords[i] for i in KeywordIndex(keywords).find(text)}
+
+
+def test_single_letter_keywords_only_match_whole_tokens():
+    assert _found(["R", "Go"], "Provisioned servers with Terraform and Google Cloud") == set()
+    assert _found(["R", "Go"], "Analyzed churn in R.") == {"R"}
+
+
+def test_symbols_are_part_of_tokens():
+    keywords = ["C++", "C#", "Node.js", "C"]
+    assert _found(keywords, "Ported C++ and C# services to Node.js") == {"C++", "C#", "Node.js"}
+    assert _found(keywords, "Wrote drivers in C, then Node.js.") == {"C", "Node.js"}
+
+
+def test_multi_token_keywords_and_overlaps():
+    keywords = ["data pipelines", "pipeline", "Apache Spark", "Spark"]
+    assert _found(keywords, "Built Data Pipelines on Apache Spark") == set(keywords)
+    assert _found(keywords, "Built data\npipelines") == {"pipeline"}
@@ -0,0 +1,88 @@
+import asyncio
+import copy
+import os
+
+import pytest
+
+from resume_optimizer.cache import StageCache, job_hash, set_stage_cache
+from resume_optimizer.chains import set_chat_model_factory
+from resume_optimizer.optimize import aoptimize_resume_batch, optimize_resume
+from resume_optimizer.testing import DEFAULT_KEYWORDS, FakeChatModel
+
+RESUME = {
+    "work": [
+        {"position": "Data Engineer", "highlights": ["Built pipelines with Python", "Maintained SQL reports"]},
+        {"position": "Data Analyst", "highlights": ["Built dashboards", "Automated reports with Python"]},
+    ]
+}
+BROKEN_JOB_TITLE = "Broken Engineer"
+
+
+class BrokenJobChatModel(FakeChatModel):
+    """FakeChatModel whose difficulty scores for BROKEN_JOB_TITLE can't be parsed."""
+
+    def _garble(self, content, prompt_text):
+        if BROKEN_JOB_TITLE in prompt_text:
+            return FakeChatModel._garble(self.copy(update={"malformed_row_rate": 1.0}), content, prompt_text)
+        return super()._garble(content, prompt_text)
+
+
+@pytest.fixture
+def broken_job_chat_models():
+    os.environ.setdefault("OPENAI_API_KEY", "none")
+    set_chat_model_factory(
+        lambda stage, **model_kwargs: BrokenJobChatModel(stage=stage, model_name=model_kwargs.get("model_name", "fake"))
+    )
+    yield
+    set_chat_model_factory(None)
+
+
+async def _collect(jobs):
+    return [
+        job async for job, _ in aoptimize_resume_batch(resume=copy.deepcopy(RESUME), jobs=jobs, tokens_per_highlight=20)
+    ]
+
+
+def test_batch_keeps_going_when_a_job_fails(broken_job_chat_models):
+    jobs = [
+        {"id": "first", "job_title": "Data Engineer", "job_description": f"Uses {', '.join(DEFAULT_KEYWORDS)}."},
+        {"id": "broken", "job_title": BROKEN_JOB_TITLE, "job_description": "Uses Python."},
+        {"id": "last", "job_title": "Analytics Engineer", "job_description": "Uses SQL and Python."},
+    ]
+    optimized_jobs = asyncio.run(_collect(jobs))
+    assert sorted(job["id"] for job in optimized_jobs) == ["first", "last"]
+
+
+def test_incremental_optimization_only_redoes_changed_sections(tmp_path, llm_request_stages):
+    stage_cache = StageCache(str(tmp_path / "stage_cache.db"))
+    set_stage_cache(stage_cache)
+    resume = {
+        "work": [
+            {"position": "Data Engineer", "highlights": ["Built pipelines with Python", "Maintained SQL reports"]},
+            {"position": "Data Analyst", "highlights": ["Built dashboards", "Automated reports with Airflow"]},
+            {"position": "Intern", "highlights": ["Cleaned data in spreadsheets"]},
+        ]
+    }
+    job = {"job_title": "Data Engineer", "job_description": f"Uses {', '.join(DEFAULT_KEYWORDS)}."}
+    try:
+        optimize_resume(resume=copy.deepcopy(resume), tokens_per_highlight=20, incremental=True, **job)
+        first_manifest = stage_cache.get_manifest(job_hash=job_hash(**job))
+        resume["work"][2]["highlights"] = ["Cleaned data in spreadsheets", "Filed reports"]
+        llm_request_stages.clear()
+        optimized = optimize_resume(resume=copy.deepcopy(resume), tokens_per_highlight=20, incremental=True, **job)
+    finally:
+        set_stage_cache(None)
+    second_manifest = stage_cache.get_manifest(job_hash=job_hash(**job))
+    unchanged_sections = [
+        i
+        for i, (first, second) in enumerate(zip(first_manifest["sections"], second_manifest["sections"]))
+        if first["hash"] == second["hash"] and first["position_keywords"] == second["position_keywords"]
+    ]
+    assert unchanged_sections != []
+    for i in unchanged_sections:
+        assert optimized["work"][i]["highlights"] == first_manifest["sections"][i]["highlights"]
+    # Only the edited resume section is scored, and only the sections that changed get new highlights
+    expected_stages = ["summarize_resume_sections", "get_compatibility"] + ["insert_keywords"] * (
+        3 - len(unchanged_sections)
+    )
+    assert sorted(llm_request_stages) == sorted(expected_stages)
@@ -0,0 +1,32 @@
+import pytest
+
+from resume_optimizer.planner import MIN_TOKENS_PER_HIGHLIGHT, BudgetExceededError, fit_to_budget, plan_optimization
+
+PLAN_KWARGS = {
+    "position_highlights": [("Data Engineer", "- Built pipelines with Python"), ("Data Analyst", "- Built dashboards")],
+    "job_description": "Data Engineer working with Python, SQL, dbt, Airflow and Snowflake on our data platform. " * 5,
+    "job_title": "Data Engineer",
+    "highlight_counts": [3, 2],
+}
+
+
+def test_plans_within_the_budget_are_kept():
+    plan = plan_optimization(tokens_per_highlight=100, **PLAN_KWARGS)
+    assert fit_to_budget(max_tokens_budget=plan.tokens, tokens_per_highlight=100, **PLAN_KWARGS) == plan
+
+
+@pytest.mark.parametrize("verify_attempts", [None, 2])
+def test_plans_over_the_budget_shrink_the_tokens_per_highlight(verify_attempts):
+    kwargs = {**PLAN_KWARGS, "verify_attempts": verify_attempts}
+    budget = plan_optimization(tokens_per_highlight=60, **kwargs).tokens
+    plan = fit_to_budget(max_tokens_budget=budget, tokens_per_highlight=100, **kwargs)
+    assert MIN_TOKENS_PER_HIGHLIGHT <= plan.tokens_per_highlight < 100
+    assert plan.tokens <= budget
+    # The most tokens per highlight within the budget
+    assert plan_optimization(tokens_per_highlight=plan.tokens_per_highlight + 1, **kwargs).tokens > budget
+
+
+def test_plans_over_the_budget_at_the_fewest_tokens_per_highlight_raise():
+    budget = plan_optimization(tokens_per_highlight=MIN_TOKENS_PER_HIGHLIGHT, **PLAN_KWARGS).tokens - 1
+    with pytest.raises(BudgetExceededError, match=f"over the budget of {budget} tokens"):
+        fit_to_budget(max_tokens_budget=budget, tokens_per_highlight=100, **PLAN_KWARGS)
@@ -0,0 +1,70 @@
+import random
+
+import pytest
+
+from resume_optimizer.match import tokenize
+from resume_optimizer.postings import SHINGLE_SIZE, PostingIndex
+
+N_POSTINGS = 40
+POSTING_WORDS = 200
+JOB = {"job_title": "Data Engineer", "keywords_model": "gpt-4", "difficulties_model": "gpt-4"}
+
+
+def _shingles(text: str) -> set[str]:
+    tokens = tokenize(text)
+    return {" ".join(tokens[i : i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+
+
+def _jaccard(text: str, other_text: str) -> float:
+    return len(_shingles(text) & _shingles(other_text)) / len(_shingles(text) | _shingles(other_text))
+
+
+def _random_word(rng: random.Random) -> str:
+    return "".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=8))
+
+
+@pytest.fixture
+def postings(tmp_path):
+    """Index of postings of random words, and the postings."""
+    rng = random.Random(0)
+    posting_index = PostingIndex(str(tmp_path / "postings.db"), threshold=0.8)
+    postings = [" ".join(_random_word(rng) for _ in range(POSTING_WORDS)) for _ in range(N_POSTINGS)]
+    for i, posting in enumerate(postings):
+        posting_index.add(job_description=posting, keywords=[f"Keyword {i}"], difficulties=[1], **JOB)
+    return posting_index, postings
+
+
+def _reworded(posting: str, *, n_words: int, rng: random.Random) -> str:
+    """The posting with n_words words replaced, each changing up to SHINGLE_SIZE shingles."""
+    words = posting.split()
+    for i in rng.sample(range(len(words)), n_words):
+        words[i] = _random_word(rng)
+    return " ".join(words)
+
+
+def test_reposts_above_the_threshold_are_found(postings):
+    posting_index, postings = postings
+    rng = random.Random(1)
+    found = 0
+    for i, posting in enumerate(postings):
+        repost = _reworded(posting, n_words=3, rng=rng)
+        assert _jaccard(posting, repost) >= 0.9
+        near_duplicate = posting_index.find(job_description=repost, **JOB)
+        if near_duplicate is not None:
+            assert near_duplicate.keywords == [f"Keyword {i}"]
+            found += 1
+    assert found >= 0.95 * N_POSTINGS
+
+
+def test_postings_below_the_threshold_are_not_found(postings):
+    posting_index, postings = postings
+    rng = random.Random(2)
+    for posting in postings:
+        rewrite = _reworded(posting, n_words=25, rng=rng)
+        assert _jaccard(posting, rewrite) <= 0.6
+        assert posting_index.find(job_description=rewrite, **JOB) is None
+
+
+def test_postings_of_other_job_title_families_are_not_found(postings):
+    posting_index, postings = postings
+    assert posting_index.find(job_description=postings[0], **{**JOB, "job_title": "Registered Nurse"}) is None
@@ -0,0 +1,15 @@
+import numpy as np
+import pytest
+
+from resume_optimizer.prefilter import UNCERTAIN, confident_compatibility
+
+
+@pytest.mark.parametrize("threshold", [-0.1, 0.5, 0.9])
+def test_confident_compatibility_rejects_overlapping_thresholds(threshold):
+    with pytest.raises(ValueError):
+        confident_compatibility(np.array([[0.0, 0.5, 1.0]]), threshold=threshold)
+
+
+def test_confident_compatibility_leaves_the_middle_to_the_llm():
+    compatibility = confident_compatibility(np.array([[0.0, 0.5, 1.0]]), threshold=0.2)
+    assert compatibility.tolist() == [[0, UNCERTAIN, 2]]
@@ -0,0 +1,35 @@
+import pytest
+
+from resume_optimizer.preprocess import JobDescriptionPreprocessor
+
+REQUIREMENTS = ["- 5+ years of Python and SQL", "- Experience with Airflow and dbt"]
+
+
+def _preprocess(job_description: str) -> str:
+    return JobDescriptionPreprocessor().preprocess(job_description, model="gpt-4").text
+
+
+@pytest.mark.parametrize(
+    "requirements_heading", ["Requirements:", "Requirements", "About You", "What you'll bring", "What You'll Do"]
+)
+@pytest.mark.parametrize("blank_line", ["", "\n"])
+def test_boilerplate_sections_end_at_the_next_heading(requirements_heading, blank_line):
+    job_description = "\n".join(
+        [
+            "Benefits:",
+            blank_line + "- Unlimited PTO",
+            "- 401(k) matching",
+            blank_line + requirements_heading,
+            *REQUIREMENTS,
+        ]
+    )
+    text = _preprocess(job_description)
+    assert "PTO" not in text
+    assert "401(k)" not in text
+    assert requirements_heading in text
+    assert all(requirement in text for requirement in REQUIREMENTS)
+
+
+def test_boilerplate_sections_end_at_a_blank_line_after_their_list():
+    text = _preprocess("What we offer\n- Remote work\n- Free lunch\n\nYou'll build our data platform with Spark.")
+    assert text == "You'll build our data platform with Spark."
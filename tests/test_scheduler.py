@@ -0,0 +1,33 @@
+import asyncio
+import random
+
+from resume_optimizer.scheduler import Scheduler
+
+
+def test_backoff_frees_the_concurrency_slot(monkeypatch):
+    monkeypatch.setattr(random, "uniform", lambda low, high: high)
+    scheduler = Scheduler(max_concurrency=1, base_delay=0.5)
+    finished = []
+
+    async def flaky_request():
+        if "flaky" not in finished:
+            finished.append("flaky")
+            raise asyncio.TimeoutError()
+        finished.append("flaky retried")
+
+    async def ready_request():
+        finished.append("ready")
+
+    async def main():
+        flaky = asyncio.create_task(
+            scheduler.run(flaky_request, stage="insert_keywords", model="m", estimated_tokens=1)
+        )
+        await asyncio.sleep(0.1)
+        await asyncio.wait_for(
+            scheduler.run(ready_request, stage="insert_keywords", model="m", estimated_tokens=1), 0.2
+        )
+        await flaky
+
+    asyncio.run(main())
+    assert finished == ["flaky", "ready", "flaky retried"]
+    assert scheduler._running == 0
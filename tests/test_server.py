@@ -0,0 +1,58 @@
+import asyncio
+import json
+
+import pytest
+
+from resume_optimizer.server import OptimizerServer
+
+
+async def _exchange(server: OptimizerServer, request: bytes) -> bytes:
+    """Send the raw request to a connection served by the server, and return everything it responds with."""
+    tcp_server = await asyncio.start_server(server.handle_connection, host="127.0.0.1", port=0)
+    async with tcp_server:
+        reader, writer = await asyncio.open_connection(*tcp_server.sockets[0].getsockname()[:2])
+        writer.write(request)
+        writer.write_eof()
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+    return response
+
+
+@pytest.mark.parametrize(
+    "request_head",
+    [b"GARBAGE\r\n\r\n", b"POST /optimize HTTP/1.1\r\nContent-Length: many\r\n\r\n"],
+)
+def test_malformed_requests_are_bad_requests(request_head):
+    response = asyncio.run(_exchange(OptimizerServer(), request_head))
+    assert response.startswith(b"HTTP/1.1 400 Bad Request\r\n")
+
+
+def test_unknown_assignment_engines_are_bad_requests():
+    body = json.dumps(
+        {"resume": {"work": []}, "job_title": "Data Engineer", "job_description": "SQL", "assign_engine": "greedy"}
+    ).encode()
+    request = b"POST /optimize HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+    response = asyncio.run(_exchange(OptimizerServer(), request))
+    assert response.startswith(b"HTTP/1.1 400 Bad Request\r\n")
+    assert b"Unknown assignment engine 'greedy'" in response
+
+
+def test_cancelled_connections_stay_cancelled():
+    async def main():
+        reader = asyncio.StreamReader()
+        writer = _ClosingWriter()
+        handler = asyncio.create_task(OptimizerServer().handle_connection(reader, writer))
+        await asyncio.sleep(0)
+        handler.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await handler
+        assert writer.closed
+
+    asyncio.run(main())
+
+
+class _ClosingWriter:
+    closed = False
+
+    def close(self) -> None:
+        self.closed = True